@@ -1 +1,7 @@
-from .core import Chat
+def __getattr__(name):
+    # Chat imports torch and the model code, only load it when it is used
+    if name == "Chat":
+        from .core import Chat
+
+        return Chat
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,9 +1,14 @@
 import os
 import re
+import time
 import logging
 import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from dataclasses import dataclass, asdict
-from typing import Literal, Optional, List, Tuple, Dict, Union
+from typing import Literal, Optional, List, Set, Tuple, Dict, Union, Callable, Iterator
 from json import load
 from pathlib import Path
 
@@ -22,6 +27,8 @@ from .utils import (
     select_device,
     get_latest_modified_file,
     del_all,
+    plan_batches,
+    PaddingStats,
 )
 from .utils import logger as utils_logger
 
@@ -45,6 +52,23 @@ class Chat:
             self.sha256_map: Dict[str, str] = load(f)
 
         self.context = GPT.Context()
+        # indices (after splitting) of the sentences of the last non-streaming
+        # infer() whose codes stopped before EOS, at max_new_token or on interrupt()
+        self.unfinished: Set[int] = set()
+
+        # called as observer(name, value) with per-stage timings ("<stage>_seconds")
+        # and values such as "gpt_tokens", "batch_size" and "<stage>_padding_ratio"
+        self.observer: Optional[Callable[[str, float], None]] = None
+
+        # real vs padded tokens of the prompts, generated codes and decoder inputs
+        self.padding_stats = PaddingStats()
+        # generated audio tokens per text token, used to predict sentence lengths
+        # when planning batches; follows the observed ratio
+        self.audio_tokens_per_text_token = 5.0
+
+        # decoder + vocos worker (and its CUDA stream) when loaded with overlap_decode
+        self._decode_executor: Optional[ThreadPoolExecutor] = None
+        self._decode_stream: Optional[torch.cuda.Stream] = None
 
     def has_loaded(self, use_decoder=False):
         not_finish = False
@@ -144,6 +168,9 @@ class Chat:
         use_flash_attn=False,
         use_vllm=False,
         experimental: bool = False,
+        use_static_cache=False,
+        continuous_batching=False,
+        overlap_decode=False,
     ) -> bool:
         download_path = self.download_models(source, force_redownload, custom_path)
         if download_path is None:
@@ -155,6 +182,9 @@ class Chat:
             use_flash_attn=use_flash_attn,
             use_vllm=use_vllm,
             experimental=experimental,
+            use_static_cache=use_static_cache,
+            continuous_batching=continuous_batching,
+            overlap_decode=overlap_decode,
             **{
                 k: os.path.join(download_path, v)
                 for k, v in asdict(self.config.path).items()
@@ -163,6 +193,8 @@ class Chat:
 
     def unload(self):
         logger = self.logger
+        if self._decode_executor is not None:
+            self._decode_executor.shutdown()
         self.normalizer.destroy()
         del self.normalizer
         del self.sha256_map
@@ -172,8 +204,8 @@ class Chat:
                 delattr(self, module)
         self.__init__(logger)
 
-    def sample_random_speaker(self) -> str:
-        return self.speaker.sample_random()
+    def sample_random_speaker(self, seed: Optional[int] = None) -> str:
+        return self.speaker.sample_random(seed)
 
     def sample_audio_speaker(self, wav: Union[np.ndarray, torch.Tensor]) -> str:
         return self.speaker.encode_prompt(self.dvae.sample_audio(wav))
@@ -203,6 +235,22 @@ class Chat:
         stream_batch: int = 24
         stream_speed: int = 12000
         pass_first_n_batches: int = 2
+        # a streaming chunk decodes only its new tokens, plus stream_context
+        # earlier ones, and holds back the audio of its last stream_lookahead tokens
+        # until the next chunk decodes them again with some right context
+        stream_context: int = 24
+        stream_lookahead: int = 6
+
+    @dataclass(repr=False, eq=False)
+    class _StreamWindow:
+        """how far a streamed batch has been decoded, see _decode_window"""
+
+        context: int
+        lookahead: int
+        decoded: int = 0  # tokens seen by the last decode
+        emitted: int = 0  # tokens whose audio has been returned
+        # audio of tokens emitted:decoded, to be crossfaded into the next decode
+        pending: Optional[np.ndarray] = None
 
     def infer(
         self,
@@ -218,8 +266,10 @@ class Chat:
         max_split_batch=4,
         params_refine_text=RefineTextParams(),
         params_infer_code=InferCodeParams(),
+        max_batch_tokens: Optional[int] = None,
     ):
         self.context.set(False)
+        self.unfinished = set()
 
         if split_text and isinstance(text, str):
             if "\n" in text:
@@ -253,6 +303,7 @@ class Chat:
             max_split_batch,
             params_refine_text,
             params_infer_code,
+            max_batch_tokens,
         )
         if stream:
             return res_gen
@@ -285,6 +336,9 @@ class Chat:
         use_flash_attn=False,
         use_vllm=False,
         experimental: bool = False,
+        use_static_cache=False,
+        continuous_batching=False,
+        overlap_decode=False,
     ):
         if device is None:
             device = select_device(experimental=experimental)
@@ -292,6 +346,16 @@ class Chat:
         self.device = device
         self.device_gpt = device if "mps" not in str(device) else torch.device("cpu")
         self.compile = compile
+        # schedule the sentences of a non-streaming infer() with GPT.generate_continuous
+        self.continuous_batching = continuous_batching
+        # decode each chunk on a worker thread (and CUDA stream) while the GPT
+        # generates the next one
+        if overlap_decode and self._decode_executor is None:
+            self._decode_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="chattts-decode"
+            )
+            if "cuda" in str(device):
+                self._decode_stream = torch.cuda.Stream(device)
 
         feature_extractor = instantiate_class(
             args=(), init=asdict(self.config.vocos.feature_extractor)
@@ -337,7 +401,11 @@ class Chat:
             self.config.embed.num_text_tokens,
             self.config.embed.num_vq,
         )
-        embed.load_pretrained(embed_path, device=device)
+        embed.load_pretrained(
+            embed_path,
+            device=device,
+            folded_path=os.path.splitext(embed_path)[0] + ".folded.safetensors",
+        )
         self.embed = embed.to(device)
         self.logger.log(logging.INFO, "embed loaded.")
 
@@ -346,6 +414,7 @@ class Chat:
             embed=self.embed,
             use_flash_attn=use_flash_attn,
             use_vllm=use_vllm,
+            use_static_cache=use_static_cache,
             device=device,
             device_gpt=self.device_gpt,
             logger=self.logger,
@@ -395,6 +464,7 @@ class Chat:
         max_split_batch=4,
         params_refine_text=RefineTextParams(),
         params_infer_code=InferCodeParams(),
+        max_batch_tokens: Optional[int] = None,
     ):
 
         assert self.has_loaded(use_decoder=use_decoder)
@@ -402,27 +472,30 @@ class Chat:
         if not isinstance(text, list):
             text = [text]
 
-        text = [
-            self.normalizer(
-                t,
-                do_text_normalization,
-                do_homophone_replacement,
-                lang,
-            )
-            for t in text
-        ]
+        with self._observe("normalize"):
+            text = [
+                self.normalizer(
+                    t,
+                    do_text_normalization,
+                    do_homophone_replacement,
+                    lang,
+                )
+                for t in text
+            ]
 
         self.logger.debug("normed texts %s", str(text))
 
         if not skip_refine_text:
-            refined = self._refine_text(
-                text,
-                self.device,
-                params_refine_text,
-            )
+            with self._observe("refine"):
+                refined = self._refine_text(
+                    text,
+                    self.device,
+                    params_refine_text,
+                )
             text_tokens = refined.ids
             text_tokens = [i[i.less(self.tokenizer.break_0_ids)] for i in text_tokens]
             text = self.tokenizer.decode(text_tokens)
+            self._observe_value("empty_retries", refined.empty_retries)
             refined.destroy()
             if refine_text_only:
                 if split_text and isinstance(text, list):
@@ -432,15 +505,16 @@ class Chat:
 
         if split_text and len(text) > 1 and params_infer_code.spk_smp is None:
             refer_text = text[0]
-            result = next(
-                self._infer_code(
-                    refer_text,
-                    False,
-                    self.device,
-                    use_decoder,
-                    params_infer_code,
+            with self._observe("gpt"):
+                result = next(
+                    self._infer_code(
+                        refer_text,
+                        False,
+                        self.device,
+                        use_decoder,
+                        params_infer_code,
+                    )
                 )
-            )
             wavs = self._decode_to_wavs(
                 result.hiddens if use_decoder else result.ids,
                 use_decoder,
@@ -450,9 +524,31 @@ class Chat:
             params_infer_code.spk_smp = self.sample_audio_speaker(wavs[0])
             params_infer_code.txt_smp = refer_text
 
-        if stream:
-            length = 0
-            pass_batch_count = 0
+        if not stream:
+            # without streaming, sentences of similar length are batched together
+            # and the results are put back into input order
+            max_batch_size = max_split_batch if split_text else len(text)
+            costs = self._predict_lengths(text)
+            if (
+                self.continuous_batching
+                and len(text) > 1
+                and not self.gpt.is_vllm
+                and not self.gpt.is_te_llama
+            ):
+                batches = self._infer_continuous(
+                    text, use_decoder, max_batch_size, costs, params_infer_code
+                )
+            else:
+                batches = self._infer_batches(
+                    text,
+                    use_decoder,
+                    plan_batches(costs, max_batch_size, max_batch_tokens),
+                    params_infer_code,
+                )
+            yield from self._in_order(batches)
+            return
+
+        pass_batch_count = 0
         if split_text:
             n = len(text) // max_split_batch
             if len(text) % max_split_batch:
@@ -470,35 +566,173 @@ class Chat:
                     i * max_split_batch,
                     i * max_split_batch + len(text_remain),
                 )
-            for result in self._infer_code(
-                text_remain,
-                stream,
-                self.device,
-                use_decoder,
-                params_infer_code,
-            ):
-                wavs = self._decode_to_wavs(
-                    result.hiddens if use_decoder else result.ids,
-                    use_decoder,
-                )
-                result.destroy()
-                if stream:
-                    pass_batch_count += 1
-                    if pass_batch_count <= params_infer_code.pass_first_n_batches:
-                        continue
-                    a = length
-                    b = a + params_infer_code.stream_speed
-                    if b > wavs.shape[1]:
-                        b = wavs.shape[1]
-                    new_wavs = wavs[:, a:b]
-                    length = b
-                    yield new_wavs
-                else:
-                    yield wavs
-            if stream:
-                new_wavs = wavs[:, length:]
-                keep_cols = np.sum(np.abs(new_wavs) > 1e-5, axis=0) > 0
-                yield new_wavs[:][:, keep_cols]
+            self._observe_value("batch_size", len(text_remain))
+            gpt_seconds = 0.0
+            tokens = 0
+            empty_retries = 0
+            window = self._StreamWindow(
+                params_infer_code.stream_context, params_infer_code.stream_lookahead
+            )
+
+            def generate_chunks():
+                nonlocal gpt_seconds, tokens, empty_retries
+                for result, seconds in self._timed(
+                    self._infer_code(
+                        text_remain,
+                        stream,
+                        self.device,
+                        use_decoder,
+                        params_infer_code,
+                    )
+                ):
+                    gpt_seconds += seconds
+                    if self.observer is not None:
+                        tokens = sum(i.size(0) for i in result.ids)
+                    empty_retries = result.empty_retries
+                    yield None, self._decode_later(result, use_decoder, window)
+
+            # decoded audio not yielded yet, at most stream_speed samples go per chunk
+            wavs = np.zeros((len(text_remain), 0), dtype=np.float32)
+            for _, new_wavs in self._decoded(generate_chunks()):
+                wavs = np.concatenate((wavs, new_wavs), 1)
+                pass_batch_count += 1
+                if pass_batch_count <= params_infer_code.pass_first_n_batches:
+                    continue
+                yield wavs[:, : params_infer_code.stream_speed]
+                wavs = wavs[:, params_infer_code.stream_speed :]
+            self._observe_value("gpt_seconds", gpt_seconds)
+            self._observe_value("gpt_tokens", tokens)
+            self._observe_value("empty_retries", empty_retries)
+            if gpt_seconds > 0:
+                self._observe_value("gpt_tokens_per_second", tokens / gpt_seconds)
+            new_wavs = wavs
+            if window.pending is not None:
+                new_wavs = np.concatenate((wavs, window.pending), 1)
+            keep_cols = np.sum(np.abs(new_wavs) > 1e-5, axis=0) > 0
+            yield new_wavs[:][:, keep_cols]
+
+    @contextmanager
+    def _observe(self, stage: str):
+        if self.observer is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observer(stage + "_seconds", time.perf_counter() - start)
+
+    def _observe_value(self, name: str, value: float):
+        if self.observer is not None:
+            self.observer(name, value)
+
+    @staticmethod
+    def _timed(it: Iterator) -> Iterator[Tuple[object, float]]:
+        # the time spent inside the wrapped generator, excluding the consumer
+        it = iter(it)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            yield item, time.perf_counter() - start
+
+    def _decode_later(
+        self,
+        result: GPT.GenerationOutputs,
+        use_decoder: bool,
+        window: Optional[_StreamWindow] = None,
+    ) -> Future:
+        """
+        decodes result into wavs and destroys it, on the decode worker with
+        overlap_decode, right away otherwise. With a window, only the audio
+        of the tokens added since the last chunk is decoded, see _decode_window
+        """
+        if self._decode_executor is None:
+            future = Future()
+            future.set_result(self._decode_result(result, use_decoder, None, window))
+            return future
+        event = None
+        if self._decode_stream is not None:
+            # the worker's stream waits for the GPT work queued so far
+            event = torch.cuda.current_stream(self.device).record_event()
+        return self._decode_executor.submit(
+            self._decode_result, result, use_decoder, event, window
+        )
+
+    def _decode_result(
+        self,
+        result: GPT.GenerationOutputs,
+        use_decoder: bool,
+        event: Optional[torch.cuda.Event] = None,
+        window: Optional[_StreamWindow] = None,
+    ) -> np.ndarray:
+        results = result.hiddens if use_decoder else result.ids
+        decode = self._decode_to_wavs
+        if window is not None:
+            decode = partial(self._decode_window, window=window)
+        if event is None:
+            wavs = decode(results, use_decoder)
+        else:
+            stream = self._decode_stream
+            stream.wait_event(event)
+            for r in results:
+                # not reused by the GPT's stream before this one is done with them
+                r.record_stream(stream)
+            with torch.cuda.stream(stream):
+                wavs = decode(results, use_decoder)
+        result.destroy()
+        return wavs
+
+    def _decoded(self, chunks: Iterator[Tuple[object, Future]]):
+        """
+        (key, decode future) -> (key, wavs), in order. With overlap_decode the
+        next chunk is generated before waiting for the decoding of the previous one
+        """
+        lag = 0 if self._decode_executor is None else 1
+        pending = deque()
+        for chunk in chunks:
+            pending.append(chunk)
+            if len(pending) > lag:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+    def _decode_window(
+        self,
+        result_list: List[torch.Tensor],
+        use_decoder: bool,
+        window: _StreamWindow,
+    ) -> np.ndarray:
+        """
+        decodes the tokens of a streaming chunk that are new since the previous
+        chunk, with window.context tokens of left context, and returns the audio
+        up to window.lookahead tokens from the end. The held back audio stays in
+        window.pending and is crossfaded into the next decode of the same span
+        """
+        end = max(r.size(0) for r in result_list)
+        if end <= window.decoded:
+            return np.zeros((len(result_list), 0), dtype=np.float32)
+        start = max(0, window.emitted - window.context)
+        wavs = self._decode_to_wavs([r[start:] for r in result_list], use_decoder)
+        # the DVAE doubles the frame rate, each mel frame is a vocos hop
+        samples = 2 * self.vocos.head.istft.hop_length
+        safe = max(window.emitted, end - window.lookahead)
+        new_wavs = wavs[
+            :, (window.emitted - start) * samples : (safe - start) * samples
+        ]
+        pending = window.pending
+        if pending is not None:
+            n = min(pending.shape[1], new_wavs.shape[1])
+            ramp = (np.arange(n, dtype=np.float32) + 0.5) / n
+            new_wavs[:, :n] = pending[:, :n] * (1 - ramp) + new_wavs[:, :n] * ramp
+        window.pending = wavs[:, (safe - start) * samples :]
+        window.decoded = end
+        window.emitted = safe
+        return new_wavs
 
     @torch.inference_mode()
     def _vocos_decode(self, spec: torch.Tensor) -> np.ndarray:
@@ -529,13 +763,225 @@ class Chat:
             src = result_list[i]
             batch_result[i].narrow(1, 0, src.size(0)).copy_(src.permute(1, 0))
             del src
+        self._observe_padding("decoder", [r.size(0) for r in result_list])
         del_all(result_list)
-        mel_specs = decoder(batch_result)
+        with self._observe("decoder"):
+            mel_specs = decoder(batch_result)
         del batch_result
-        wavs = self._vocos_decode(mel_specs)
+        with self._observe("vocos"):
+            wavs = self._vocos_decode(mel_specs)
         del mel_specs
         return wavs
 
+    def _code_temperature(self, params: InferCodeParams) -> List[float]:
+        if not isinstance(params.temperature, list):
+            return [params.temperature] * self.config.gpt.num_vq
+        return params.temperature
+
+    def _encode_code_prompts(self, text: List[str], params: InferCodeParams):
+        return self.tokenizer.encode(
+            self.speaker.decorate_code_prompts(
+                text,
+                params.prompt,
+                params.txt_smp,
+                params.spk_emb,
+            ),
+            self.config.gpt.num_vq,
+            prompt=(
+                self.speaker.decode_prompt(params.spk_smp)
+                if params.spk_smp is not None
+                else None
+            ),
+            device=self.device_gpt,
+        )
+
+    def _embed_code_prompts(
+        self, input_ids: torch.Tensor, text_mask: torch.Tensor, params: InferCodeParams
+    ) -> torch.Tensor:
+        emb = self.embed(input_ids, text_mask)
+        if params.spk_emb is not None:
+            self.speaker.apply(
+                emb,
+                params.spk_emb,
+                input_ids,
+                self.tokenizer.spk_emb_ids,
+                self.gpt.device_gpt,
+            )
+        return emb
+
+    def _predict_lengths(self, text: List[str]) -> List[int]:
+        """predicted prompt + generated tokens of each sentence"""
+        return [
+            round(n * (1 + self.audio_tokens_per_text_token))
+            for n in self.tokenizer.count_tokens(text)
+        ]
+
+    def _update_length_ratio(self, text: List[str], ids: List[torch.Tensor]):
+        text_tokens = sum(self.tokenizer.count_tokens(text))
+        if text_tokens == 0:
+            return
+        ratio = sum(i.size(0) for i in ids) / text_tokens
+        self.audio_tokens_per_text_token = (
+            0.9 * self.audio_tokens_per_text_token + 0.1 * ratio
+        )
+
+    def _mark_unfinished(
+        self, indices: List[int], lengths: List[int], params: InferCodeParams
+    ):
+        if self.context.get():
+            # interrupted, sentences that already ended are not told apart
+            self.unfinished.update(indices)
+            return
+        self.unfinished.update(
+            i for i, n in zip(indices, lengths) if n >= params.max_new_token
+        )
+
+    def _observe_padding(self, stage: str, lengths: List[int]):
+        ratio = self.padding_stats.add(stage, lengths)
+        self._observe_value(stage + "_padding_ratio", ratio)
+
+    @staticmethod
+    def _in_order(batches: Iterator[Tuple[List[int], List[np.ndarray]]]):
+        """
+        takes (sentence indices, wavs) in any order and yields lists of wavs in input
+        order, each time the next sentences in line are done
+        """
+        wavs: Dict[int, np.ndarray] = {}
+        done = 0
+        for indices, batch_wavs in batches:
+            wavs.update(zip(indices, batch_wavs))
+            ready = []
+            while done in wavs:
+                ready.append(wavs.pop(done))
+                done += 1
+            if ready:
+                yield ready
+
+    def _infer_batches(
+        self,
+        text: List[str],
+        use_decoder: bool,
+        batches: List[List[int]],
+        params: InferCodeParams,
+    ):
+        """runs the planned batches of sentence indices, yields (indices, wavs)"""
+        return self._decoded(self._generate_batches(text, use_decoder, batches, params))
+
+    def _generate_batches(
+        self,
+        text: List[str],
+        use_decoder: bool,
+        batches: List[List[int]],
+        params: InferCodeParams,
+    ):
+        for batch in batches:
+            batch_text = [text[i] for i in batch]
+            self.logger.info("infer batch of %d sentences: %s", len(batch), batch)
+            self._observe_value("batch_size", len(batch))
+            result, gpt_seconds = next(
+                self._timed(
+                    self._infer_code(
+                        batch_text,
+                        False,
+                        self.device,
+                        use_decoder,
+                        params,
+                    )
+                )
+            )
+            lengths = [i.size(0) for i in result.ids]
+            tokens = sum(lengths)
+            self._observe_value("gpt_seconds", gpt_seconds)
+            self._observe_value("gpt_tokens", tokens)
+            self._observe_value("empty_retries", result.empty_retries)
+            if gpt_seconds > 0:
+                self._observe_value("gpt_tokens_per_second", tokens / gpt_seconds)
+            self._observe_padding("gpt", lengths)
+            self._update_length_ratio(batch_text, result.ids)
+            self._mark_unfinished(batch, lengths, params)
+            yield batch, self._decode_later(result, use_decoder)
+
+    def _infer_continuous(
+        self,
+        text: List[str],
+        use_decoder: bool,
+        max_batch_size: int,
+        costs: List[int],
+        params: InferCodeParams,
+    ):
+        """
+        all sentences go through one continuous batch of at most max_batch_size rows,
+        longest predicted first so that the short ones fill the rows freed at the end.
+        The codes are then decoded in that order max_batch_size sentences at a time,
+        yields (indices, wavs)
+        """
+        order = sorted(range(len(text)), key=lambda i: costs[i], reverse=True)
+        self._observe_value("batch_size", min(max_batch_size, len(text)))
+        start = time.perf_counter()
+        result = self._infer_code_continuous(
+            [text[i] for i in order], self.device, use_decoder, params, max_batch_size
+        )
+        gpt_seconds = time.perf_counter() - start
+        tokens = sum(i.size(0) for i in result.ids)
+        self._observe_value("gpt_seconds", gpt_seconds)
+        self._observe_value("gpt_tokens", tokens)
+        self._observe_value("empty_retries", result.empty_retries)
+        if gpt_seconds > 0:
+            self._observe_value("gpt_tokens_per_second", tokens / gpt_seconds)
+        self._update_length_ratio([text[i] for i in order], result.ids)
+        self._mark_unfinished(order, [i.size(0) for i in result.ids], params)
+        results = result.hiddens if use_decoder else result.ids
+        for i in range(0, len(results), max_batch_size):
+            yield order[i : i + max_batch_size], self._decode_to_wavs(
+                results[i : i + max_batch_size], use_decoder
+            )
+        result.destroy()
+
+    @torch.no_grad()
+    def _infer_code_continuous(
+        self,
+        text: List[str],
+        device: torch.device,
+        return_hidden: bool,
+        params: InferCodeParams,
+        max_batch_size: int,
+    ) -> GPT.GenerationOutputs:
+        input_ids, attention_mask, text_mask = self._encode_code_prompts(text, params)
+        emb = self._embed_code_prompts(input_ids, text_mask, params)
+        del text_mask
+
+        num_code = self.config.gpt.num_audio_tokens - 1
+
+        def new_logits_processors():
+            # the repetition penalty keeps counts of the rows it has seen
+            logits_warpers, logits_processors = gen_logits(
+                num_code=num_code,
+                top_P=params.top_P,
+                top_K=params.top_K,
+                repetition_penalty=params.repetition_penalty,
+            )
+            return (*logits_processors, *logits_warpers)
+
+        # every sentence is prefilled on its own length, strip the left padding
+        pads = (attention_mask.size(1) - attention_mask.sum(1)).tolist()
+        result = self.gpt.generate_continuous(
+            [e.narrow(0, p, e.size(0) - p) for e, p in zip(emb, pads)],
+            [i.narrow(0, p, i.size(0) - p) for i, p in zip(input_ids, pads)],
+            temperature=torch.tensor(self._code_temperature(params), device=device),
+            eos_token=num_code,
+            max_batch_size=max_batch_size,
+            max_new_token=params.max_new_token,
+            min_new_token=params.min_new_token,
+            logits_processors_factory=new_logits_processors,
+            return_hidden=return_hidden,
+            show_tqdm=params.show_tqdm,
+            ensure_non_empty=params.ensure_non_empty,
+            manual_seed=params.manual_seed,
+            context=self.context,
+        )
+        del emb, input_ids, attention_mask
+        return result
+
     @torch.no_grad()
     def _infer_code(
         self,
@@ -553,27 +999,11 @@ class Chat:
 
         assert len(text), "text should not be empty"
 
-        if not isinstance(params.temperature, list):
-            temperature = [params.temperature] * self.config.gpt.num_vq
-        else:
-            temperature = params.temperature
+        temperature = self._code_temperature(params)
 
-        input_ids, attention_mask, text_mask = self.tokenizer.encode(
-            self.speaker.decorate_code_prompts(
-                text,
-                params.prompt,
-                params.txt_smp,
-                params.spk_emb,
-            ),
-            self.config.gpt.num_vq,
-            prompt=(
-                self.speaker.decode_prompt(params.spk_smp)
-                if params.spk_smp is not None
-                else None
-            ),
-            device=self.device_gpt,
-        )
+        input_ids, attention_mask, text_mask = self._encode_code_prompts(text, params)
         start_idx = input_ids.shape[-2]
+        self._observe_padding("prompt", attention_mask.sum(1).tolist())
 
         num_code = self.config.gpt.num_audio_tokens - 1
 
@@ -623,19 +1053,10 @@ class Chat:
                 ),
             ]
 
-        emb = self.embed(input_ids, text_mask)
+        emb = self._embed_code_prompts(input_ids, text_mask, params)
 
         del text_mask
 
-        if params.spk_emb is not None:
-            self.speaker.apply(
-                emb,
-                params.spk_emb,
-                input_ids,
-                self.tokenizer.spk_emb_ids,
-                self.gpt.device_gpt,
-            )
-
         result = gpt.generate(
             emb,
             input_ids,
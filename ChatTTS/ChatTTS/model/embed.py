@@ -1,8 +1,15 @@
+import os
+from typing import Optional
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.utils.parametrize as P
 from torch.nn.utils.parametrizations import weight_norm
+from safetensors.torch import save_file
+from safetensors import safe_open
 
-from ..utils import load_safetensors
+from ..utils import load_safetensors, logger
 
 
 class Embed(nn.Module):
@@ -34,12 +41,132 @@ class Embed(nn.Module):
             ],
         )
 
+        self.fuse()
+
     @torch.inference_mode()
-    def load_pretrained(self, filename: str, device: torch.device):
-        state_dict_tensors = load_safetensors(filename)
-        self.load_state_dict(state_dict_tensors)
+    def load_pretrained(
+        self,
+        filename: str,
+        device: torch.device,
+        folded_path: Optional[str] = None,
+    ):
+        """
+        With folded_path, the heads are loaded as plain nn.Linear modules with
+        weight_norm folded in (inference only). The folded weights are saved there
+        on the first load and read instead of filename while filename is unchanged.
+        """
+        source = self._source_metadata(filename)
+        if folded_path is not None and self._folded_metadata(folded_path) == source:
+            self.fold_weight_norm(materialize=False)
+            self.load_state_dict(load_safetensors(folded_path))
+        else:
+            self.load_state_dict(load_safetensors(filename))
+            if folded_path is not None:
+                self.fold_weight_norm()
+                self._save_folded(folded_path, source)
+        self.fuse()
         self.to(device)
 
+    @staticmethod
+    def _source_metadata(filename: str):
+        stat = os.stat(filename)
+        return {"source_size": str(stat.st_size), "source_mtime": str(stat.st_mtime_ns)}
+
+    @staticmethod
+    def _folded_metadata(folded_path: str):
+        if not os.path.isfile(folded_path):
+            return None
+        try:
+            with safe_open(folded_path, framework="pt") as f:
+                return f.metadata()
+        except Exception as e:
+            logger.get_logger().warning(f"ignore invalid {folded_path}: {e}")
+            return None
+
+    def _save_folded(self, folded_path: str, metadata: dict):
+        tmp = f"{folded_path}.{os.getpid()}.tmp"
+        try:
+            save_file(
+                {k: v.contiguous() for k, v in self.state_dict().items()},
+                tmp,
+                metadata=metadata,
+            )
+            os.replace(tmp, folded_path)
+        except OSError as e:
+            logger.get_logger().warning(f"cannot save folded embed weights: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @torch.no_grad()
+    def fold_weight_norm(self, materialize=True):
+        """
+        Replaces the weight_norm parametrizations of head_text and head_code by
+        plain weights g * v / ||v||, so they are not recomputed on every call.
+        Without materialize, the heads are left uninitialized for load_state_dict.
+        """
+        if materialize:
+            for head in (self.head_text, *self.head_code):
+                if P.is_parametrized(head, "weight"):
+                    P.remove_parametrizations(head, "weight")
+            return
+        self.head_text = nn.utils.skip_init(
+            nn.Linear, self.model_dim, self.head_text.out_features, bias=False
+        )
+        self.head_code = nn.ModuleList(
+            [
+                nn.utils.skip_init(
+                    nn.Linear, self.model_dim, self.num_audio_tokens, bias=False
+                )
+                for _ in range(self.num_vq)
+            ],
+        )
+
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Stacks the weights of all codebooks, with weight_norm folded into the heads,
+        so that code_logits and code_embedding take a single matmul / embedding_bag
+        instead of one call per codebook.
+        The stacked copies are not saved in the state dict and must be rebuilt
+        whenever the weights of emb_code or head_code change.
+        """
+        self.register_buffer(
+            "head_code_weight",
+            torch.cat([head.weight for head in self.head_code]),
+            persistent=False,
+        )
+        self.register_buffer(
+            "emb_code_weight",
+            torch.cat([emb.weight for emb in self.emb_code]),
+            persistent=False,
+        )
+        self.register_buffer(
+            "emb_code_offsets",
+            torch.arange(self.num_vq) * self.num_audio_tokens,
+            persistent=False,
+        )
+
+    def code_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        (..., hidden) -> (..., num_audio_tokens, num_vq), same as stacking
+        head_code[i](hidden_states) on the last dim
+        """
+        logits = F.linear(hidden_states, self.head_code_weight)
+        return logits.unflatten(-1, (self.num_vq, self.num_audio_tokens)).transpose(
+            -1, -2
+        )
+
+    def code_embedding(self, input_ids: torch.Tensor) -> torch.Tensor:
+        """
+        (..., num_vq) -> (..., hidden), same as summing emb_code[i](input_ids[..., i])
+        """
+        emb = F.embedding_bag(
+            (input_ids + self.emb_code_offsets).view(-1, self.num_vq),
+            self.emb_code_weight,
+            mode="sum",
+        )
+        return emb.view(*input_ids.shape[:-1], emb.size(-1))
+
     def __call__(
         self, input_ids: torch.Tensor, text_mask: torch.Tensor
     ) -> torch.Tensor:
@@ -61,10 +188,7 @@ class Embed(nn.Module):
         text_mask_inv = text_mask.logical_not().to(device)
         masked_input_ids: torch.Tensor = input_ids[text_mask_inv].to(device)
 
-        emb_code = [
-            self.emb_code[i](masked_input_ids[:, i]) for i in range(self.num_vq)
-        ]
-        emb_code = torch.stack(emb_code, 2).sum(2)
+        emb_code = self.code_embedding(masked_input_ids)
 
         emb = torch.zeros(
             (input_ids.shape[:-1]) + (emb_text.shape[-1],),
@@ -1,8 +1,9 @@
 import platform
 from dataclasses import dataclass
 import logging
-from typing import Union, List, Optional, Tuple, Callable
+from typing import Union, List, Optional, Tuple, Callable, Sequence
 import gc
+from collections import deque
 
 import torch
 import torch.nn as nn
@@ -10,12 +11,13 @@ import torch.nn.functional as F
 import torch.nn.utils.parametrize as P
 from tqdm import tqdm
 from transformers import LlamaModel, LlamaConfig
-from transformers.cache_utils import Cache
+from transformers.cache_utils import Cache, DynamicCache, StaticCache
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.utils import is_flash_attn_2_available
 
 from ..utils import del_all
 from .embed import Embed
+from .processors import TopKTopPSampler, split_sampler
 
 
 class GPT(nn.Module):
@@ -25,6 +27,7 @@ class GPT(nn.Module):
         embed: Embed,
         use_flash_attn=False,
         use_vllm=False,
+        use_static_cache=False,
         device=torch.device("cpu"),
         device_gpt=torch.device("cpu"),
         logger=logging.getLogger(__name__),
@@ -43,6 +46,7 @@ class GPT(nn.Module):
         self.num_text_tokens = int(gpt_config["num_text_tokens"])
 
         self.use_flash_attn = use_flash_attn
+        self.use_static_cache = use_static_cache
         self.is_te_llama = False
         self.is_vllm = use_vllm
 
@@ -51,10 +55,10 @@ class GPT(nn.Module):
 
         self.llama_config = self._build_llama_config(gpt_config)
 
-        self.emb_code = [ec.__call__ for ec in embed.emb_code]
+        self.code_embedding = embed.code_embedding
         self.emb_text = embed.emb_text.__call__
         self.head_text = embed.head_text.__call__
-        self.head_code = [hc.__call__ for hc in embed.head_code]
+        self.code_logits = embed.code_logits
 
     def load_pretrained(
         self, gpt_folder: str, embed_file_path: str, experimental=False
@@ -156,7 +160,8 @@ class GPT(nn.Module):
             if self.inputs_embeds is not None:
                 self.inputs_embeds = self.inputs_embeds.to(device, dtype=dtype)
             if self.cache_position is not None:
-                self.cache_position = self.cache_position.to(device, dtype=dtype)
+                # indices into the KV cache, keep them integral
+                self.cache_position = self.cache_position.to(device)
 
     @torch.no_grad()
     def _prepare_generation_inputs(
@@ -278,6 +283,8 @@ class GPT(nn.Module):
         ids: List[torch.Tensor]
         attentions: List[Optional[Tuple[torch.FloatTensor, ...]]]
         hiddens: List[torch.Tensor]
+        # rows whose first token was EOS and had to be resampled (see ensure_non_empty)
+        empty_retries: int = 0
 
         def destroy(self):
             del_all(self.ids)
@@ -293,6 +300,7 @@ class GPT(nn.Module):
         attentions: List[Optional[Tuple[torch.FloatTensor, ...]]],
         hiddens: List[torch.Tensor],
         infer_text: bool,
+        empty_retries: int = 0,
     ) -> GenerationOutputs:
         inputs_ids = [
             inputs_ids[idx].narrow(0, start_idx, i) for idx, i in enumerate(end_idx)
@@ -310,8 +318,135 @@ class GPT(nn.Module):
             ids=inputs_ids,
             attentions=attentions,
             hiddens=hiddens,
+            empty_retries=empty_retries,
         )
 
+    def _embed_tokens(self, input_ids: torch.Tensor, infer_text: bool) -> torch.Tensor:
+        """(batch, length, num_vq) token ids -> (batch, length, hidden) embeddings"""
+        input_ids = input_ids.to(self.device_gpt)
+        if infer_text:
+            return self.emb_text(input_ids[:, :, 0])
+        return self.code_embedding(input_ids)
+
+    def _head_logits(
+        self, hidden_states: torch.Tensor, infer_text: bool
+    ) -> torch.Tensor:
+        """
+        (batch, length, hidden) -> (batch, length, num_text_tokens) for text,
+        (batch, length, num_audio_tokens, num_vq) for codes
+        """
+        if infer_text:
+            with P.cached():
+                return self.head_text(hidden_states)
+        return self.code_logits(hidden_states).float()
+
+    def _logits_token(self, generated: torch.Tensor, infer_text: bool) -> torch.Tensor:
+        """
+        generated (batch, length, num_vq) -> the token history the logits processors expect:
+        (batch * num_vq, length) for codes, (batch, length, 1) for text
+        """
+        if infer_text:
+            return generated.narrow(2, 0, 1).to(self.device)
+        # logits_token = rearrange(generated, "b c n -> (b n) c")
+        generated = generated.permute(0, 2, 1)
+        return generated.reshape(generated.size(0) * generated.size(1), -1).to(
+            self.device
+        )
+
+    @staticmethod
+    def _process_logits(
+        logits: torch.Tensor,
+        logits_token: torch.Tensor,
+        temperature: torch.Tensor,
+        logits_processors: Tuple[
+            Callable[[torch.LongTensor, torch.FloatTensor], torch.FloatTensor]
+        ],
+        eos_token: Union[int, torch.Tensor],
+        suppress_eos: bool,
+    ) -> torch.Tensor:
+        # with a TopKTopPSampler temperature is None, the sampler applies it
+        if temperature is not None:
+            logits /= temperature
+
+        for logitsProcessors in logits_processors:
+            logits = logitsProcessors(logits_token, logits)
+
+        if suppress_eos:
+            logits[:, eos_token] = -torch.inf
+
+        return logits
+
+    def _sample(
+        self,
+        logits: torch.Tensor,
+        manual_seed: Optional[int] = None,
+        sampler: Optional[TopKTopPSampler] = None,
+        temperature: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        return self._draw(
+            logits,
+            None if manual_seed is None else self.generator.manual_seed(manual_seed),
+            sampler,
+            temperature,
+        )
+
+    @staticmethod
+    def _draw(
+        logits: torch.Tensor,
+        generator: Optional[torch.Generator],
+        sampler: Optional[TopKTopPSampler],
+        temperature: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        if sampler is not None:
+            return sampler.sample(logits, temperature, generator)[0]
+        scores = F.softmax(logits, dim=-1)
+        return torch.multinomial(scores, num_samples=1, generator=generator)
+
+    def _resample_empty(
+        self,
+        logits: torch.Tensor,
+        idx_next: torch.Tensor,
+        first: torch.Tensor,
+        eos_token: Union[int, torch.Tensor],
+        manual_seed: Optional[int],
+        max_retries: int,
+        sampler: Optional[TopKTopPSampler] = None,
+        temperature: Optional[torch.Tensor] = None,
+    ) -> int:
+        """
+        idx_next (batch * width, 1) was sampled from logits (batch * width, vocab),
+        by sampler with temperature (batch * width, 1) if given.
+        Resamples, in place, the rows at their first token (first, (batch,)) that
+        ended at once, from the same logits instead of running the prompt again.
+        After max_retries attempts EOS is excluded. Returns the resampled rows.
+        """
+        width = idx_next.size(0) // first.size(0)
+        columns = torch.arange(width, device=idx_next.device)
+        generator = None if manual_seed is None else self.generator
+        retries = 0
+        for attempt in range(max_retries + 1):
+            empty = idx_next.view(-1, width).eq(eos_token).any(1).logical_and_(first)
+            rows = empty.nonzero().squeeze_(1)
+            if rows.numel() == 0:
+                break
+            retries += rows.numel()
+            index = (rows.unsqueeze(1) * width + columns).view(-1)
+            sub_logits = logits.index_select(0, index.to(logits.device))
+            if attempt == max_retries:
+                sub_logits[:, eos_token] = -torch.inf
+            resampled = self._draw(
+                sub_logits,
+                generator,
+                sampler,
+                (
+                    None
+                    if sampler is None
+                    else temperature.index_select(0, index.to(temperature.device))
+                ),
+            )
+            idx_next.index_copy_(0, index, resampled.to(idx_next.device))
+        return retries
+
     @torch.no_grad()
     def generate(
         self,
@@ -334,18 +469,20 @@ class GPT(nn.Module):
         stream_batch=24,
         manual_seed: Optional[int] = None,
         context=Context(),
+        max_empty_retries=8,
     ):
 
         attentions: List[Optional[Tuple[torch.FloatTensor, ...]]] = []
         hiddens = []
         stream_iter = 0
+        empty_retries = 0
 
         start_idx, end_idx = inputs_ids.shape[1], torch.zeros(
             inputs_ids.shape[0], device=inputs_ids.device, dtype=torch.long
         )
         finish = torch.zeros(inputs_ids.shape[0], device=inputs_ids.device).bool()
 
-        old_temperature = temperature
+        logits_processors, sampler = split_sampler(logits_processors)
 
         temperature = (
             temperature.unsqueeze(0)
@@ -390,28 +527,43 @@ class GPT(nn.Module):
             )
 
         past_key_values = None
+        positions: Optional[torch.Tensor] = None
+
+        if self.use_static_cache and not self.is_te_llama:
+            # K/V of every layer for prompt + max_new_token positions, allocated once
+            # and written in place at cache_position instead of growing by torch.cat
+            past_key_values = StaticCache(
+                config=self.llama_config,
+                max_batch_size=inputs_ids_buf.size(0),
+                max_cache_len=inputs_ids_buf.size(1),
+                device=self.device_gpt,
+                dtype=self.gpt.dtype,
+            )
+            positions = torch.arange(
+                inputs_ids_buf.size(1), dtype=torch.long, device=inputs_ids_buf.device
+            )
 
         for i in range(max_new_token):
 
+            cache_position = None
+            if positions is not None:
+                past_length = 0 if i == 0 else progress - 1
+                cache_position = positions.narrow(
+                    0, past_length, progress - past_length
+                )
+
             model_input = self._prepare_generation_inputs(
                 inputs_ids,
                 past_key_values,
                 attention_mask_cache.narrow(1, 0, inputs_ids.shape[1]),
+                cache_position=cache_position,
                 use_cache=not self.is_te_llama,
             )
 
             if i > 0:
                 del emb
-                inputs_ids_emb = model_input.input_ids.to(self.device_gpt)
-                if infer_text:
-                    emb: torch.Tensor = self.emb_text(inputs_ids_emb[:, :, 0])
-                else:
-                    code_emb = [
-                        self.emb_code[i](inputs_ids_emb[:, :, i])
-                        for i in range(self.num_vq)
-                    ]
-                    emb = torch.stack(code_emb, 3).sum(3)
-                del inputs_ids_emb, model_input.input_ids
+                emb = self._embed_tokens(model_input.input_ids, infer_text)
+                del model_input.input_ids
             model_input.inputs_embeds = emb
 
             model_input.to(self.device_gpt, self.gpt.dtype)
@@ -435,23 +587,7 @@ class GPT(nn.Module):
             if return_hidden:
                 hiddens.append(hidden_states.narrow(1, -1, 1).squeeze_(1))
 
-            with P.cached():
-                if infer_text:
-                    logits: torch.Tensor = self.head_text(hidden_states)
-                else:
-                    # logits = torch.stack([self.head_code[i](hidden_states) for i in range(self.num_vq)], 3)
-                    logits = torch.empty(
-                        hidden_states.size(0),
-                        hidden_states.size(1),
-                        self.num_audio_tokens,
-                        self.num_vq,
-                        dtype=torch.float,
-                        device=self.device,
-                    )
-                    for num_vq_iter in range(self.num_vq):
-                        x: torch.Tensor = self.head_code[num_vq_iter](hidden_states)
-                        logits[..., num_vq_iter] = x
-                        del x
+            logits = self._head_logits(hidden_states, infer_text)
 
             del hidden_states
 
@@ -462,53 +598,44 @@ class GPT(nn.Module):
                 # logits = rearrange(logits, "b c n -> (b n) c")
                 logits = logits.permute(0, 2, 1)
                 logits = logits.reshape(-1, logits.size(2))
-                # logits_token = rearrange(inputs_ids[:, start_idx:], "b c n -> (b n) c")
-                inputs_ids_sliced = inputs_ids.narrow(
-                    1,
-                    start_idx,
-                    inputs_ids.size(1) - start_idx,
-                ).permute(0, 2, 1)
-                logits_token = inputs_ids_sliced.reshape(
-                    inputs_ids_sliced.size(0) * inputs_ids_sliced.size(1),
-                    -1,
-                ).to(self.device)
-                del inputs_ids_sliced
-            else:
-                logits_token = (
-                    inputs_ids.narrow(
-                        1,
-                        start_idx,
-                        inputs_ids.size(1) - start_idx,
-                    )
-                    .narrow(2, 0, 1)
-                    .to(self.device)
-                )
-
-            logits /= temperature
-
-            for logitsProcessors in logits_processors:
-                logits = logitsProcessors(logits_token, logits)
 
+            logits_token = self._logits_token(
+                inputs_ids.narrow(1, start_idx, inputs_ids.size(1) - start_idx),
+                infer_text,
+            )
+            logits = self._process_logits(
+                logits,
+                logits_token,
+                None if sampler else temperature,
+                logits_processors,
+                eos_token,
+                i < min_new_token,
+            )
             del logits_token
 
-            if i < min_new_token:
-                logits[:, eos_token] = -torch.inf
+            idx_next = self._sample(logits, manual_seed, sampler, temperature).to(
+                finish.device
+            )
 
-            scores = F.softmax(logits, dim=-1)
+            if i == 0 and ensure_non_empty:
+                empty_retries = self._resample_empty(
+                    logits,
+                    idx_next,
+                    torch.ones_like(finish),
+                    eos_token,
+                    manual_seed,
+                    max_empty_retries,
+                    sampler,
+                    temperature,
+                )
+                if empty_retries:
+                    self.logger.warning(
+                        "resampled %d unexpected ends at the first token",
+                        empty_retries,
+                    )
 
             del logits
 
-            if manual_seed is None:
-                idx_next = torch.multinomial(scores, num_samples=1).to(finish.device)
-            else:
-                idx_next = torch.multinomial(
-                    scores,
-                    num_samples=1,
-                    generator=self.generator.manual_seed(manual_seed),
-                ).to(finish.device)
-
-            del scores
-
             if not infer_text:
                 # idx_next = rearrange(idx_next, "(b n) 1 -> b n", n=self.num_vq)
                 idx_next = idx_next.view(-1, self.num_vq)
@@ -529,45 +656,6 @@ class GPT(nn.Module):
                     "unexpected end at index %s",
                     str([unexpected_idx.item() for unexpected_idx in finish.nonzero()]),
                 )
-                if ensure_non_empty and manual_seed is None:
-                    if show_tqdm:
-                        pbar.close()
-                    self.logger.warning("regenerate in order to ensure non-empty")
-                    del_all(attentions)
-                    del_all(hiddens)
-                    del (
-                        start_idx,
-                        end_idx,
-                        finish,
-                        temperature,
-                        attention_mask_cache,
-                        past_key_values,
-                        idx_next,
-                        inputs_ids_buf,
-                    )
-                    new_gen = self.generate(
-                        emb,
-                        inputs_ids,
-                        old_temperature,
-                        eos_token,
-                        attention_mask,
-                        max_new_token,
-                        min_new_token,
-                        logits_processors,
-                        infer_text,
-                        return_attn,
-                        return_hidden,
-                        stream,
-                        show_tqdm,
-                        ensure_non_empty,
-                        stream_batch,
-                        manual_seed,
-                        context,
-                    )
-                    for result in new_gen:
-                        yield result
-                    del inputs_ids
-                return
 
             del idx_next
             progress += 1
@@ -586,6 +674,7 @@ class GPT(nn.Module):
                         attentions,
                         hiddens,
                         infer_text,
+                        empty_retries,
                     )
             del not_finished
 
@@ -615,4 +704,445 @@ class GPT(nn.Module):
             attentions,
             hiddens,
             infer_text,
+            empty_retries,
+        )
+
+    @dataclass(repr=False, eq=False)
+    class _Cohort:
+        """sentences admitted in the same step; they share the step count"""
+
+        rows: List[int]
+        # row of each sentence in the KV cache, handed to a queued sentence on eviction
+        slots: List[int]
+        tokens: torch.Tensor
+        # (admitted, max_new_token, hidden), rows stay in place, see buffer_rows
+        hiddens: Optional[torch.Tensor]
+        buffer_rows: List[int]
+        # own processors, the repetition penalty counts follow one history
+        logits_processors: Sequence[
+            Callable[[torch.LongTensor, torch.FloatTensor], torch.FloatTensor]
+        ]
+        step: int = 0
+
+    @staticmethod
+    def _pad_left(x: torch.Tensor, dim: int, length: int) -> torch.Tensor:
+        if x.size(dim) == length:
+            return x
+        shape = list(x.shape)
+        shape[dim] = length - x.size(dim)
+        return torch.cat([x.new_zeros(shape), x], dim)
+
+    @staticmethod
+    def _write_rows(
+        x: torch.Tensor, new: torch.Tensor, slots: List[int]
+    ) -> torch.Tensor:
+        """overwrite the rows slots of x with the first rows of new, append the rest"""
+        n = len(slots)
+        if n:
+            x.index_copy_(
+                0, torch.tensor(slots, dtype=torch.long, device=x.device), new[:n]
+            )
+        if n < new.size(0):
+            x = torch.cat([x, new[n:]])
+        return x
+
+    def _prefill(
+        self, emb: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, DynamicCache, torch.Tensor]:
+        """
+        run the prompts of newly admitted sentences, left padded to the longest,
+        returns the last hidden state of each row, their cache and attention mask
+        """
+        length = max(e.size(0) for e in emb)
+        inputs_embeds = torch.stack([self._pad_left(e, 0, length) for e in emb])
+        attention_mask = torch.stack(
+            [
+                self._pad_left(
+                    torch.ones(e.size(0), dtype=torch.bool, device=e.device), 0, length
+                )
+                for e in emb
+            ]
+        )
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask.eq(0), 1)
+        cache = DynamicCache()
+        outputs: BaseModelOutputWithPast = self.gpt(
+            attention_mask=attention_mask.to(self.device_gpt, dtype=self.gpt.dtype),
+            position_ids=position_ids.to(self.device_gpt),
+            past_key_values=cache,
+            inputs_embeds=inputs_embeds.to(self.device_gpt, dtype=self.gpt.dtype),
+            use_cache=True,
+        )
+        hidden = outputs.last_hidden_state.narrow(1, -1, 1).to(
+            self.device, dtype=torch.float
+        )
+        del outputs
+        return hidden, cache, attention_mask
+
+    @torch.no_grad()
+    def generate_continuous(
+        self,
+        emb: List[torch.Tensor],
+        inputs_ids: List[torch.Tensor],
+        temperature: torch.Tensor,
+        eos_token: Union[int, torch.Tensor],
+        max_batch_size: int,
+        max_new_token=2048,
+        min_new_token=0,
+        logits_processors_factory: Callable[
+            [],
+            Sequence[
+                Callable[[torch.LongTensor, torch.FloatTensor], torch.FloatTensor]
+            ],
+        ] = tuple,
+        infer_text=False,
+        return_hidden=False,
+        show_tqdm=True,
+        ensure_non_empty=True,
+        manual_seed: Optional[int] = None,
+        context=Context(),
+        max_empty_retries=8,
+    ) -> GenerationOutputs:
+        """
+        Iteration-level scheduling over a queue of sentences.
+
+        emb[i] (length_i, hidden) and inputs_ids[i] (length_i, num_vq) are the unpadded
+        prompts. At most max_batch_size sentences are decoded together: a row that hits
+        EOS is evicted at once, and queued sentences are prefilled on the next step and
+        take over the KV cache rows of the evicted ones instead of waiting for the whole
+        batch to finish. The cache is only compacted (with the leading columns only
+        padding refers to) once the queue is empty and at least half of it is evicted.
+        logits_processors_factory is called once per admission, so that stateful
+        processors see the history of one set of rows.
+        Results are returned in input order, like generate() without streaming.
+        """
+        queue = deque(range(len(emb)))
+        ids: List[torch.Tensor] = [
+            inputs_ids[i].new_empty(0, 1 if infer_text else self.num_vq).squeeze(1)
+            for i in range(len(emb))
+        ]
+        hiddens: List[torch.Tensor] = [
+            torch.empty(0, self.llama_config.hidden_size, device=self.device)
+            for _ in range(len(emb))
+        ]
+        token_dtype = inputs_ids[0].dtype if len(inputs_ids) else torch.long
+        empty_retries = 0
+        _, sampler = split_sampler(logits_processors_factory())
+
+        cohorts: List[GPT._Cohort] = []
+        cache: Optional[DynamicCache] = None
+        attention_mask: Optional[torch.Tensor] = None
+        last_tokens: Optional[torch.Tensor] = None  # (batch, 1, num_vq)
+        free: List[int] = []  # cache rows of evicted sentences
+
+        pbar: Optional[tqdm] = None
+        if show_tqdm:
+            pbar = tqdm(
+                total=len(emb),
+                desc="text" if infer_text else "code",
+                unit="sentence",
+            )
+
+        while queue or cohorts:
+            if context.get():
+                self.logger.warning("generation is interrupted")
+                break
+
+            hidden_parts = []
+            if cohorts:
+                # one decode step for the running rows
+                attention_mask = torch.cat(
+                    [
+                        attention_mask,
+                        attention_mask.new_ones(attention_mask.size(0), 1),
+                    ],
+                    1,
+                )
+                position_ids = attention_mask.long().sum(1, keepdim=True) - 1
+                outputs: BaseModelOutputWithPast = self.gpt(
+                    attention_mask=attention_mask.to(
+                        self.device_gpt, dtype=self.gpt.dtype
+                    ),
+                    position_ids=position_ids.to(self.device_gpt),
+                    past_key_values=cache,
+                    inputs_embeds=self._embed_tokens(last_tokens, infer_text).to(
+                        self.device_gpt, dtype=self.gpt.dtype
+                    ),
+                    use_cache=True,
+                )
+                cache = outputs.past_key_values
+                hidden = outputs.last_hidden_state.to(self.device, dtype=torch.float)
+                del outputs
+                slots = [slot for c in cohorts for slot in c.slots]
+                if slots != list(range(hidden.size(0))):
+                    # rows of evicted sentences are decoded but not sampled
+                    hidden = hidden.index_select(
+                        0, torch.tensor(slots, dtype=torch.long, device=self.device)
+                    )
+                hidden_parts.append(hidden)
+                del hidden
+
+            running = sum(len(c.rows) for c in cohorts)
+            if queue and running < max_batch_size:
+                rows = [
+                    queue.popleft()
+                    for _ in range(min(max_batch_size - running, len(queue)))
+                ]
+                hidden, new_cache, new_mask = self._prefill([emb[i] for i in rows])
+                hidden_parts.append(hidden)
+                if cache is None:
+                    cache, attention_mask = new_cache, new_mask
+                    slots = list(range(len(rows)))
+                else:
+                    length = max(attention_mask.size(1), new_mask.size(1))
+                    if attention_mask.size(1) < length:
+                        # a prompt longer than the running rows, pad the cache once
+                        attention_mask = self._pad_left(attention_mask, 1, length)
+                        for kv in (cache.key_cache, cache.value_cache):
+                            for layer in range(len(kv)):
+                                kv[layer] = self._pad_left(kv[layer], 2, length)
+                    # reuse the rows of evicted sentences before growing the cache
+                    reused = free[: len(rows)]
+                    del free[: len(rows)]
+                    size = attention_mask.size(0)
+                    slots = reused + list(range(size, size + len(rows) - len(reused)))
+                    attention_mask = self._write_rows(
+                        attention_mask, self._pad_left(new_mask, 1, length), reused
+                    )
+                    for kv, new_kv in (
+                        (cache.key_cache, new_cache.key_cache),
+                        (cache.value_cache, new_cache.value_cache),
+                    ):
+                        for layer in range(len(kv)):
+                            kv[layer] = self._write_rows(
+                                kv[layer],
+                                self._pad_left(new_kv[layer], 2, length),
+                                reused,
+                            )
+                del new_cache, new_mask
+                processors, _ = split_sampler(logits_processors_factory())
+                cohorts.append(
+                    self._Cohort(
+                        rows=rows,
+                        slots=slots,
+                        tokens=torch.zeros(
+                            len(rows),
+                            max_new_token,
+                            self.num_vq,
+                            dtype=token_dtype,
+                            device=self.device,
+                        ),
+                        hiddens=(
+                            torch.empty(
+                                len(rows),
+                                max_new_token,
+                                self.llama_config.hidden_size,
+                                device=self.device,
+                            )
+                            if return_hidden
+                            else None
+                        ),
+                        buffer_rows=list(range(len(rows))),
+                        logits_processors=processors,
+                    )
+                )
+
+            hidden_states = torch.cat(hidden_parts)
+            del hidden_parts
+            logits = self._head_logits(hidden_states, infer_text)
+            logits = logits.narrow(1, -1, 1).squeeze_(1).float()
+            if not infer_text:
+                logits = logits.permute(0, 2, 1)
+                logits = logits.reshape(-1, logits.size(2))
+
+            # the logits processors see each cohort's own history
+            width = logits.size(0) // hidden_states.size(0)
+            parts = []
+            row_temperature = (
+                temperature.unsqueeze(0)
+                .expand(hidden_states.size(0), -1)
+                .reshape(-1, 1)
+            )
+            offset = 0
+            for cohort in cohorts:
+                n = len(cohort.rows) * width
+                parts.append(
+                    self._process_logits(
+                        logits.narrow(0, offset, n),
+                        self._logits_token(
+                            cohort.tokens.narrow(1, 0, cohort.step), infer_text
+                        ),
+                        None if sampler else row_temperature.narrow(0, offset, n),
+                        cohort.logits_processors,
+                        eos_token,
+                        cohort.step < min_new_token,
+                    )
+                )
+                offset += n
+            del logits
+            logits = torch.cat(parts)
+            del parts
+            idx_next = self._sample(logits, manual_seed, sampler, row_temperature).to(
+                self.device
+            )
+            if ensure_non_empty:
+                # only the cohort prefilled in this step is at its first token
+                first = torch.zeros(
+                    hidden_states.size(0), dtype=torch.bool, device=self.device
+                )
+                if cohorts[-1].step == 0:
+                    first[-len(cohorts[-1].rows) :] = True
+                retries = self._resample_empty(
+                    logits,
+                    idx_next,
+                    first,
+                    eos_token,
+                    manual_seed,
+                    max_empty_retries,
+                    sampler,
+                    row_temperature,
+                )
+                if retries:
+                    self.logger.warning(
+                        "resampled %d unexpected ends at the first token", retries
+                    )
+                    empty_retries += retries
+            del logits
+            idx_next = idx_next.view(-1, 1 if infer_text else self.num_vq)
+            finish = idx_next.eq(eos_token).any(1)
+            if infer_text:
+                idx_next = idx_next.expand(-1, self.num_vq)
+
+            next_tokens = []
+            offset = 0
+            for cohort in cohorts:
+                n = len(cohort.rows)
+                cohort.tokens.narrow(1, cohort.step, 1).copy_(
+                    idx_next.narrow(0, offset, n).unsqueeze(1)
+                )
+                if cohort.hiddens is not None:
+                    cohort.hiddens.select(1, cohort.step).index_copy_(
+                        0,
+                        torch.tensor(
+                            cohort.buffer_rows, dtype=torch.long, device=self.device
+                        ),
+                        hidden_states.narrow(0, offset, n).squeeze(1),
+                    )
+                cohort.step += 1
+                done = finish.narrow(0, offset, n).tolist()
+                for j, (row, eos) in enumerate(zip(cohort.rows, done)):
+                    if not eos and cohort.step < max_new_token:
+                        continue
+                    length = cohort.step - 1 if eos else cohort.step
+                    if not eos:
+                        self.logger.warning(
+                            f"incomplete result. hit max_new_token: {max_new_token}"
+                        )
+                    ids[row] = self._finished_ids(cohort.tokens[j], length, infer_text)
+                    if cohort.hiddens is not None:
+                        hiddens[row] = (
+                            cohort.hiddens[cohort.buffer_rows[j]]
+                            .narrow(0, 0, length)
+                            .clone()
+                        )
+                    if pbar is not None:
+                        pbar.update(1)
+                alive = [
+                    j
+                    for j, eos in enumerate(done)
+                    if not eos and cohort.step < max_new_token
+                ]
+                if len(alive) < n:
+                    # only the small token buffer is compacted, the hiddens stay
+                    free.extend(cohort.slots[j] for j in range(n) if j not in alive)
+                    cohort.rows = [cohort.rows[j] for j in alive]
+                    cohort.slots = [cohort.slots[j] for j in alive]
+                    cohort.buffer_rows = [cohort.buffer_rows[j] for j in alive]
+                    cohort.tokens = cohort.tokens.index_select(
+                        0, torch.tensor(alive, dtype=torch.long, device=self.device)
+                    )
+                next_tokens.append(
+                    idx_next.narrow(0, offset, n).index_select(
+                        0, torch.tensor(alive, dtype=torch.long, device=self.device)
+                    )
+                )
+                offset += n
+            del idx_next, finish, hidden_states
+
+            cohorts = [c for c in cohorts if c.rows]
+            if not cohorts:
+                cache = attention_mask = last_tokens = None
+                free = []
+                continue
+            next_tokens = torch.cat(next_tokens)
+            slots = [slot for c in cohorts for slot in c.slots]
+            if free and not queue and len(free) >= len(slots):
+                # no sentence left to take the evicted rows, drop them
+                # and the leading columns only padding refers to
+                index = torch.tensor(
+                    slots, dtype=torch.long, device=attention_mask.device
+                )
+                attention_mask = attention_mask.index_select(0, index)
+                start = int(attention_mask.any(0).int().argmax())
+                attention_mask = attention_mask.narrow(
+                    1, start, attention_mask.size(1) - start
+                )
+                index = index.to(self.device_gpt)
+                for layer in range(len(cache.key_cache)):
+                    for kv in (cache.key_cache, cache.value_cache):
+                        kv[layer] = (
+                            kv[layer]
+                            .index_select(0, index)
+                            .narrow(2, start, kv[layer].size(2) - start)
+                        )
+                offset = 0
+                for cohort in cohorts:
+                    cohort.slots = list(range(offset, offset + len(cohort.rows)))
+                    offset += len(cohort.rows)
+                free = []
+                last_tokens = next_tokens.unsqueeze(1)
+            else:
+                # evicted rows decode a dummy token until they are reused
+                last_tokens = next_tokens.new_zeros(
+                    attention_mask.size(0), next_tokens.size(1)
+                )
+                last_tokens.index_copy_(
+                    0,
+                    torch.tensor(slots, dtype=torch.long, device=self.device),
+                    next_tokens,
+                )
+                last_tokens.unsqueeze_(1)
+            del next_tokens
+
+        if context.get():
+            # partial results of the running rows, queued sentences stay empty
+            for cohort in cohorts:
+                for j, row in enumerate(cohort.rows):
+                    ids[row] = self._finished_ids(
+                        cohort.tokens[j], cohort.step, infer_text
+                    )
+                    if cohort.hiddens is not None:
+                        hiddens[row] = (
+                            cohort.hiddens[cohort.buffer_rows[j]]
+                            .narrow(0, 0, cohort.step)
+                            .clone()
+                        )
+
+        if pbar is not None:
+            pbar.close()
+
+        return self.GenerationOutputs(
+            ids=ids,
+            attentions=[],
+            hiddens=hiddens if return_hidden else [],
+            empty_retries=empty_retries,
         )
+
+    @staticmethod
+    def _finished_ids(
+        tokens: torch.Tensor, length: int, infer_text: bool
+    ) -> torch.Tensor:
+        ids = tokens.narrow(0, 0, length).clone()
+        if infer_text:
+            ids = ids.narrow(1, 0, 1).squeeze_(1)
+        return ids
@@ -1,9 +1,18 @@
+from typing import Callable, Optional, Sequence, Tuple
+
 import torch
 import torch.nn.functional as F
-from transformers.generation import TopKLogitsWarper, TopPLogitsWarper
 
 
 class CustomRepetitionPenaltyLogitsProcessorRepeat:
+    """
+    Multiplies negative scores and divides positive ones by penalty ** n, n being
+    the number of times the token occurs in the last past_window input ids.
+
+    The counts are kept between calls: when input_ids is the previous history plus
+    one token, only that token and the one leaving the window are counted, with
+    scatter_add. Any other history is counted again. Scores are changed in place.
+    """
 
     def __init__(self, penalty: float, max_input_ids: int, past_window: int):
         if not isinstance(penalty, float) or not (penalty > 0):
@@ -15,24 +24,157 @@ class CustomRepetitionPenaltyLogitsProcessorRepeat:
         self.max_input_ids = max_input_ids
         self.past_window = past_window
 
+        self.counts: Optional[torch.Tensor] = None  # (batch, vocab)
+        self.window: Optional[torch.Tensor] = None  # (batch, <= past_window)
+
+    def _follows(self, window: torch.Tensor, vocab_size: int) -> bool:
+        """whether window is the previous window plus one token"""
+        prev = self.window
+        if (
+            prev is None
+            or self.counts.shape != (window.size(0), vocab_size)
+            or prev.device != window.device
+        ):
+            return False
+        if prev.size(1) < self.past_window:
+            return window.size(1) == prev.size(1) + 1 and torch.equal(
+                window.narrow(1, 0, prev.size(1)), prev
+            )
+        return window.size(1) == self.past_window and torch.equal(
+            window.narrow(1, 0, self.past_window - 1),
+            prev.narrow(1, 1, self.past_window - 1),
+        )
+
+    def _update_counts(self, input_ids: torch.LongTensor, vocab_size: int):
+        length = min(input_ids.size(1), self.past_window)
+        window = input_ids.narrow(1, input_ids.size(1) - length, length)
+        if self._follows(window, vocab_size):
+            self.counts.scatter_add_(
+                1, window.narrow(1, -1, 1), self.counts.new_ones(window.size(0), 1)
+            )
+            if self.window.size(1) == self.past_window:
+                self.counts.scatter_add_(
+                    1,
+                    self.window.narrow(1, 0, 1),
+                    self.counts.new_full((window.size(0), 1), -1),
+                )
+        else:
+            self.counts = torch.zeros(
+                window.size(0), vocab_size, dtype=torch.long, device=window.device
+            ).scatter_add_(1, window, torch.ones_like(window))
+        self.window = window.clone()
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if input_ids.dim() == 3:
+            # text histories come as (batch, length, 1)
+            input_ids = input_ids.squeeze(2)
+        self._update_counts(input_ids.long(), scores.size(1))
+        # as before, rows past max_input_ids are not penalized
+        rows = min(scores.size(0), self.max_input_ids)
+        if rows == 0 or self.window.size(1) == 0:
+            return scores
+        ids = self.window.narrow(0, 0, rows).to(scores.device)
+        alpha = torch.pow(
+            self.penalty,
+            self.counts.narrow(0, 0, rows).to(scores.device).gather(1, ids),
+        )
+        scores_rows = scores.narrow(0, 0, rows)
+        picked = scores_rows.gather(1, ids)
+        scores_rows.scatter_(
+            1,
+            ids,
+            torch.where(picked < 0, picked.multiply(alpha), picked.divide(alpha)),
+        )
+        return scores
+
+
+class TopKTopPSampler:
+    """
+    Samples among the top_k highest scores, cut to the smallest prefix holding
+    top_p of the probability, after dividing by temperature. Keeps the same tokens
+    as TopPLogitsWarper followed by TopKLogitsWarper, but only the k candidates
+    are sorted and softmaxed: the full vocabulary is only reduced once, for the
+    normalizer top_p needs.
+
+    As the last logits processor, GPT.generate and the velocity Sampler call
+    sample() instead of dividing by temperature themselves. Called like a logits
+    warper, it masks everything but the kept tokens with -inf.
+    """
+
+    def __init__(
+        self,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        min_tokens_to_keep: int = 1,
+    ):
+        if top_k is not None and (not isinstance(top_k, int) or top_k <= 0):
+            raise ValueError(
+                f"`top_k` has to be a strictly positive integer, but is {top_k}"
+            )
+        if top_p is not None and not (0 <= top_p <= 1.0):
+            raise ValueError(f"`top_p` has to be a float >= 0 and <= 1, but is {top_p}")
+
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_tokens_to_keep = min_tokens_to_keep
+
+    def _candidates(
+        self, logits: torch.Tensor, temperature=None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        (rows, vocab) -> scores divided by temperature of the top k tokens, sorted
+        in descending order with -inf past top_p, and their token ids
+        """
+        k = logits.size(-1)
+        if self.top_k is not None:
+            k = min(max(self.top_k, self.min_tokens_to_keep), k)
+        values, indices = torch.topk(logits, k, dim=-1)
+        if temperature is not None:
+            values = values / temperature
+        if self.top_p is not None and self.top_p < 1:
+            log_norm = torch.logsumexp(
+                logits if temperature is None else logits / temperature,
+                dim=-1,
+                keepdim=True,
+            )
+            probs = values.sub(log_norm).exp_()
+            # a token is dropped once the tokens above it hold top_p
+            remove = probs.cumsum(-1).sub_(probs).ge(self.top_p)
+            remove.narrow(-1, 0, min(self.min_tokens_to_keep, k)).fill_(False)
+            values.masked_fill_(remove, -torch.inf)
+        return values, indices
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        temperature=None,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        logits (rows, vocab), temperature a number or (rows, 1)
+        -> sampled ids (rows, 1) and their log probabilities (rows, 1)
+        """
+        values, indices = self._candidates(logits, temperature)
+        probs = F.softmax(values, dim=-1)
+        choice = torch.multinomial(probs, num_samples=1, generator=generator)
+        return indices.gather(-1, choice), probs.gather(-1, choice).log_()
+
     def __call__(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor
     ) -> torch.FloatTensor:
-        if input_ids.size(1) > self.past_window:
-            input_ids = input_ids.narrow(1, -self.past_window, self.past_window)
-        freq = F.one_hot(input_ids, scores.size(1)).sum(1)
-        if freq.size(0) > self.max_input_ids:
-            freq.narrow(
-                0, self.max_input_ids, freq.size(0) - self.max_input_ids
-            ).zero_()
-        alpha = torch.pow(self.penalty, freq)
-        scores = scores.contiguous()
-        inp = scores.multiply(alpha)
-        oth = scores.divide(alpha)
-        con = scores < 0
-        out = torch.where(con, inp, oth)
-        del inp, oth, scores, con, alpha
-        return out
+        values, indices = self._candidates(scores)
+        return torch.full_like(scores, -torch.inf).scatter_(-1, indices, values)
+
+
+def split_sampler(
+    processors: Sequence[Callable],
+) -> Tuple[Sequence[Callable], Optional[TopKTopPSampler]]:
+    """separates a TopKTopPSampler at the end of the logits processors"""
+    if len(processors) and isinstance(processors[-1], TopKTopPSampler):
+        return processors[:-1], processors[-1]
+    return processors, None
 
 
 def gen_logits(
@@ -42,10 +184,8 @@ def gen_logits(
     repetition_penalty=1.0,
 ):
     logits_warpers = []
-    if top_P is not None:
-        logits_warpers.append(TopPLogitsWarper(top_P, min_tokens_to_keep=3))
-    if top_K is not None:
-        logits_warpers.append(TopKLogitsWarper(top_K, min_tokens_to_keep=3))
+    if top_P is not None or top_K is not None:
+        logits_warpers.append(TopKTopPSampler(top_K, top_P, min_tokens_to_keep=3))
 
     logits_processors = []
     if repetition_penalty is not None and repetition_penalty != 1:
@@ -1,11 +1,14 @@
 import lzma
-from typing import List, Optional, Union
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
 
 import pybase16384 as b14
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from ..speaker_sampler import decode_spk_emb, encode_spk_emb
+
 
 class Speaker:
     def __init__(self, dim: int, spk_cfg: str, device=torch.device("cpu")) -> None:
@@ -15,8 +18,13 @@ class Speaker:
         self.std, self.mean = spk_stat.requires_grad_(False).chunk(2)
         self.dim = dim
 
-    def sample_random(self) -> str:
-        return self._encode(self._sample_random())
+    def sample_random(self, seed: Optional[int] = None) -> str:
+        """
+        with a seed, draws from a generator of its own: the same speaker as
+        torch.manual_seed(seed) followed by sample_random(), without touching
+        the global RNG other threads may be using
+        """
+        return self._encode(self._sample_random(seed))
 
     @torch.inference_mode()
     def apply(
@@ -29,20 +37,15 @@ class Speaker:
         inplace: bool = True,
     ) -> torch.Tensor:
         if isinstance(spk_emb, str):
-            spk_emb_tensor = torch.from_numpy(self._decode(spk_emb))
+            # shared across instances, must not be modified inplace
+            spk_emb_tensor = self._decode_normalized(spk_emb)
         else:
-            spk_emb_tensor = spk_emb
+            spk_emb_tensor = self._normalize(spk_emb)
         n = (
-            F.normalize(
-                spk_emb_tensor,
-                p=2.0,
-                dim=0,
-                eps=1e-12,
-            )
-            .to(device)
-            .unsqueeze_(0)
+            spk_emb_tensor.to(device)
+            .unsqueeze(0)
             .expand(emb.size(0), -1)
-            .unsqueeze_(1)
+            .unsqueeze(1)
             .expand(emb.shape)
         )
         cond = input_ids.narrow(-1, 0, 1).eq(spk_emb_ids).expand(emb.shape)
@@ -120,9 +123,17 @@ class Speaker:
         return torch.from_numpy(p.astype(np.int32)).view(*shp)
 
     @torch.no_grad()
-    def _sample_random(self) -> torch.Tensor:
+    def _sample_random(self, seed: Optional[int] = None) -> torch.Tensor:
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(self.std.device).manual_seed(seed)
         spk = (
-            torch.randn(self.dim, device=self.std.device, dtype=self.std.dtype)
+            torch.randn(
+                self.dim,
+                device=self.std.device,
+                dtype=self.std.dtype,
+                generator=generator,
+            )
             .mul_(self.std)
             .add_(self.mean)
         )
@@ -131,24 +142,30 @@ class Speaker:
     @staticmethod
     @torch.no_grad()
     def _encode(spk_emb: torch.Tensor) -> str:
-        arr: np.ndarray = spk_emb.to(dtype=torch.float16, device="cpu").numpy()
-        s = b14.encode_to_string(
-            lzma.compress(
-                arr.tobytes(),
-                format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
-            ),
-        )
-        del arr
-        return s
+        return encode_spk_emb(spk_emb.to(dtype=torch.float16, device="cpu").numpy())
+
+    @staticmethod
+    def cache_info() -> Dict[str, Union[int, float]]:
+        info = Speaker._decode_normalized.cache_info()
+        total = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+            "hit_rate": info.hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    @torch.no_grad()
+    def _decode_normalized(spk_emb: str) -> torch.Tensor:
+        return Speaker._normalize(torch.from_numpy(Speaker._decode(spk_emb)))
+
+    @staticmethod
+    def _normalize(spk_emb: torch.Tensor) -> torch.Tensor:
+        return F.normalize(spk_emb, p=2.0, dim=0, eps=1e-12)
 
     @staticmethod
     def _decode(spk_emb: str) -> np.ndarray:
-        return np.frombuffer(
-            lzma.decompress(
-                b14.decode_from_string(spk_emb),
-                format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
-            ),
-            dtype=np.float16,
-        ).copy()
+        return decode_spk_emb(spk_emb)
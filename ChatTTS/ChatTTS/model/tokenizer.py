@@ -125,6 +125,10 @@ class Tokenizer:
 
         return new_input_ids, attention_mask, text_mask
 
+    def count_tokens(self, text: List[str]) -> List[int]:
+        """token count of each text, without special tokens or padding"""
+        return [len(self._tokenizer.encode(t, add_special_tokens=False)) for t in text]
+
     @torch.inference_mode
     def decode(
         self,
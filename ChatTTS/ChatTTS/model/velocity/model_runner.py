@@ -89,6 +89,8 @@ class ModelRunner:
             for k in f.keys():
                 state_dict_tensors[k] = f.get_tensor(k)
         self.post_model.load_state_dict(state_dict_tensors)
+        self.post_model.fold_weight_norm()
+        self.post_model.fuse()
         self.post_model.to(next(self.model.parameters())).eval()
         self.sampler = Sampler(self.post_model, self.model_config.num_audio_tokens, 4)
 
@@ -521,11 +523,7 @@ class ModelRunner:
                     input_tokens[:, :, 0]
                 )
             else:
-                code_emb = [
-                    self.post_model.emb_code[i](input_tokens[:, :, i])
-                    for i in range(self.post_model.num_vq)
-                ]
-                input_emb = torch.stack(code_emb, 3).sum(3)
+                input_emb = self.post_model.code_embedding(input_tokens)
                 start_idx = (
                     input_tokens_history.shape[-2] - 1
                     if input_tokens_history.shape[-2] > 0
@@ -561,10 +559,6 @@ class ModelRunner:
             eos_token=eos_token,
             start_idx=start_idx,
         )
-        # print(logprob.shape, idx_next.shape)
-        if len(logprob.shape) == 2:
-            logprob = logprob[:, None, :]
-        logprob = torch.gather(logprob, -1, idx_next.transpose(-1, -2))[:, :, 0]
         # print("测试",idx_next.shape, logprob.shape)
         # Sample the next token.
         # output = self.model.sample(
@@ -3,6 +3,7 @@ from torch.functional import F
 from typing import List, Callable
 
 from ..embed import Embed
+from ..processors import split_sampler
 
 
 class Sampler:
@@ -47,19 +48,7 @@ class Sampler:
         if infer_text:
             logits: torch.Tensor = self.post_model.head_text(hidden_states)
         else:
-            # logits = torch.stack([self.head_code[i](hidden_states) for i in range(self.num_vq)], 3)
-            logits = torch.empty(
-                hidden_states.size(0),
-                hidden_states.size(1),
-                self.num_audio_tokens,
-                self.num_vq,
-                dtype=torch.float,
-                device=self.device,
-            )
-            for num_vq_iter in range(self.num_vq):
-                x: torch.Tensor = self.post_model.head_code[num_vq_iter](hidden_states)
-                logits[..., num_vq_iter] = x
-                del x
+            logits = self.post_model.code_logits(hidden_states)
 
         del hidden_states
 
@@ -79,7 +68,9 @@ class Sampler:
         else:
             logits_token = inputs_ids[:, start_idx:, 0].to(self.device)
 
-        logits /= temperature
+        logits_warpers, sampler = split_sampler(logits_warpers)
+        if sampler is None:
+            logits /= temperature
 
         for logitsProcessors in logits_processors:
             logits = logitsProcessors(logits_token, logits)
@@ -92,10 +83,16 @@ class Sampler:
         if now_length < min_new_token:
             logits[:, eos_token] = -torch.inf
 
-        scores = F.softmax(logits, dim=-1)
-        idx_next = torch.multinomial(scores, num_samples=1).to(finish.device)
-        if not infer_text:
-            scores = scores.reshape(B, -1, scores.shape[-1])
+        if sampler is not None:
+            idx_next, logprob = sampler.sample(logits, temperature)
+        else:
+            scores = F.softmax(logits, dim=-1)
+            idx_next = torch.multinomial(scores, num_samples=1)
+            logprob = scores.gather(1, idx_next).log_()
+            del scores
+        idx_next = idx_next.to(finish.device)
+        # log probability of each sampled token, (B, num_vq) or (B, 1)
+        logprob = logprob.view(B, -1)
         if not infer_text:
             # idx_next = rearrange(idx_next, "(b n) 1 -> b n", n=self.num_vq)
             idx_next = idx_next.view(-1, self.num_vq)
@@ -115,6 +112,6 @@ class Sampler:
         idx_next = idx_next[:, None, :]
         return (
             idx_next,
-            torch.log(scores),
+            logprob,
             finish,
         )
@@ -0,0 +1,57 @@
+import lzma
+from typing import Optional
+
+import numpy as np
+import pybase16384 as b14
+
+from .config import Config
+
+_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}]
+
+
+def encode_spk_emb(spk_emb: np.ndarray) -> str:
+    return b14.encode_to_string(
+        lzma.compress(
+            spk_emb.astype(np.float16).tobytes(),
+            format=lzma.FORMAT_RAW,
+            filters=_LZMA_FILTERS,
+        ),
+    )
+
+
+def decode_spk_emb(spk_emb: str) -> np.ndarray:
+    return np.frombuffer(
+        lzma.decompress(
+            b14.decode_from_string(spk_emb),
+            format=lzma.FORMAT_RAW,
+            filters=_LZMA_FILTERS,
+        ),
+        dtype=np.float16,
+    ).copy()
+
+
+class SpeakerSampler:
+    """
+    Samples speaker embeddings from the spk_stat statistics only,
+    without importing torch or loading any model weights.
+    The output has the same format as Chat.sample_random_speaker().
+    """
+
+    def __init__(self, spk_stat: Optional[str] = None, dim: Optional[int] = None):
+        config = Config()
+        if spk_stat is None:
+            spk_stat = config.spk_stat
+        if dim is None:
+            dim = config.gpt.hidden_size
+        stat = np.frombuffer(b14.decode_from_string(spk_stat), dtype=np.float16)
+        std, mean = stat.astype(np.float32).reshape(2, -1)
+        if std.shape[0] != dim:
+            raise ValueError(f"spk_stat has dim {std.shape[0]}, expected {dim}")
+        self.std, self.mean = std, mean
+        self.dim = dim
+
+    def sample(self, seed: Optional[int] = None) -> str:
+        """the same seed always gives the same speaker"""
+        rng = np.random.default_rng(seed)
+        spk = rng.standard_normal(self.dim, dtype=np.float32) * self.std + self.mean
+        return encode_spk_emb(spk)
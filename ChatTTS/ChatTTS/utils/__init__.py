@@ -2,3 +2,4 @@ from .dl import check_all_assets, download_all_assets
 from .gpu import select_device
 from .io import load_safetensors, get_latest_modified_file, del_all
 from .log import logger
+from .batch import plan_batches, padding_ratio, PaddingStats
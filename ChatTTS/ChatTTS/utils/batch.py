@@ -0,0 +1,74 @@
+import threading
+from typing import Dict, List, Optional
+
+
+def plan_batches(
+    costs: List[int],
+    max_batch_size: int,
+    max_batch_tokens: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    Group indices into batches of similar cost, longest first.
+
+    A batch is padded to its longest member, so its padded size is
+    len(batch) * max(cost). Indices are sorted by cost and a batch is closed
+    once it holds max_batch_size items or adding one more would make the
+    padded size exceed max_batch_tokens (a single item always fits).
+    """
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        if current and (
+            len(current) >= max_batch_size
+            or (
+                max_batch_tokens is not None
+                and (len(current) + 1) * costs[current[0]] > max_batch_tokens
+            )
+        ):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_ratio(lengths: List[int]) -> float:
+    """share of a batch padded to its longest member that is padding"""
+    if not lengths or max(lengths) == 0:
+        return 0.0
+    return 1 - sum(lengths) / (len(lengths) * max(lengths))
+
+
+class PaddingStats:
+    """real and padded token counts per stage, accumulated across batches"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.real: Dict[str, int] = {}
+        self.padded: Dict[str, int] = {}
+
+    def add(self, stage: str, lengths: List[int]) -> float:
+        """records a batch padded to its longest member and returns its padding ratio"""
+        real = sum(lengths)
+        padded = len(lengths) * max(lengths, default=0)
+        with self.lock:
+            self.real[stage] = self.real.get(stage, 0) + real
+            self.padded[stage] = self.padded.get(stage, 0) + padded
+        return padding_ratio(lengths)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {
+                stage: {
+                    "real_tokens": self.real[stage],
+                    "padded_tokens": self.padded[stage],
+                    "padding_ratio": (
+                        1 - self.real[stage] / self.padded[stage]
+                        if self.padded[stage]
+                        else 0.0
+                    ),
+                }
+                for stage in self.padded
+            }
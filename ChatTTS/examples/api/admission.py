@@ -0,0 +1,142 @@
+"""
+/generate_voice 的准入控制
+
+- 有界队列：总排队数和单个客户端排队数都有上限，超出时返回 429 + Retry-After
+- 优先级：interactive 总是先于 bulk 出队
+- 公平性：同一优先级内按客户端轮转，单个客户端的大批量请求不会饿死其他客户端
+- 截止时间：超过 deadline 或客户端已断开的排队请求在拿到实例前就被丢弃
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+
+PRIORITIES = ("interactive", "bulk")
+
+
+class QueueFullError(Exception):
+    """队列已满，调用方应返回 429"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """请求在排队期间超过了截止时间"""
+
+
+class ClientDisconnected(Exception):
+    """请求在排队期间客户端已断开"""
+
+
+class Ticket:
+    """一个排队中的请求，拿到实例后 future 的结果即为该实例"""
+
+    def __init__(self, client_id: str, priority: str, deadline: Optional[float]):
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority: {priority}")
+        loop = asyncio.get_event_loop()
+        self.client_id = client_id
+        self.priority = priority
+        self.enqueued_at = loop.time()
+        # deadline 为相对秒数，这里换算成事件循环时间
+        self.deadline = None if deadline is None else self.enqueued_at + deadline
+        self.future: asyncio.Future = loop.create_future()
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+
+class AdmissionQueue:
+    """按优先级分层、按客户端轮转的有界等待队列"""
+
+    def __init__(self, max_size: int, max_per_client: int):
+        self.max_size = max_size
+        self.max_per_client = max_per_client
+        self.queues: Dict[str, "OrderedDict[str, Deque[Ticket]]"] = {
+            p: OrderedDict() for p in PRIORITIES
+        }
+        self.size = 0
+        self.per_client: Dict[str, int] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.abandoned = 0
+
+    def push(self, ticket: Ticket, retry_after: int):
+        """入队，队列已满时抛出QueueFullError"""
+        if self.size >= self.max_size:
+            self.rejected += 1
+            raise QueueFullError("server queue is full", retry_after)
+        if self.per_client.get(ticket.client_id, 0) >= self.max_per_client:
+            self.rejected += 1
+            raise QueueFullError(
+                "too many queued requests for client " + ticket.client_id, retry_after
+            )
+        clients = self.queues[ticket.priority]
+        clients.setdefault(ticket.client_id, deque()).append(ticket)
+        self.per_client[ticket.client_id] = self.per_client.get(ticket.client_id, 0) + 1
+        self.size += 1
+
+    def pop(self, now: float) -> Optional[Ticket]:
+        """取出下一个有效请求，顺带丢弃已过期或已放弃的请求"""
+        for priority in PRIORITIES:
+            clients = self.queues[priority]
+            while clients:
+                client_id, tickets = next(iter(clients.items()))
+                ticket = tickets.popleft()
+                self._forget(ticket)
+                if tickets:
+                    # 轮转：该客户端排到本优先级的末尾
+                    clients.move_to_end(client_id)
+                else:
+                    del clients[client_id]
+                if ticket.future.done():
+                    continue
+                if ticket.expired(now):
+                    self.expired += 1
+                    ticket.future.set_exception(DeadlineExceeded())
+                    continue
+                self.admitted += 1
+                return ticket
+        return None
+
+    def discard(self, ticket: Ticket) -> bool:
+        """从队列中移除一个仍在排队的请求"""
+        clients = self.queues[ticket.priority]
+        tickets = clients.get(ticket.client_id)
+        if tickets is None or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del clients[ticket.client_id]
+        self._forget(ticket)
+        self.abandoned += 1
+        return True
+
+    def _forget(self, ticket: Ticket):
+        self.size -= 1
+        left = self.per_client[ticket.client_id] - 1
+        if left:
+            self.per_client[ticket.client_id] = left
+        else:
+            del self.per_client[ticket.client_id]
+
+    def depth(self) -> Dict[str, int]:
+        return {
+            p: sum(len(t) for t in clients.values())
+            for p, clients in self.queues.items()
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.size,
+            "depth_by_priority": self.depth(),
+            "clients": len(self.per_client),
+            "max_size": self.max_size,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "abandoned": self.abandoned,
+        }
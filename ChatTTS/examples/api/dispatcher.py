@@ -0,0 +1,305 @@
+"""
+多节点 ChatTTS 调度服务
+
+在 N 个 main_new_new.py 后端前面提供同样的 /generate_voice 接口：
+- 定期轮询各后端的 /ready，只向健康节点转发，并按上报的排队深度和在途请求数选择节点
+- 同一个 spk_emb 的请求优先路由到固定节点（rendezvous hash），保持后端的说话人缓存命中
+- 粘性节点过载时退回到负载最低的节点；请求未到达后端（连接失败、收到响应前连接被关闭）
+  或被拒绝（429/502/503/504）时换一个节点重试。500 等确定性错误原样返回，读取超时返回 504，
+  避免在多个节点上重复完整的推理
+- 客户端断开时取消到后端的请求、关闭连接，后端随之丢弃排队中的请求或中断推理
+
+启动示例：
+    python examples/api/dispatcher.py --port 8000 \
+        --backends http://localhost:8004 http://localhost:8005 http://localhost:8006
+"""
+
+import argparse
+import asyncio
+import hashlib
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from fastapi import FastAPI, HTTPException, Request, Response
+
+HEALTH_INTERVAL = 2.0  # 健康检查间隔（秒）
+HEALTH_TIMEOUT = 5.0  # 健康检查超时（秒）
+REQUEST_TIMEOUT = 600.0  # 转发请求超时（秒）
+STICKY_MAX_LOAD = 4  # 粘性节点的负载超过该值时改用负载最低的节点
+MAX_ATTEMPTS = 3  # 每个请求最多尝试的节点数
+DISCONNECT_POLL_INTERVAL = 0.5  # 检查客户端是否断开的间隔（秒）
+RETRY_STATUS = {429, 502, 503, 504}
+# 原样转发给客户端的响应头（aiohttp 的 headers 不区分大小写）
+FORWARD_HEADERS = ("Content-Disposition", "Retry-After", "X-Synthesis-Seconds")
+
+
+class BackendUnreachable(Exception):
+    """请求没有到达后端（连接失败或收到响应前连接被关闭），可以换节点重试"""
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.queue_depth = 0
+        self.available = 0
+        self.in_flight = 0
+        self.failures = 0
+        self.requests = 0
+        self.last_checked = 0.0
+
+    @property
+    def load(self) -> int:
+        """排队数 + 本调度器的在途请求数，减去空闲实例数"""
+        return self.queue_depth + self.in_flight - self.available
+
+    def status(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "queue_depth": self.queue_depth,
+            "available": self.available,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class Dispatcher:
+    def __init__(self, urls: List[str]):
+        self.backends = [Backend(u) for u in urls]
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        await self.check_all()
+        self.health_task = asyncio.ensure_future(self.health_loop())
+
+    async def stop(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def check(self, backend: Backend):
+        """查询后端 /ready，记录健康状态和排队深度"""
+        try:
+            async with self.session.get(
+                backend.url + "/ready",
+                timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT),
+            ) as response:
+                data = await response.json()
+            backend.healthy = response.status == 200 and data.get("status") == "ready"
+            backend.queue_depth = int(data.get("queue_depth", 0))
+            backend.available = int(data.get("available", 0))
+        except Exception:
+            backend.healthy = False
+        backend.last_checked = time.time()
+
+    async def check_all(self):
+        await asyncio.gather(*[self.check(b) for b in self.backends])
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            await self.check_all()
+
+    @staticmethod
+    def _score(key: str, backend: Backend) -> int:
+        digest = hashlib.sha1((key + "|" + backend.url).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def candidates(self, key: Optional[str]) -> List[Backend]:
+        """按优先顺序返回健康节点：粘性节点（未过载时）在前，其余按负载排序"""
+        healthy = [b for b in self.backends if b.healthy]
+        by_load = sorted(healthy, key=lambda b: b.load)
+        if not key or not healthy:
+            return by_load
+        sticky = max(healthy, key=lambda b: self._score(key, b))
+        if sticky.load >= STICKY_MAX_LOAD and by_load[0] is not sticky:
+            return by_load
+        return [sticky] + [b for b in by_load if b is not sticky]
+
+    async def post(
+        self, backend: Backend, body: bytes, headers: Dict[str, str]
+    ) -> Response:
+        """向一个后端转发请求，请求未到达后端时抛出 BackendUnreachable"""
+        responded = False
+        try:
+            async with self.session.post(
+                backend.url + "/generate_voice", data=body, headers=headers
+            ) as response:
+                responded = True
+                content = await response.read()
+        except aiohttp.ClientConnectorError as e:
+            raise BackendUnreachable(str(e)) from e
+        except aiohttp.ServerDisconnectedError as e:
+            if responded:
+                raise
+            raise BackendUnreachable(str(e)) from e
+        return Response(
+            content=content,
+            status_code=response.status,
+            media_type=response.headers.get("Content-Type"),
+            headers={
+                name: response.headers[name]
+                for name in FORWARD_HEADERS
+                if name in response.headers
+            },
+        )
+
+    async def forward(
+        self,
+        body: bytes,
+        headers: Dict[str, str],
+        key: Optional[str],
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ):
+        """
+        转发请求，客户端断开时（is_disconnected）取消到后端的请求并返回 499：
+        关闭的连接让后端丢弃排队中的请求、中断正在进行的推理
+        """
+        last_error = "no healthy backend"
+        retry_after = None
+        tried = set()
+        for _ in range(MAX_ATTEMPTS):
+            if is_disconnected is not None and await is_disconnected():
+                return Response(status_code=499)
+            backend = next(
+                (b for b in self.candidates(key) if b.url not in tried), None
+            )
+            if backend is None:
+                break
+            tried.add(backend.url)
+            backend.in_flight += 1
+            backend.requests += 1
+            task = asyncio.ensure_future(self.post(backend, body, headers))
+            try:
+                while not task.done():
+                    await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+                    if (
+                        not task.done()
+                        and is_disconnected is not None
+                        and await is_disconnected()
+                    ):
+                        task.cancel()
+                        await asyncio.wait({task})
+                        return Response(status_code=499)
+                response = task.result()
+            except BackendUnreachable as e:
+                backend.failures += 1
+                backend.healthy = False
+                last_error = backend.url + ": " + str(e)
+                continue
+            except asyncio.TimeoutError:
+                # 后端可能仍在推理，换节点会重复完整的推理；节点只是慢，不标记为不健康
+                raise HTTPException(status_code=504, detail=backend.url + " timed out")
+            except aiohttp.ClientError as e:
+                backend.failures += 1
+                raise HTTPException(status_code=502, detail=backend.url + ": " + str(e))
+            finally:
+                # 处理函数被取消时同样关闭到后端的连接
+                if not task.done():
+                    task.cancel()
+                backend.in_flight -= 1
+            if response.status_code in RETRY_STATUS:
+                retry_after = response.headers.get("Retry-After", retry_after)
+                last_error = backend.url + " returned " + str(response.status_code)
+                if response.status_code != 429:
+                    backend.failures += 1
+                continue
+            return response
+        raise HTTPException(
+            status_code=503,
+            detail=last_error,
+            headers={"Retry-After": retry_after or str(int(HEALTH_INTERVAL))},
+        )
+
+
+def speaker_key(payload: Optional[dict]) -> Optional[str]:
+    """提取用于粘性路由的说话人标识"""
+    if not payload:
+        return None
+    spk = (payload.get("params_infer_code") or {}).get("spk_emb")
+    if spk is None:
+        return None
+    return hashlib.sha1(str(spk).encode("utf-8")).hexdigest()
+
+
+def create_app(urls: List[str]) -> FastAPI:
+    app = FastAPI()
+    dispatcher = Dispatcher(urls)
+    app.state.dispatcher = dispatcher
+
+    @app.on_event("startup")
+    async def startup_event():
+        await dispatcher.start()
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        await dispatcher.stop()
+
+    @app.get("/ready")
+    async def ready():
+        """至少一个后端就绪即视为就绪"""
+        healthy = [b for b in dispatcher.backends if b.healthy]
+        if not healthy:
+            return {"status": "initializing"}
+        return {
+            "status": "ready",
+            "instances": len(healthy),
+            "available": sum(b.available for b in healthy),
+            "queue_depth": sum(b.queue_depth for b in healthy),
+        }
+
+    @app.get("/status")
+    async def status():
+        """各后端的健康状态与负载"""
+        backends = {b.url: b.status() for b in dispatcher.backends}
+        return {
+            # 兼容客户端的 wait_for_service_ready：按健康后端计数
+            "instances": {u: s for u, s in backends.items() if s["healthy"]},
+            "backends": backends,
+        }
+
+    @app.post("/generate_voice")
+    async def generate_voice(request: Request):
+        """转发到选中的后端"""
+        body = await request.body()
+        try:
+            payload = await request.json()
+        except Exception:
+            payload = None
+        headers = {"Content-Type": "application/json"}
+        client_id = request.headers.get("X-Client-Id") or (
+            request.client.host if request.client else ""
+        )
+        headers["X-Client-Id"] = client_id
+        return await dispatcher.forward(
+            body, headers, speaker_key(payload), request.is_disconnected
+        )
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(
+        description="Dispatcher in front of several ChatTTS API servers"
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Backend base URLs, e.g. http://localhost:8004",
+    )
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.backends), host=args.host, port=args.port)
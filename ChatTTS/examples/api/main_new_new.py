@@ -1,22 +1,32 @@
 import io
 import os
 import sys
+import math
+import wave
 import zipfile
-from typing import Optional, Dict, List, Any
+from functools import lru_cache
+from typing import Optional, Dict, List, Any, Awaitable, Callable, Literal, Tuple
 from contextlib import asynccontextmanager
 import asyncio
 from collections import deque
+import time
 import psutil
-import GPUtil
 import threading
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from fastapi.responses import StreamingResponse
+try:
+    import GPUtil
+except ImportError:
+    GPUtil = None  # CPU部署时可不安装
+
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, validator
 import torch
 import numpy as np
+import av
 
 if sys.platform == "darwin":
     os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
@@ -25,11 +35,23 @@ now_dir = os.getcwd()
 sys.path.append(now_dir)
 
 import ChatTTS
-from tools.audio import pcm_arr_to_mp3_view
+from ChatTTS.model import Speaker
+from tools.audio import float_to_int16, pcm_arr_to_mp3_view
 from tools.logger import get_logger
 from tools.normalizer.en import normalizer_en_nemo_text
 from tools.normalizer.zh import normalizer_zh_tn
 
+from admission import (
+    AdmissionQueue,
+    ClientDisconnected,
+    DeadlineExceeded,
+    QueueFullError,
+    Ticket,
+)
+import metrics
+from synthesis_cache import SynthesisCache, cache_key, cacheable, split_seconds
+from workers import CpuWorker, RenderResult, start_cpu_workers
+
 logger = get_logger("Command")
 
 # 配置参数
@@ -37,6 +59,23 @@ TOTAL_VRAM = 80  # 总显存（GB）
 INSTANCE_VRAM = 15  # 每个实例占用显存（GB）
 MAX_POOL_SIZE = min(12, int(TOTAL_VRAM * 0.9 // INSTANCE_VRAM))  # 保留10%显存余量
 MAX_POOL_SIZE = 2
+MAX_QUEUE_SIZE = 64  # 全局最大排队请求数，超出返回429
+MAX_QUEUE_PER_CLIENT = 16  # 单个客户端最大排队请求数
+QUEUE_POLL_INTERVAL = 0.5  # 检查截止时间和客户端断开的间隔（秒）
+SAMPLE_RATE = 24000  # ChatTTS输出采样率
+# CPU预fork模式：大于0时在CPU上加载一份共享权重并启动对应数量的推理进程
+CPU_WORKERS = int(os.environ.get("CHATTTS_CPU_WORKERS", "0"))
+# 合成缓存目录：设置后相同文本、说话人和参数的句子直接从磁盘返回，可与客户端共用
+SYNTHESIS_CACHE_DIR = os.environ.get("CHATTTS_SYNTHESIS_CACHE")
+# 静态 KV 缓存：按提示长度 + max_new_token 一次分配，生成时原地写入，不再逐 token 扩容
+STATIC_KV_CACHE = os.environ.get("CHATTTS_STATIC_KV_CACHE", "0") == "1"
+# 连续批处理：句子结束即移出批次，排队的句子随时补入，不再等整批最长的句子
+CONTINUOUS_BATCHING = os.environ.get("CHATTTS_CONTINUOUS_BATCHING", "0") == "1"
+# 解码流水线：DVAE 解码器和 Vocos 在单独线程（GPU 上为单独 CUDA 流）中运行，GPT 同时生成下一批/下一段
+OVERLAP_DECODE = os.environ.get("CHATTTS_OVERLAP_DECODE", "0") == "1"
+# 非流式请求按长度分桶时每批的 token 预算（按批内最长句子补齐计算），不设置时只按 max_split_batch 限制句数
+MAX_BATCH_TOKENS = int(os.environ["CHATTTS_MAX_BATCH_TOKENS"]) if os.environ.get("CHATTTS_MAX_BATCH_TOKENS") else None
+synthesis_cache: Optional[SynthesisCache] = None
 
 class ChatInstance:
     def __init__(self, id: int):
@@ -47,22 +86,43 @@ class ChatInstance:
         self.total_requests = 0
         self.failed_requests = 0
         
-    def initialize(self):
+    def initialize(self, device: Optional[torch.device] = None):
         """同步初始化方法"""
         logger.info("Initializing instance " + str(self.id))
         self.chat = ChatTTS.Chat(get_logger("ChatTTS_" + str(self.id)))
         self.chat.normalizer.register("en", normalizer_en_nemo_text())
         self.chat.normalizer.register("zh", normalizer_zh_tn())
-        if not self.chat.load(source="huggingface"):
+        self.chat.observer = metrics.observe_chat
+        if not self.chat.load(
+            source="huggingface",
+            device=device,
+            use_static_cache=STATIC_KV_CACHE,
+            continuous_batching=CONTINUOUS_BATCHING,
+            overlap_decode=OVERLAP_DECODE,
+        ):
             raise RuntimeError("Failed to load models for instance " + str(self.id))
         logger.info("Instance " + str(self.id) + " initialized successfully")
         return self
 
+    def render(self, params: "ChatTTSParams") -> RenderResult:
+        """推理并编码每个索引的音频"""
+        return render_audio(self.chat, params)
+
+class WorkerInstance(ChatInstance):
+    """CPU预fork模式下的实例，推理在独立进程中执行"""
+    def __init__(self, worker: CpuWorker):
+        super().__init__(worker.id)
+        self.chat = worker  # 提供interrupt()
+
+    def render(self, params: "ChatTTSParams") -> RenderResult:
+        return self.chat.render(params)
+
 class InstancePool:
     def __init__(self):
         self.instances: Dict[int, ChatInstance] = {}
         self.available = deque()
-        self.lock = asyncio.Lock()
+        self.queue = AdmissionQueue(MAX_QUEUE_SIZE, MAX_QUEUE_PER_CLIENT)
+        self.service_time = 0.0  # 单次请求占用实例时间的滑动平均（秒）
         self.initialized = False
         self.initialization_event = asyncio.Event()
         
@@ -83,35 +143,101 @@ class InstancePool:
         self.initialized = True
         self.initialization_event.set()
 
+    def initialize_workers(self, n: int):
+        """CPU预fork模式：加载一份模型，放入共享内存后fork出n个绑核的推理进程"""
+        logger.info("Starting " + str(n) + " CPU workers...")
+        # 父进程不做推理，避免在fork前初始化多线程计算
+        torch.set_num_threads(1)
+        chat = ChatInstance(-1).initialize(device=torch.device("cpu")).chat
+        for worker in start_cpu_workers(chat, render_audio, n, metrics.observe_chat):
+            self.instances[worker.id] = WorkerInstance(worker)
+            self.available.append(worker.id)
+            logger.info(
+                "CPU worker " + str(worker.id) + " started on cores " + str(worker.cores)
+            )
+        self.initialized = True
+        self.initialization_event.set()
+
+    def shutdown(self):
+        """停止CPU推理进程"""
+        for instance in self.instances.values():
+            if isinstance(instance, WorkerInstance):
+                instance.chat.close()
+
     async def wait_for_initialization(self):
         """等待初始化完成"""
         await self.initialization_event.wait()
 
-    async def get_instance(self):
-        """获取一个可用实例"""
+    def retry_after(self) -> int:
+        """根据排队长度和平均服务时间估算客户端应等待的秒数"""
+        workers = max(len(self.instances), 1)
+        estimate = (self.queue.size + 1) * max(self.service_time, 1.0) / workers
+        return max(1, math.ceil(estimate))
+
+    async def get_instance(
+        self,
+        client_id: str = "",
+        priority: str = "bulk",
+        deadline: Optional[float] = None,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ):
+        """获取一个可用实例，必要时按优先级和客户端公平排队"""
         if not self.initialized:
             await self.wait_for_initialization()
-        
-        async with self.lock:
+
+        ticket = Ticket(client_id, priority, deadline)
+        self.queue.push(ticket, self.retry_after())
+        self.dispatch()
+
+        try:
             while True:
-                if not self.available:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                instance_id = self.available.popleft()
-                instance = self.instances[instance_id]
-                if not instance.busy:
-                    instance.busy = True
-                    instance.last_used = asyncio.get_event_loop().time()
-                    instance.total_requests += 1
-                    return instance
-                
-                self.available.append(instance_id)
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(ticket.future), timeout=QUEUE_POLL_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                if ticket.expired(asyncio.get_event_loop().time()):
+                    raise DeadlineExceeded()
+                if is_disconnected is not None and await is_disconnected():
+                    raise ClientDisconnected()
+        except BaseException:
+            self.abandon(ticket)
+            raise
+
+    def abandon(self, ticket: Ticket):
+        """放弃排队请求；如果实例已经分配给它则归还"""
+        if self.queue.discard(ticket):
+            ticket.future.cancel()
+        elif ticket.future.done() and not ticket.future.cancelled():
+            if ticket.future.exception() is None:
+                self.release_instance(ticket.future.result())
+        else:
+            ticket.future.cancel()
+
+    def dispatch(self):
+        """把空闲实例分配给队首请求"""
+        now = asyncio.get_event_loop().time()
+        while self.available:
+            ticket = self.queue.pop(now)
+            if ticket is None:
+                return
+            instance = self.instances[self.available.popleft()]
+            instance.busy = True
+            instance.last_used = now
+            instance.total_requests += 1
+            ticket.future.set_result(instance)
 
     def release_instance(self, instance: ChatInstance):
         """释放实例"""
+        elapsed = asyncio.get_event_loop().time() - instance.last_used
+        if self.service_time:
+            self.service_time = 0.9 * self.service_time + 0.1 * elapsed
+        else:
+            self.service_time = elapsed
         instance.busy = False
         self.available.append(instance.id)
+        self.dispatch()
 
 class ChatTTSParams(BaseModel):
     text: List[str]
@@ -122,8 +248,12 @@ class ChatTTSParams(BaseModel):
     use_decoder: bool = True
     do_text_normalization: bool = True
     do_homophone_replacement: bool = False
+    split_text: bool = True  # False时每条文本单独返回一个音频，整批一次推理
+    format: Literal["mp3", "wav", "flac"] = "mp3"  # wav/flac为无损中间格式，合并时只编码一次
     params_refine_text: Optional[ChatTTS.Chat.RefineTextParams] = None
     params_infer_code: ChatTTS.Chat.InferCodeParams
+    priority: Literal["interactive", "bulk"] = "bulk"  # interactive优先出队
+    deadline: Optional[float] = None  # 最长排队秒数，超过后直接丢弃
 
     # 使用验证器
     @validator('text')
@@ -138,9 +268,37 @@ class ChatTTSParams(BaseModel):
 app = FastAPI()
 instance_pool = InstancePool()
 
+metrics.registry.register(
+    metrics.Gauge(
+        "chattts_queue_depth",
+        "Requests waiting for an instance.",
+        lambda: [({"priority": p}, n) for p, n in instance_pool.queue.depth().items()],
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "chattts_instances",
+        "ChatTTS instances by state.",
+        lambda: [
+            ({"state": "busy"}, sum(i.busy for i in instance_pool.instances.values())),
+            ({"state": "idle"}, sum(not i.busy for i in instance_pool.instances.values())),
+        ],
+    )
+)
+
 @app.on_event("startup")
 async def startup_event():
     """服务启动事件"""
+    global synthesis_cache
+    if SYNTHESIS_CACHE_DIR:
+        synthesis_cache = SynthesisCache(SYNTHESIS_CACHE_DIR)
+        logger.info("Synthesis cache: " + SYNTHESIS_CACHE_DIR)
+
+    if CPU_WORKERS > 0:
+        # 必须在主线程、处理任何请求之前fork
+        instance_pool.initialize_workers(CPU_WORKERS)
+        return
+
     def init_pool():
         try:
             instance_pool.initialize_pool()
@@ -152,12 +310,22 @@ async def startup_event():
     init_thread = threading.Thread(target=init_pool)
     init_thread.start()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """服务关闭事件"""
+    instance_pool.shutdown()
+
 @app.get("/ready")
 async def ready():
     """检查服务是否准备就绪"""
     try:
         await asyncio.wait_for(instance_pool.wait_for_initialization(), timeout=1.0)
-        return {"status": "ready", "instances": len(instance_pool.instances)}
+        return {
+            "status": "ready",
+            "instances": len(instance_pool.instances),
+            "available": len(instance_pool.available),
+            "queue_depth": instance_pool.queue.size,
+        }
     except asyncio.TimeoutError:
         return {"status": "initializing"}
 
@@ -166,7 +334,6 @@ async def get_status():
     """获取服务状态"""
     if not instance_pool.initialized:
         await instance_pool.wait_for_initialization()
-    gpu = GPUtil.getGPUs()[0]
     return {
         "instances": {
             i: {
@@ -175,15 +342,53 @@ async def get_status():
                 "failed_requests": inst.failed_requests
             } for i, inst in instance_pool.instances.items()
         },
-        "gpu_status": {
-            "vram_used": str(round(gpu.memoryUsed, 1)) + "GB",
-            "vram_util": str(round(gpu.memoryUtil*100, 1)) + "%"
-        },
+        "queue": instance_pool.queue.stats(),
+        "gpu_status": get_gpu_status(),
         "cpu_status": {
             "cpu_percent": str(round(psutil.cpu_percent(), 1)) + "%"
+        },
+        "cache_status": {
+            "empty_audio": cache_stats(create_empty_audio.cache_info()),
+            "speaker": Speaker.cache_info(),
+            "synthesis": synthesis_cache.stats() if synthesis_cache else None,
         }
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus文本格式的指标"""
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+def get_gpu_status() -> Optional[Dict[str, str]]:
+    """获取GPU显存状态，没有GPU或GPUtil不可用时返回None"""
+    if GPUtil is None:
+        return None
+    try:
+        gpus = GPUtil.getGPUs()
+    except Exception as e:
+        logger.warning("Failed to query GPU status: " + str(e))
+        return None
+    if not gpus:
+        return None
+    gpu = gpus[0]
+    return {
+        "vram_used": str(round(gpu.memoryUsed, 1)) + "GB",
+        "vram_util": str(round(gpu.memoryUtil*100, 1)) + "%"
+    }
+
+def cache_stats(info) -> Dict[str, Any]:
+    """将lru_cache的统计信息转换为命中率"""
+    total = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "hit_rate": info.hits / total if total else 0.0
+    }
+
 def format_validation_error(error) -> List[Dict[str, Any]]:
     """格式化验证错误，确保返回的是可JSON序列化的格式"""
     result = []
@@ -216,11 +421,11 @@ async def cleanup_resources(buf, instance: ChatInstance):
     torch.cuda.empty_cache()
     instance_pool.release_instance(instance)
 
-def create_empty_audio():
-    """创建空白音频的MP3数据"""
+@lru_cache(maxsize=None)
+def create_empty_audio(fmt: str = "mp3", sample_rate: int = 16000) -> bytes:
+    """创建空白音频数据，按格式和采样率在进程内只生成一次"""
     try:
         # 创建一个短的非零音频（0.1秒）- 确保有足够的样本且非零值
-        sample_rate = 16000  # 假设采样率为16kHz
         duration = 0.1  # 0.1秒
         num_samples = int(sample_rate * duration)
         # 使用非零值，创建一个极小振幅的正弦波而不是零数组
@@ -230,14 +435,18 @@ def create_empty_audio():
         # 添加日志以检查数组
         logger.info(f"Empty audio array shape: {empty_wav.shape}, min: {empty_wav.min()}, max: {empty_wav.max()}")
         
-        return pcm_arr_to_mp3_view(empty_wav.astype(np.float32))
+        if fmt != "mp3":
+            return encode_audio(empty_wav.astype(np.float32), fmt, sample_rate)
+        return bytes(pcm_arr_to_mp3_view(empty_wav.astype(np.float32)))
     except Exception as e:
         logger.error(f"Error creating empty audio: {e}")
         # 如果出错，返回预先生成的静音MP3数据
         return b'ID3\x03\x00\x00\x00\x00\x00#TSSE\x00\x00\x00\x0f\x00\x00\x03Lavf58.29.100\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xf3\x84\xc0\x00\x00\x00\x00\x00\x00\x00\x00\x00Info\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Lavf58.29.100\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
 @app.post("/generate_voice")
-async def generate_voice(params: ChatTTSParams, background_tasks: BackgroundTasks):
+async def generate_voice(
+    params: ChatTTSParams, request: Request, background_tasks: BackgroundTasks
+):
     """生成语音的主要接口"""
     logger.info("Text input: " + str(params.text))
     
@@ -261,9 +470,9 @@ async def generate_voice(params: ChatTTSParams, background_tasks: BackgroundTask
         buf = io.BytesIO()
         try:
             with zipfile.ZipFile(buf, "a", compression=zipfile.ZIP_DEFLATED, allowZip64=False) as f:
-                empty_audio_data = create_empty_audio()
+                empty_audio_data = create_empty_audio(params.format)
                 for i in range(len(params.text)):
-                    f.writestr(f"{i}.mp3", empty_audio_data)
+                    f.writestr(f"{i}.{params.format}", empty_audio_data)
             
             logger.info("Created empty audio files for all text indices.")
             buf.seek(0)
@@ -279,91 +488,311 @@ async def generate_voice(params: ChatTTSParams, background_tasks: BackgroundTask
             logger.error(f"Error creating empty audio files: {e}")
             raise HTTPException(status_code=500, detail=f"Error creating empty audio files: {str(e)}")
 
-    # 获取实例
-    instance = await instance_pool.get_instance()
+    # 合成缓存全部命中时不占用实例
+    cached = await run_in_threadpool(cache_lookup, params)
+    if cached is not None and all(
+        hit is not None for key, hit in zip(*cached) if key is not None
+    ):
+        metrics.requests_total.inc(outcome="cached")
+        buf = build_zip(cached[1], params.format)
+        response = StreamingResponse(buf, media_type="application/zip")
+        response.headers["Content-Disposition"] = "attachment; filename=audio_files.zip"
+        response.headers["X-Synthesis-Seconds"] = "0"
+        background_tasks.add_task(lambda b: b.close(), buf)
+        return response
+
+    # 获取实例（排队、优先级和截止时间由实例池处理）
+    client_id = request.headers.get("X-Client-Id") or (
+        request.client.host if request.client else ""
+    )
+    try:
+        instance = await instance_pool.get_instance(
+            client_id, params.priority, params.deadline, request.is_disconnected
+        )
+    except QueueFullError as e:
+        metrics.requests_total.inc(outcome="rejected")
+        logger.warning("Rejecting request from " + client_id + ": " + str(e))
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except DeadlineExceeded:
+        metrics.requests_total.inc(outcome="expired")
+        logger.warning("Request from " + client_id + " exceeded its deadline while queued")
+        raise HTTPException(
+            status_code=503,
+            detail="Deadline exceeded while queued",
+            headers={"Retry-After": str(instance_pool.retry_after())},
+        )
+    except ClientDisconnected:
+        metrics.requests_total.inc(outcome="disconnected")
+        logger.info("Client " + client_id + " disconnected while queued, dropping request")
+        return Response(status_code=499)
     logger.info("Using instance " + str(instance.id))
     
+    task = None
+    handed_off = False  # 实例已交给后台清理任务释放
     try:
-        # 设置音频种子
-        if params.params_infer_code.manual_seed is not None:
-            torch.manual_seed(params.params_infer_code.manual_seed)
-            params.params_infer_code.spk_emb = instance.chat.sample_random_speaker()
-
-        # 创建文本到索引的映射和非空文本列表
-        non_empty_texts = []
-        text_to_original_idx = {}
-        for i, text in enumerate(params.text):
-            if text and text.strip():
-                text_to_original_idx[len(non_empty_texts)] = i
-                non_empty_texts.append(text)
-        
-        logger.info(f"Processing {len(non_empty_texts)} non-empty texts out of {len(params.text)} total texts")
-        
-        # 文本处理
-        if params.params_refine_text and non_empty_texts:
-            text = instance.chat.infer(
-                text=non_empty_texts, 
-                skip_refine_text=False, 
-                refine_text_only=True
-            )
-            logger.info("Refined text: " + str(text))
-        else:
-            text = non_empty_texts
-
-        logger.info("Use speaker:")
-        logger.info(str(params.params_infer_code.spk_emb))
-
-        # 语音推理 - 只处理非空文本
-        if non_empty_texts:
-            logger.info("Start voice inference.")
-            wavs = instance.chat.infer(
-                text=text,
-                stream=params.stream,
-                lang=params.lang,
-                skip_refine_text=params.skip_refine_text,
-                use_decoder=params.use_decoder,
-                do_text_normalization=params.do_text_normalization,
-                do_homophone_replacement=params.do_homophone_replacement,
-                params_infer_code=params.params_infer_code,
-                params_refine_text=params.params_refine_text,
-            )
-            logger.info("Inference completed.")
-        else:
-            wavs = []
-        
-        # 创建ZIP文件
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, "a", compression=zipfile.ZIP_DEFLATED, allowZip64=False) as f:
-            # 为所有索引创建MP3文件
-            empty_audio_data = create_empty_audio()
-            
-            # 首先为所有位置添加空音频
-            for i in range(len(params.text)):
-                f.writestr(f"{i}.mp3", empty_audio_data)
-            
-            # 然后用非空文本的音频替换对应位置
-            for wav_idx, original_idx in text_to_original_idx.items():
-                if wav_idx < len(wavs):  # 确保索引有效
-                    wav_data = pcm_arr_to_mp3_view(wavs[wav_idx])
-                    if wav_data:  # 确保MP3数据有效
-                        f.writestr(f"{original_idx}.mp3", wav_data)
-        
-        logger.info("Audio generation successful.")
-        buf.seek(0)
+        # 推理在线程池中执行，事件循环可以继续检查客户端是否断开
+        # 中断后的结果不完整，synthesize 据此跳过缓存写入；先置位再中断实例
+        interrupted = threading.Event()
+        task = asyncio.ensure_future(
+            run_in_threadpool(synthesize, instance, params, cached, interrupted)
+        )
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=QUEUE_POLL_INTERVAL)
+                if task.done():
+                    break
+                if not interrupted.is_set() and await request.is_disconnected():
+                    logger.info("Client disconnected, interrupting instance " + str(instance.id))
+                    interrupted.set()
+                if interrupted.is_set():
+                    # 每次 infer() 开始时都会清除中断标志（精炼文本后的第二次 infer、
+                    # 尚未开始推理的 CPU 工作进程），推理结束前每次轮询都重新中断
+                    instance.chat.interrupt()
+        except asyncio.CancelledError:
+            # 处理函数被取消（例如服务关闭），让推理尽快结束
+            logger.info("Request cancelled, interrupting instance " + str(instance.id))
+            interrupted.set()
+            instance.chat.interrupt()
+            raise
+        buf, render_seconds = task.result()
+        if interrupted.is_set():
+            metrics.requests_total.inc(outcome="disconnected")
+            buf.close()
+            return Response(status_code=499)
+        metrics.requests_total.inc(outcome="ok")
 
         # 添加资源清理任务
         background_tasks.add_task(cleanup_resources, buf, instance)
+        handed_off = True
 
         response = StreamingResponse(buf, media_type="application/zip")
         response.headers["Content-Disposition"] = "attachment; filename=audio_files.zip"
+        # 推理耗时，客户端缓存用来统计节省的时间
+        response.headers["X-Synthesis-Seconds"] = f"{render_seconds:.3f}"
         return response
         
     except Exception as e:
+        metrics.requests_total.inc(outcome="error")
         instance.failed_requests += 1
-        instance_pool.release_instance(instance)
         logger.error("Error in generate_voice: " + str(e))
         raise HTTPException(status_code=500, detail=f"Error generating voice: {str(e)}")
+    finally:
+        if not handed_off:
+            if task is not None and not task.done():
+                # 推理线程仍在使用该实例，结束后再归还
+                task.add_done_callback(lambda _: instance_pool.release_instance(instance))
+            else:
+                instance_pool.release_instance(instance)
+
+# (每条文本的缓存键, 命中的音频)，空文本的键为None
+CacheLookup = Tuple[List[Optional[str]], List[Optional[bytes]]]
+
+def cache_lookup(params: ChatTTSParams) -> Optional[CacheLookup]:
+    """查询合成缓存，未启用或请求不能按句缓存时返回None"""
+    if synthesis_cache is None:
+        return None
+    body = params.model_dump(mode="json")
+    if not cacheable(body):
+        return None
+    keys = [cache_key(t, body, params.format) if t and t.strip() else None for t in params.text]
+    hits = []
+    for key in keys:
+        entry = synthesis_cache.lookup(key, params.format) if key is not None else None
+        if entry is not None:
+            metrics.synthesis_cache_total.inc(result="hit")
+            metrics.synthesis_cache_saved_seconds_total.inc(entry[1])
+        elif key is not None:
+            metrics.synthesis_cache_total.inc(result="miss")
+        hits.append(None if entry is None else entry[0])
+    return keys, hits
+
+def cache_store(
+    keys: List[Optional[str]], encoded: List[Optional[bytes]], render_seconds: float, audio_seconds: float, fmt: str
+):
+    """按音频大小（CBR MP3和WAV与时长成正比）分摊推理时间后写入缓存，键为None的音频不写入"""
+    items = [(k, data) for k, data in zip(keys, encoded) if data]
+    if not items:
+        return
+    sizes = tuple(float(len(data)) for _, data in items)
+    gpu_shares = split_seconds(render_seconds, sizes)
+    audio_shares = split_seconds(audio_seconds, sizes)
+    for (key, data), gpu, audio in zip(items, gpu_shares, audio_shares):
+        if key is None:  # 仍参与分摊，避免其余条目记下它的推理时间
+            continue
+        try:
+            synthesis_cache.put(key, data, gpu, audio, fmt)
+        except OSError as e:
+            logger.warning("Failed to write synthesis cache: " + str(e))
+
+def build_zip(encoded: List[Optional[bytes]], fmt: str = "mp3") -> io.BytesIO:
+    """每个索引只写入一次：有音频的写入音频，其余写入缓存的空音频"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "a", compression=zipfile.ZIP_DEFLATED, allowZip64=False) as f:
+        for i, wav_data in enumerate(encoded):
+            if not wav_data:  # 音频数据无效时使用空音频
+                wav_data = create_empty_audio(fmt)
+            f.writestr(f"{i}.{fmt}", wav_data)
+    buf.seek(0)
+    return buf
+
+def synthesize(
+    instance: ChatInstance,
+    params: ChatTTSParams,
+    cached: Optional[CacheLookup] = None,
+    interrupted: Optional[threading.Event] = None,
+) -> Tuple[io.BytesIO, float]:
+    """
+    在指定实例上执行推理并打包为ZIP（同步，运行在线程池中），返回(ZIP, 推理秒数)
+    interrupted 被置位（客户端断开）时结果可能被截断，不写入缓存
+    """
+    start_time = time.perf_counter()
+    if cached is None:
+        encoded, audio_seconds, _ = instance.render(params)
+        render_seconds = time.perf_counter() - start_time
+    else:
+        # 只推理未命中的文本，以EOS结束的结果写回缓存
+        keys, encoded = cached
+        misses = [i for i, (key, hit) in enumerate(zip(keys, encoded)) if key is not None and hit is None]
+        miss_params = params.model_copy(update={"text": [params.text[i] for i in misses]})
+        rendered, audio_seconds, unfinished = instance.render(miss_params)
+        render_seconds = time.perf_counter() - start_time
+        encoded = list(encoded)
+        for i, data in zip(misses, rendered):
+            encoded[i] = data
+        if interrupted is None or not interrupted.is_set():
+            cache_store(
+                [None if j in unfinished else keys[i] for j, i in enumerate(misses)],
+                rendered, render_seconds, audio_seconds, params.format,
+            )
+
+    # 创建ZIP文件
+    zip_start = time.perf_counter()
+    buf = build_zip(encoded, params.format)
+    metrics.stage_seconds.observe(time.perf_counter() - zip_start, stage="zip")
+    metrics.observe_synthesis(audio_seconds, time.perf_counter() - start_time)
+    
+    logger.info("Audio generation successful.")
+    return buf, render_seconds
+
+def encode_audio(wav: np.ndarray, fmt: str, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """把单声道float PCM编码为请求的格式"""
+    if fmt == "mp3":
+        return bytes(pcm_arr_to_mp3_view(wav))
+    pcm = float_to_int16(wav.reshape(-1))
+    buf = io.BytesIO()
+    if fmt == "wav":
+        with wave.open(buf, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(pcm.tobytes())
+        return buf.getvalue()
+    with av.open(buf, "w", format=fmt) as container:
+        stream = container.add_stream(fmt, rate=sample_rate)
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(pcm[None, :], format="s16", layout="mono")
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buf.getvalue()
+
+def render_audio(chat: ChatTTS.Chat, params: ChatTTSParams) -> RenderResult:
+    """
+    推理并把每个索引编码为请求的格式，返回(各索引的音频数据, 音频总秒数, 未以EOS结束的索引)，
+    空文本对应None
+    """
+    # 设置音频种子：用请求自己的随机数生成器，多个实例并发推理时互不影响
+    if params.params_infer_code.manual_seed is not None:
+        params.params_infer_code.spk_emb = chat.sample_random_speaker(
+            params.params_infer_code.manual_seed
+        )
+
+    # 创建文本到索引的映射和非空文本列表
+    non_empty_texts = []
+    text_to_original_idx = {}
+    for i, text in enumerate(params.text):
+        if text and text.strip():
+            text_to_original_idx[len(non_empty_texts)] = i
+            non_empty_texts.append(text)
+    
+    logger.info(f"Processing {len(non_empty_texts)} non-empty texts out of {len(params.text)} total texts")
+    
+    # 文本处理
+    if params.params_refine_text and non_empty_texts:
+        text = chat.infer(
+            text=non_empty_texts, 
+            skip_refine_text=False, 
+            refine_text_only=True,
+            split_text=params.split_text,  # False时保持列表，与text一一对应
+        )
+        logger.info("Refined text: " + str(text))
+        if chat.context.get():
+            # 精炼文本时被中断（客户端断开），不再推理截断的文本
+            logger.info("Interrupted while refining text, skipping voice inference.")
+            return [None] * len(params.text), 0.0, list(text_to_original_idx.values())
+    else:
+        text = non_empty_texts
+
+    logger.info("Use speaker:")
+    logger.info(str(params.params_infer_code.spk_emb))
+
+    # 语音推理 - 只处理非空文本
+    if non_empty_texts:
+        logger.info("Start voice inference.")
+        wavs = chat.infer(
+            text=text,
+            stream=params.stream,
+            lang=params.lang,
+            skip_refine_text=params.skip_refine_text,
+            use_decoder=params.use_decoder,
+            do_text_normalization=params.do_text_normalization,
+            do_homophone_replacement=params.do_homophone_replacement,
+            split_text=params.split_text,
+            params_infer_code=params.params_infer_code,
+            params_refine_text=params.params_refine_text,
+            max_batch_tokens=MAX_BATCH_TOKENS,
+        )
+        logger.info("Inference completed.")
+    else:
+        wavs = []
+
+    # chat.unfinished 为截断句子在 text 中的下标；split_text 时所有句子拼成一个音频
+    unfinished = []
+    if non_empty_texts and params.split_text and chat.unfinished:
+        unfinished = list(text_to_original_idx.values())
+    elif non_empty_texts:
+        unfinished = [text_to_original_idx[i] for i in sorted(chat.unfinished) if i in text_to_original_idx]
+
+    encoded: List[Optional[bytes]] = [None] * len(params.text)
+    audio_seconds = 0.0
+    encode_start = time.perf_counter()
+    for wav_idx, original_idx in text_to_original_idx.items():
+        if wav_idx < len(wavs):  # 确保索引有效
+            audio_seconds += wavs[wav_idx].shape[-1] / SAMPLE_RATE
+            encoded[original_idx] = encode_audio(wavs[wav_idx], params.format)
+    if chat.observer is not None:
+        chat.observer(params.format + "_encode_seconds", time.perf_counter() - encode_start)
+    return encoded, audio_seconds, unfinished
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8004)
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="ChatTTS API server")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8004)
+    parser.add_argument("--cpu_workers", type=int, default=CPU_WORKERS,
+                        help="CPU prefork worker processes sharing one copy of the weights (0 = off)")
+    parser.add_argument("--synthesis_cache", type=str, default=SYNTHESIS_CACHE_DIR,
+                        help="Directory of the deduplicated synthesis cache (shared with clients)")
+    args = parser.parse_args()
+    CPU_WORKERS = args.cpu_workers
+    SYNTHESIS_CACHE_DIR = args.synthesis_cache
+
+    uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
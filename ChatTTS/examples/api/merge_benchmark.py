@@ -0,0 +1,203 @@
+"""
+对比 merge.py（pydub）与 merge_engine.py 的合并速度，以及不同中间格式的耗时和音质
+
+在临时目录里生成一个模拟项目（每个对话左右各若干句合成语音），
+按 --formats 中的每种格式保存片段，分别记录：
+- 片段编码耗时（相当于服务端为每句编码的 CPU 时间）；
+- merge_engine 合并耗时；
+- 最终立体声 MP3 相对原始 PCM 的信噪比（MP3 中间格式会经过两次有损编码）。
+merge.py 只支持 MP3 片段，需要 pydub 和 ffmpeg 可执行文件，缺少时跳过。
+
+    python merge_benchmark.py --dialogues 16 --sentences 10 --workers 4 --formats mp3,wav,flac
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import wave
+from typing import Dict, Tuple
+
+import av
+import numpy as np
+
+import merge_engine
+
+SAMPLE_RATE = merge_engine.SAMPLE_RATE
+
+# (对话序号, side, 句子序号) → 原始 PCM
+Reference = Dict[Tuple[int, str, int], np.ndarray]
+
+
+def encode_clip(pcm: np.ndarray, fmt: str, sample_rate: int = SAMPLE_RATE) -> bytes:
+    buf = io.BytesIO()
+    if fmt == "wav":
+        with wave.open(buf, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(pcm.tobytes())
+        return buf.getvalue()
+    with av.open(buf, "w", format=fmt) as container:
+        stream = container.add_stream(fmt, rate=sample_rate)
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(pcm[None, :], format="s16", layout="mono")
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buf.getvalue()
+
+
+def make_reference(dialogues: int, sentences: int, seed: int = 0) -> Reference:
+    """句长 1~5 秒，基频缓慢变化、带包络和噪声的谐波信号，接近语音的频谱"""
+    rng = np.random.default_rng(seed)
+    clips = {}
+    for d in range(dialogues):
+        for side in merge_engine.SIDES:
+            for j in range(sentences):
+                n = int(rng.uniform(1, 5) * SAMPLE_RATE)
+                t = np.arange(n) / SAMPLE_RATE
+                f0 = rng.uniform(100, 250) * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(1, 4) * t))
+                phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+                signal = sum(np.sin(k * phase) / k for k in range(1, 12))
+                envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(2, 5) * t) ** 2
+                signal = signal * envelope + 0.05 * rng.standard_normal(n)
+                clips[(d, side, j)] = (3000 * signal).astype(np.int16)
+    return clips
+
+
+def write_project(base_dir: str, reference: Reference, fmt: str) -> float:
+    """保存为 tts_test_<i>/{left,right}/<j>.<fmt>，返回编码耗时"""
+    seconds = 0.0
+    for (d, side, j), pcm in reference.items():
+        side_dir = os.path.join(base_dir, f"tts_test_{d}", side)
+        os.makedirs(side_dir, exist_ok=True)
+        start = time.perf_counter()
+        data = encode_clip(pcm, fmt)
+        seconds += time.perf_counter() - start
+        with open(os.path.join(side_dir, f"{j}.{fmt}"), "wb") as f:
+            f.write(data)
+    return seconds
+
+
+def reference_stereo(reference: Reference, dialogue: int, save_dir: str) -> np.ndarray:
+    """按 config.json 的时间轴摆放原始 PCM"""
+    with open(os.path.join(save_dir, f"tts_test_{dialogue}", "config.json"), "r", encoding="utf-8") as f:
+        segments = json.load(f)["audio_segments"]
+    counters = {side: 0 for side in merge_engine.SIDES}
+    total = int(round(segments[-1]["end_time_seconds"] * SAMPLE_RATE))
+    stereo = np.zeros((total, 2), dtype=np.int16)
+    for seg in segments:
+        pcm = reference[(dialogue, seg["role"], counters[seg["role"]])]
+        counters[seg["role"]] += 1
+        start = int(round(seg["start_time_seconds"] * SAMPLE_RATE))
+        n = min(len(pcm), total - start)
+        stereo[start : start + n, merge_engine.CHANNEL[seg["role"]]] = pcm[:n]
+    return stereo
+
+
+def decode_stereo(path: str) -> np.ndarray:
+    chunks = []
+    with av.open(path) as container:
+        resampler = av.AudioResampler(format="s16", layout="stereo", rate=SAMPLE_RATE)
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1, 2))
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1, 2))
+    return np.concatenate(chunks)
+
+
+def snr(reference: np.ndarray, decoded: np.ndarray) -> float:
+    n = min(len(reference), len(decoded))
+    ref = reference[:n].astype(np.float64)
+    noise = ref - decoded[:n].astype(np.float64)
+    return 10 * np.log10(np.sum(ref**2) / max(np.sum(noise**2), 1e-9))
+
+
+def end_times(save_dir: str):
+    result = {}
+    for name in os.listdir(save_dir):
+        with open(os.path.join(save_dir, name, "config.json"), "r", encoding="utf-8") as f:
+            segments = json.load(f)["audio_segments"]
+        result[name] = segments[-1]["end_time_seconds"] if segments else 0.0
+    return result
+
+
+def run_pydub(base_dir: str, save_dir: str, workers: int) -> float:
+    import merge
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        merge.merge_audio_files(base_dir, save_dir, None, max_workers=workers)
+    return time.perf_counter() - start
+
+
+def run_engine(base_dir: str, save_dir: str, workers: int, fmt: str = "mp3") -> float:
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        merge_engine.merge_audio_files(base_dir, save_dir, None, max_workers=workers, fmt=fmt)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark merge.py against merge_engine.py")
+    parser.add_argument("--dialogues", type=int, default=16)
+    parser.add_argument("--sentences", type=int, default=10, help="Sentences per side")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--formats", type=str, default="mp3,wav",
+                        help="Comma-separated clip formats to compare (mp3, wav, flac)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated projects")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="merge_benchmark_")
+    reference = make_reference(args.dialogues, args.sentences)
+    print(f"Project: {args.dialogues} dialogues x {2 * args.sentences} sentences in {root}")
+    per_dialogue = lambda seconds: f"{seconds / args.dialogues * 1000:8.1f} ms/dialogue"
+    try:
+        for fmt in args.formats.split(","):
+            base_dir = os.path.join(root, fmt, "project")
+            encode_seconds = write_project(base_dir, reference, fmt)
+            print(f"[{fmt}] clip encoding      {per_dialogue(encode_seconds)}")
+
+            if fmt == "mp3":
+                if shutil.which("ffmpeg") or shutil.which("avconv"):
+                    pydub_dir = os.path.join(root, fmt, "pydub")
+                    seconds = run_pydub(base_dir, pydub_dir, args.workers)
+                    print(f"[{fmt}] merge.py (pydub)   {per_dialogue(seconds)}")
+                else:
+                    pydub_dir = None
+                    print(f"[{fmt}] ffmpeg not found, skipping merge.py")
+
+            engine_dir = os.path.join(root, fmt, "engine")
+            seconds = run_engine(base_dir, engine_dir, args.workers, fmt)
+            print(f"[{fmt}] merge_engine.py    {per_dialogue(seconds)}")
+
+            ratios = [
+                snr(reference_stereo(reference, d, engine_dir), decode_stereo(
+                    os.path.join(engine_dir, f"tts_test_{d}", f"tts_test_{d}.mp3")
+                ))
+                for d in range(args.dialogues)
+            ]
+            print(f"[{fmt}] final MP3 SNR      {np.mean(ratios):8.1f} dB")
+
+            if fmt == "mp3" and pydub_dir:
+                old = end_times(pydub_dir)
+                new = end_times(engine_dir)
+                diff = max(abs(old[k] - new[k]) for k in new)
+                print(f"[{fmt}] max difference in dialogue length vs merge.py: {diff * 1000:.1f} ms")
+    finally:
+        if args.keep:
+            print(f"Kept {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
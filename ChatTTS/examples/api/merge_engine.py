@@ -0,0 +1,444 @@
+"""
+合并引擎：把 <tts_id>/{left,right}/<i>.<mp3|wav|flac> 合并为左右声道分离的立体声对话
+
+与 merge.py 的输出相同（<tts_id>/<tts_id>.mp3 和 config.json），区别在于：
+- 每个片段只在进程内用 PyAV 解码一次为 int16 PCM，不再为每个文件启动 ffmpeg；
+- 根据已知时长（项目清单 manifest.sqlite3，或 MP3 帧头）先算出每段的位置，
+  预分配整段对话的 (n, 2) 立体声缓冲区，解码结果逐帧写入左/右声道的视图，
+  不再生成中间的 AudioSegment 或声道平移后的副本；
+- 片段间的静音和交叉淡入淡出在 NumPy 中完成；
+- 客户端用 --format wav/flac 保存无损片段时，最终 MP3 只编码一次，没有二次有损压缩；
+  16 位单声道 WAV 直接按 PCM 读取，不经过解码器；
+- 合并结果一次编码写出：有 ffmpeg 可执行文件时通过管道交给一个 ffmpeg 进程
+  （pip 安装的 PyAV 自带的 LAME 明显更慢），否则用 PyAV 编码；
+- 对话之间用进程池并行。
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import io
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import wave
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import av
+import numpy as np
+from tqdm import tqdm
+
+from tts_client.audio import AUDIO_FORMATS, audio_duration
+from tts_client.manifest import DONE
+from tts_client.reader import DialogueIndex
+
+SAMPLE_RATE = 24000  # ChatTTS输出采样率
+BIT_RATE = None  # 默认使用编码器的码率，与 pydub 导出的结果一致
+FFMPEG = shutil.which("ffmpeg")
+SIDES = ("left", "right")
+CHANNEL = {"left": 0, "right": 1}
+
+# (side, index) → 秒
+Durations = Dict[Tuple[str, int], float]
+# 片段来源：文件路径，或内存中的 (数据, 时长)，时长为 None 时从数据计算
+Source = Union[str, Tuple[bytes, Optional[float]]]
+
+
+class Segment(NamedTuple):
+    role: str
+    index: int
+    source: Union[str, bytes]  # 文件路径或内存中的数据
+    start: int  # 在输出中的起始样本
+    length: int  # 样本数
+    fade: int  # 首尾淡入淡出的样本数
+    mix: int  # 开头与同一声道上一段重叠、需要叠加的样本数
+
+
+def extract_file_index(file_path: str):
+    """从文件路径中提取索引，不是数字时按文件名排序"""
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    try:
+        return 0, int(name), ""
+    except ValueError:
+        return 1, 0, name
+
+
+def format_time(seconds: float) -> str:
+    """格式化为 分:秒.毫秒"""
+    return f"{int(seconds // 60):02d}:{seconds % 60:06.3f}"
+
+
+def load_durations(base_dir: str) -> Dict[str, Tuple[Durations, Dict[Tuple[str, int], int]]]:
+    """从客户端写入的项目清单中读出每个片段的时长和大小，没有清单时返回空字典"""
+    path = os.path.join(base_dir, "manifest.sqlite3")
+    if not os.path.exists(path):
+        return {}
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = db.execute(
+            "SELECT tts_id, side, idx, size, duration FROM units WHERE status = ? AND duration IS NOT NULL",
+            (DONE,),
+        ).fetchall()
+    except sqlite3.DatabaseError as e:
+        print(f"Could not read manifest {path}: {e}")
+        return {}
+    finally:
+        db.close()
+    result: Dict[str, Tuple[Durations, Dict[Tuple[str, int], int]]] = {}
+    for tts_id, side, idx, size, duration in rows:
+        durations, sizes = result.setdefault(tts_id, ({}, {}))
+        durations[(side, idx)] = duration
+        sizes[(side, idx)] = size
+    return result
+
+
+def list_files(tts_dir: str, side: str, fmt: str = "mp3") -> List[str]:
+    return sorted(glob.glob(os.path.join(tts_dir, side, "*." + fmt)), key=extract_file_index)
+
+
+def plan_segments(
+    tts_dir: str,
+    known: Optional[Tuple[Durations, Dict[Tuple[str, int], int]]] = None,
+    sample_rate: int = SAMPLE_RATE,
+    gap: float = 0.0,
+    crossfade: float = 0.0,
+    fmt: str = "mp3",
+) -> Tuple[List[Segment], int]:
+    """
+    按 left0, right0, left1, right1 ... 的顺序排列片段（一侧用完后只取另一侧），
+    算出每段的起始样本和总样本数。相邻片段之间插入 gap 秒静音，
+    crossfade 秒时与上一段重叠并淡入淡出。清单中的时长只在文件大小一致时使用，
+    否则从文件头计算；无法解析的文件跳过。
+    """
+    durations, sizes = known or ({}, {})
+    clips = []
+    for side, i, path in interleave({side: list_files(tts_dir, side, fmt) for side in SIDES}):
+        index = extract_file_index(path)[1]
+        duration = durations.get((side, index))
+        if duration is None or sizes.get((side, index)) != os.path.getsize(path):
+            with open(path, "rb") as f:
+                duration = audio_duration(f.read(), fmt)
+        if duration is None:
+            print(f"Skipping unreadable file: {path}")
+            continue
+        clips.append((side, i, path, duration))
+    return layout(clips, sample_rate, gap, crossfade)
+
+
+def interleave(items: Dict[str, List[Any]]) -> List[Tuple[str, int, Any]]:
+    """按 left0, right0, left1, right1 ... 排列，一侧用完后只取另一侧"""
+    order = []
+    for i in range(max(len(v) for v in items.values())):
+        for side in SIDES:
+            if i < len(items[side]):
+                order.append((side, i, items[side][i]))
+    return order
+
+
+def layout(
+    clips: List[Tuple[str, int, Union[str, bytes], float]],
+    sample_rate: int = SAMPLE_RATE,
+    gap: float = 0.0,
+    crossfade: float = 0.0,
+) -> Tuple[List[Segment], int]:
+    """按顺序排列 (side, index, 来源, 时长)，返回各段位置和总样本数"""
+    gap_samples = int(round(gap * sample_rate))
+    fade_samples = int(round(crossfade * sample_rate))
+    segments = []
+    end = 0
+    channel_end = {side: 0 for side in SIDES}
+    for side, i, source, duration in clips:
+        length = int(round(duration * sample_rate))
+        fade = min(fade_samples, length // 2)
+        start = end if not segments else max(0, end + gap_samples - min(fade, segments[-1].fade))
+        mix = min(length, max(0, channel_end[side] - start))
+        segments.append(Segment(side, i, source, start, length, fade, mix))
+        end = max(end, start + length)
+        channel_end[side] = max(channel_end[side], start + length)
+    return segments, end
+
+
+def _open(source: Union[str, bytes]):
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+
+def _describe(seg: Segment) -> str:
+    return seg.source if isinstance(seg.source, str) else f"{seg.role} clip {seg.index}"
+
+
+def place(target: np.ndarray, pos: int, chunk: np.ndarray, seg: Segment):
+    """
+    把一块解码结果写入 target（该片段在输出中对应的单声道视图）的 pos 处：
+    首尾按 seg.fade 线性淡入淡出，与同一声道上一段重叠的部分饱和相加
+    """
+    k = len(chunk)
+    if seg.fade and (pos < seg.fade or pos + k > seg.length - seg.fade):
+        idx = np.arange(pos, pos + k)
+        gain = np.minimum(1.0, np.minimum(idx + 1, seg.length - idx) / seg.fade)
+        chunk = (chunk * gain).astype(np.int16)
+    m = min(k, max(0, seg.mix - pos))
+    if m:
+        mixed = target[pos : pos + m].astype(np.int32) + chunk[:m]
+        target[pos : pos + m] = np.clip(mixed, -32768, 32767)
+    target[pos + m : pos + k] = chunk[m:]
+
+
+def read_wav_into(seg: Segment, target: np.ndarray, sample_rate: int = SAMPLE_RATE) -> Optional[int]:
+    """16 位单声道、采样率一致的 WAV 直接按块读取 PCM；其他 WAV 返回 None，交给解码器"""
+    with wave.open(_open(seg.source), "rb") as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != 2 or f.getframerate() != sample_rate:
+            return None
+        pos = 0
+        while pos < seg.length:
+            chunk = np.frombuffer(f.readframes(min(65536, seg.length - pos)), dtype="<i2")
+            if not len(chunk):
+                break
+            place(target, pos, chunk, seg)
+            pos += len(chunk)
+    return pos
+
+
+def decode_into(seg: Segment, stereo: np.ndarray, sample_rate: int = SAMPLE_RATE) -> int:
+    """
+    逐帧解码为单声道 int16，直接写入 (n, 2) 输出缓冲区对应声道的跨步视图，
+    不生成中间的片段数组。返回写入的样本数，解码长度与帧头计算的时长
+    可能差几个样本，以预分配的长度为准
+    """
+    target = stereo[seg.start : seg.start + seg.length, CHANNEL[seg.role]]
+    is_wav = seg.source.endswith(".wav") if isinstance(seg.source, str) else seg.source[:4] == b"RIFF"
+    if is_wav:
+        written = read_wav_into(seg, target, sample_rate)
+        if written is not None:
+            return written
+    pos = 0
+    with av.open(_open(seg.source)) as container:
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+        for frame in itertools.chain(container.decode(audio=0), [None]):
+            for out in resampler.resample(frame):
+                chunk = out.to_ndarray()[0][: seg.length - pos]
+                if len(chunk):
+                    place(target, pos, chunk, seg)
+                    pos += len(chunk)
+    return pos
+
+
+def encode_stereo(
+    pcm: np.ndarray, output_file: str, sample_rate: int = SAMPLE_RATE, bit_rate: Optional[int] = BIT_RATE
+):
+    """把 (n, 2) int16 缓冲区一次编码为 MP3，交错数据直接作为输入，不再复制"""
+    if FFMPEG:
+        command = [FFMPEG, "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate), "-ac", "2"]
+        command += ["-i", "pipe:0"]
+        if bit_rate:
+            command += ["-b:a", str(bit_rate)]
+        command += ["-f", "mp3", output_file]
+        subprocess.run(command, input=memoryview(pcm).cast("B"), check=True)
+        return
+
+    with av.open(output_file, "w", format="mp3") as container:
+        stream = container.add_stream("mp3", rate=sample_rate)
+        stream.layout = "stereo"
+        if bit_rate:
+            stream.bit_rate = bit_rate
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format="s16", layout="stereo")
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+
+def process_directory(
+    tts_dir: str,
+    output_dir: str,
+    transcript: Optional[dict] = None,
+    known: Optional[Tuple[Durations, Dict[Tuple[str, int], int]]] = None,
+    sample_rate: int = SAMPLE_RATE,
+    bit_rate: Optional[int] = BIT_RATE,
+    gap: float = 0.0,
+    crossfade: float = 0.0,
+    fmt: str = "mp3",
+) -> str:
+    """合并单个对话目录，在进程池中执行"""
+    tts_dirname = os.path.basename(tts_dir)
+    segments, total = plan_segments(tts_dir, known, sample_rate, gap, crossfade, fmt)
+    return write_dialogue(tts_dirname, segments, total, output_dir, transcript, sample_rate, bit_rate)
+
+
+def merge_clips(
+    name: str,
+    sources: Dict[str, List[Optional[Source]]],
+    output_dir: str,
+    transcript: Optional[dict] = None,
+    fmt: str = "mp3",
+    sample_rate: int = SAMPLE_RATE,
+    bit_rate: Optional[int] = BIT_RATE,
+    gap: float = 0.0,
+    crossfade: float = 0.0,
+) -> str:
+    """
+    合并一个对话的片段，sources[side][i] 为第 i 句的来源，缺失的句子为 None。
+    客户端的融合模式在对话的最后一句返回后直接传入内存中的数据，不需要先写出每句的文件
+    """
+    clips = []
+    for side, i, source in interleave(sources):
+        if source is None:
+            continue
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                data, duration = source, audio_duration(f.read(), fmt)
+        else:
+            data, duration = source
+            if duration is None:
+                duration = audio_duration(data, fmt)
+        if duration is None:
+            print(f"Skipping unreadable {side} clip {i} of {name}")
+            continue
+        clips.append((side, i, data, duration))
+    segments, total = layout(clips, sample_rate, gap, crossfade)
+    return write_dialogue(name, segments, total, output_dir, transcript, sample_rate, bit_rate)
+
+
+def write_dialogue(
+    name: str,
+    segments: List[Segment],
+    total: int,
+    output_dir: str,
+    transcript: Optional[dict] = None,
+    sample_rate: int = SAMPLE_RATE,
+    bit_rate: Optional[int] = BIT_RATE,
+) -> str:
+    """
+    写出 <output_dir>/<name>/<name>.mp3 和 config.json，整个对话只占用一个输出缓冲区。
+    config.json 最后写入，存在即表示合并完成
+    """
+    transcript = transcript or {}
+    stereo = np.zeros((total, 2), dtype=np.int16)
+    audio_segments = []
+    for seg in segments:
+        try:
+            decode_into(seg, stereo, sample_rate)
+        except (av.error.FFmpegError, wave.Error, EOFError) as e:
+            # 没写入的部分保持静音，后面片段的时间不受影响
+            print(f"Error decoding {_describe(seg)}: {e}")
+
+        contents = transcript.get(seg.role) or []
+        start_time = seg.start / sample_rate
+        end_time = (seg.start + seg.length) / sample_rate
+        audio_segments.append(
+            {
+                "role": seg.role,
+                "content": contents[seg.index] if seg.index < len(contents) else "",
+                "start_time": format_time(start_time),
+                "end_time": format_time(end_time),
+                "start_time_seconds": start_time,
+                "end_time_seconds": end_time,
+            }
+        )
+
+    tts_output_dir = os.path.join(output_dir, name)
+    os.makedirs(tts_output_dir, exist_ok=True)
+    encode_stereo(stereo, os.path.join(tts_output_dir, f"{name}.mp3"), sample_rate, bit_rate)
+
+    config_data = {
+        "audio_segments": audio_segments,
+        "terminated_by_manager": False,
+        "end_call_signal_detected": False,
+        "termination_reason": "",
+        "terminator": "",
+    }
+    config_file = os.path.join(tts_output_dir, "config.json")
+    with open(config_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(config_data, f, ensure_ascii=False, indent=2)
+    os.replace(config_file + ".tmp", config_file)
+    return name
+
+
+def merge_audio_files(
+    base_dir: str,
+    save_dir: str,
+    transcript_file: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    pattern: str = "*",
+    bit_rate: Optional[int] = BIT_RATE,
+    gap: float = 0.0,
+    crossfade: float = 0.0,
+    fmt: str = "mp3",
+) -> List[str]:
+    """用进程池合并 base_dir 下所有匹配 pattern 的对话目录，返回成功处理的目录名"""
+    index = None
+    if transcript_file and os.path.exists(transcript_file):
+        index = DialogueIndex.open(transcript_file)
+        print(f"Loaded transcript index for {len(index)} tts IDs")
+    else:
+        print(f"Transcript file not found: {transcript_file}")
+
+    tts_dirs = sorted(d for d in glob.glob(os.path.join(base_dir, pattern)) if os.path.isdir(d))
+    print(f"Found {len(tts_dirs)} tts directories to process")
+    known = load_durations(base_dir)
+    os.makedirs(save_dir, exist_ok=True)
+
+    done = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for tts_dir in tts_dirs:
+            name = os.path.basename(tts_dir)
+            transcript = index.get(name) if index is not None else None
+            futures[
+                executor.submit(
+                    process_directory,
+                    tts_dir,
+                    save_dir,
+                    transcript,
+                    known.get(name),
+                    SAMPLE_RATE,
+                    bit_rate,
+                    gap,
+                    crossfade,
+                    fmt,
+                )
+            ] = tts_dir
+        with tqdm(total=len(futures), desc="Processing directories") as progress:
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    done.append(future.result())
+                except Exception as exc:
+                    print(f"{futures[future]} generated an exception: {exc}")
+                progress.update(1)
+    return done
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge per-sentence clips into stereo dialogues")
+    parser.add_argument("--base_dir", type=str, required=True, help="Project directory written by the TTS client")
+    parser.add_argument("--save_dir", type=str, required=True, help="Output directory")
+    parser.add_argument("--transcript_file", type=str, default=None, help="Input JSONL with left/right texts")
+    parser.add_argument("--pattern", type=str, default="*", help="Glob for dialogue directories in base_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--bit_rate", type=int, default=BIT_RATE, help="Output MP3 bit rate (default: encoder default)")
+    parser.add_argument("--format", type=str, choices=AUDIO_FORMATS, default="mp3",
+                        help="Format of the per-sentence clips (the client's --format)")
+    parser.add_argument("--gap_ms", type=int, default=0, help="Silence inserted between consecutive clips")
+    parser.add_argument("--crossfade_ms", type=int, default=0,
+                        help="Overlap consecutive clips and fade them in/out over this many milliseconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"Using {args.workers} worker processes")
+    merged = merge_audio_files(
+        args.base_dir,
+        args.save_dir,
+        args.transcript_file,
+        args.workers,
+        args.pattern,
+        args.bit_rate,
+        args.gap_ms / 1000,
+        args.crossfade_ms / 1000,
+        args.format,
+    )
+    print(f"All processing completed! {len(merged)} dialogues merged")
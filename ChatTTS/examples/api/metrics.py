@@ -0,0 +1,230 @@
+"""
+Prometheus 文本格式的指标，不依赖 prometheus_client 和 GPU
+
+ChatTTS.Chat 通过 observer(name, value) 上报各阶段耗时和计数，
+服务端在此基础上补充 MP3 编码、ZIP 打包、RTF、队列深度等指标。
+"""
+
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+RTF_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+PADDING_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8)
+
+# Chat.observer 上报的阶段名
+CHAT_STAGES = ("normalize", "refine", "gpt", "decoder", "vocos")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _format_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, value: float = 1.0, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in items
+        ]
+
+
+class Gauge(_Metric):
+    """取值时调用 collect()，返回 [(labels, value)]"""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help: str, collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]
+    ):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(tuple(sorted(labels.items())))} {_format_value(v)}"
+            for labels, v in self.collect()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Labels, List[float]] = {}  # 各桶计数 + [sum, count]
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0.0] * (len(self.buckets) + 2)
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.series.items()]
+        lines = self.header()
+        for labels, series in items:
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {_format_value(cumulative)}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {_format_value(series[-1])}"
+            )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(series[-1])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds: Histogram = registry.register(
+    Histogram(
+        "chattts_stage_seconds",
+        "Wall time spent in each synthesis stage.",
+        LATENCY_BUCKETS,
+    )
+)
+gpt_tokens_total: Counter = registry.register(
+    Counter("chattts_gpt_tokens_total", "Audio/text tokens generated by the GPT.")
+)
+gpt_tokens_per_second: Histogram = registry.register(
+    Histogram(
+        "chattts_gpt_tokens_per_second",
+        "GPT generation throughput per inference batch.",
+        RATE_BUCKETS,
+    )
+)
+batch_size: Histogram = registry.register(
+    Histogram(
+        "chattts_batch_size",
+        "Number of sentences per GPT inference batch.",
+        BATCH_BUCKETS,
+    )
+)
+padding_ratio: Histogram = registry.register(
+    Histogram(
+        "chattts_padding_ratio",
+        "Share of padding in each batch (prompt, gpt codes, decoder input).",
+        PADDING_BUCKETS,
+    )
+)
+empty_retries_total: Counter = registry.register(
+    Counter(
+        "chattts_empty_retries_total",
+        "Sentences whose first sampled token was EOS and was resampled.",
+    )
+)
+audio_seconds_total: Counter = registry.register(
+    Counter("chattts_audio_seconds_total", "Seconds of audio produced.")
+)
+synthesis_seconds_total: Counter = registry.register(
+    Counter(
+        "chattts_synthesis_seconds_total", "Wall seconds spent producing audio."
+    )
+)
+realtime_factor: Histogram = registry.register(
+    Histogram(
+        "chattts_realtime_factor",
+        "Audio seconds produced per wall second, per request.",
+        RTF_BUCKETS,
+    )
+)
+requests_total: Counter = registry.register(
+    Counter("chattts_requests_total", "Requests to /generate_voice by outcome.")
+)
+synthesis_cache_total: Counter = registry.register(
+    Counter("chattts_synthesis_cache_total", "Synthesis cache lookups by result.")
+)
+synthesis_cache_saved_seconds_total: Counter = registry.register(
+    Counter(
+        "chattts_synthesis_cache_saved_seconds_total",
+        "Inference seconds saved by synthesis cache hits.",
+    )
+)
+
+
+def observe_chat(name: str, value: float):
+    """作为 Chat.observer 使用，可在推理线程中调用"""
+    if name.endswith("_seconds"):
+        stage_seconds.observe(value, stage=name[: -len("_seconds")])
+    elif name == "gpt_tokens":
+        gpt_tokens_total.inc(value)
+    elif name == "gpt_tokens_per_second":
+        gpt_tokens_per_second.observe(value)
+    elif name == "batch_size":
+        batch_size.observe(value)
+    elif name == "empty_retries":
+        empty_retries_total.inc(value)
+    elif name.endswith("_padding_ratio"):
+        padding_ratio.observe(value, stage=name[: -len("_padding_ratio")])
+
+
+def observe_synthesis(audio_seconds: float, wall_seconds: float):
+    """记录一次请求产出的音频时长与耗时"""
+    audio_seconds_total.inc(audio_seconds)
+    synthesis_seconds_total.inc(wall_seconds)
+    if wall_seconds > 0:
+        realtime_factor.observe(audio_seconds / wall_seconds)
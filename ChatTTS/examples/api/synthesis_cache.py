@@ -0,0 +1,195 @@
+"""
+按内容寻址的合成缓存，服务端和客户端共用
+
+同一说话人、同一句话、同样的推理参数和种子只合成一次，之后直接从磁盘返回。
+键由规范化文本、说话人嵌入的哈希、影响合成结果的请求参数和种子计算得到；
+每条缓存旁边记录合成时消耗的推理秒数，用来统计命中节省的 GPU 时间。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from typing import Any, Dict, Optional, Tuple
+
+KEY_VERSION = 2
+
+# 影响合成结果的请求字段，其余字段（show_tqdm、stream_batch 等）不参与计算
+REQUEST_FIELDS = (
+    "lang",
+    "skip_refine_text",
+    "use_decoder",
+    "do_text_normalization",
+    "do_homophone_replacement",
+    "split_text",
+)
+# 请求体里可以省略、服务端有默认值的字段，省略时按默认值计算键
+REQUEST_DEFAULTS = {"split_text": True}
+INFER_CODE_FIELDS = (
+    "prompt",
+    "spk_smp",
+    "txt_smp",
+    "top_P",
+    "top_K",
+    "temperature",
+    "repetition_penalty",
+    "max_new_token",
+    "min_new_token",
+    "ensure_non_empty",
+)
+REFINE_TEXT_FIELDS = (
+    "prompt",
+    "top_P",
+    "top_K",
+    "temperature",
+    "repetition_penalty",
+    "max_new_token",
+    "min_new_token",
+    "ensure_non_empty",
+    "manual_seed",
+)
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角统一，合并连续空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def speaker_hash(spk_emb: Any) -> Optional[str]:
+    if spk_emb is None:
+        return None
+    if not isinstance(spk_emb, str):
+        spk_emb = json.dumps(spk_emb, separators=(",", ":"))
+    return hashlib.sha256(spk_emb.encode("utf-8")).hexdigest()
+
+
+def cacheable(body: Dict[str, Any]) -> bool:
+    """
+    只有每条文本对应一个音频时才能按句缓存：
+    流式请求、或 split_text 为真且有多条非空文本（服务端会拼接为一个音频）时不缓存
+    """
+    if body.get("stream") or body.get("refine_text_only"):
+        return False
+    texts = [t for t in body.get("text") or [] if t and t.strip()]
+    return len(texts) <= 1 or body.get("split_text", True) is False
+
+
+def _number(value: Any) -> Any:
+    """整数统一为浮点数：客户端发送的 1 与服务端校验后的 1.0 得到同一个键"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _fields(params: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+    return {k: _number(params.get(k)) for k in fields}
+
+
+def cache_key(text: str, body: Dict[str, Any], fmt: str = "mp3") -> str:
+    """body 为 /generate_voice 的请求体（dict），text 为其中的一条文本"""
+    infer_code = body.get("params_infer_code") or {}
+    refine_text = body.get("params_refine_text")
+    material = {
+        "version": KEY_VERSION,
+        "format": fmt,
+        "text": normalize_text(text),
+        "speaker": speaker_hash(infer_code.get("spk_emb")),
+        "seed": _number(infer_code.get("manual_seed")),
+        "request": _fields({**REQUEST_DEFAULTS, **body}, REQUEST_FIELDS),
+        "infer_code": _fields(infer_code, INFER_CODE_FIELDS),
+        # 服务端只要收到 params_refine_text 就会先润色文本
+        "refine_text": None if not refine_text else _fields(refine_text, REFINE_TEXT_FIELDS),
+    }
+    encoded = json.dumps(material, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class SynthesisCache:
+    """目录结构：<root>/<key[:2]>/<key>.<fmt> 与同名 .json 元数据"""
+
+    def __init__(self, root: str, fmt: str = "mp3"):
+        self.root = root
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.gpu_seconds_saved = 0.0
+        self.audio_seconds_saved = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key: str, fmt: Optional[str] = None) -> Optional[bytes]:
+        """命中时返回音频数据，并累计节省的推理时间"""
+        entry = self.lookup(key, fmt)
+        return None if entry is None else entry[0]
+
+    def lookup(self, key: str, fmt: Optional[str] = None) -> Optional[Tuple[bytes, float]]:
+        """命中时返回 (音频数据, 这条缓存节省的推理秒数)，fmt 默认为创建时的格式"""
+        path = self._path(key)
+        try:
+            with open(path + "." + (fmt or self.fmt), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        meta = self._read_meta(path)
+        with self.lock:
+            self.hits += 1
+            self.gpu_seconds_saved += meta.get("gpu_seconds", 0.0)
+            self.audio_seconds_saved += meta.get("audio_seconds", 0.0)
+        return data, meta.get("gpu_seconds", 0.0)
+
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        gpu_seconds: float = 0.0,
+        audio_seconds: float = 0.0,
+        fmt: Optional[str] = None,
+    ):
+        """原子写入，多个进程同时写同一个键时保留任意一份"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"gpu_seconds": gpu_seconds, "audio_seconds": audio_seconds}, f)
+        os.replace(tmp, path + ".json")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path + "." + (fmt or self.fmt))
+        with self.lock:
+            self.stores += 1
+
+    @staticmethod
+    def _read_meta(path: str) -> Dict[str, float]:
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "root": self.root,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / total if total else 0.0,
+                "gpu_seconds_saved": self.gpu_seconds_saved,
+                "audio_seconds_saved": self.audio_seconds_saved,
+            }
+
+
+def split_seconds(total: float, durations: Tuple[float, ...]) -> Tuple[float, ...]:
+    """按各句音频时长把一次请求的推理时间分摊到每句"""
+    audio = sum(durations)
+    if audio <= 0:
+        return tuple(total / len(durations) for _ in durations) if durations else ()
+    return tuple(total * d / audio for d in durations)
@@ -0,0 +1,4 @@
+from tts_client import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+"""
+JSONL 对话批量合成客户端
+
+    python examples/api/tts_batch_client.py --input_file dialogues.jsonl --port 8000
+
+读取 → 说话人分配 → 请求 → 写入 四个阶段通过有界队列连接，
+支持 --resume 断点续跑和 --shard i/N 多客户端分片处理同一输入文件。
+"""
+
+import os
+import sys
+
+# 与 main_new_new.py 一致：从 ChatTTS 根目录运行时可以导入 ChatTTS
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+from .cli import main, parse_args
@@ -0,0 +1,141 @@
+"""
+音频校验：按 MP3 帧头、WAV/FLAC 文件头计算时长，不依赖 ffmpeg
+"""
+
+from typing import Optional
+
+# 服务端可以返回的格式：mp3 有损；wav/flac 无损，合并时只编码一次
+AUDIO_FORMATS = ("mp3", "wav", "flac")
+
+# Layer III 码率表（kbps），按 MPEG 版本区分
+_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # MPEG1
+    0b10: (22050, 24000, 16000),  # MPEG2
+    0b00: (11025, 12000, 8000),  # MPEG2.5
+}
+
+# 服务端在推理失败时用 0.1 秒的空音频占位，非空文本的音频必须比它长
+MIN_SPEECH_SECONDS = 0.15
+
+
+def _skip_id3(data: bytes) -> int:
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size
+
+
+def _encoder_gap(frame: bytes) -> Optional[int]:
+    """从 Xing/Info 信息帧的 LAME 扩展中读出编码器延迟与末尾填充的样本数"""
+    for tag in (b"Xing", b"Info"):
+        i = frame.find(tag, 0, 64)
+        if i >= 0:
+            break
+    else:
+        return None
+    flags = int.from_bytes(frame[i + 4 : i + 8], "big")
+    lame = i + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    if len(frame) < lame + 24:
+        return 0
+    gap = int.from_bytes(frame[lame + 21 : lame + 24], "big")
+    return (gap >> 12) + (gap & 0xFFF)
+
+
+def mp3_duration(data: bytes) -> Optional[float]:
+    """逐帧读取 Layer III 帧头累加时长；数据被截断或不是 MP3 时返回 None"""
+    pos = _skip_id3(data)
+    end = len(data)
+    if data[-128:-125] == b"TAG":  # ID3v1
+        end -= 128
+    seconds = 0.0
+    frames = 0
+    while pos + 4 <= end:
+        header = int.from_bytes(data[pos : pos + 4], "big")
+        if header >> 21 != 0x7FF:
+            return None
+        version = (header >> 19) & 0b11
+        layer = (header >> 17) & 0b11
+        bitrate_index = (header >> 12) & 0xF
+        rate_index = (header >> 10) & 0b11
+        if version == 0b01 or layer != 0b01 or bitrate_index in (0, 15) or rate_index == 3:
+            return None
+        mpeg1 = version == 0b11
+        bitrate = _BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+        sample_rate = _SAMPLE_RATES[version][rate_index]
+        padding = (header >> 9) & 1
+        samples = 1152 if mpeg1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+        if pos + length > end:
+            return None
+        # 第一帧可能是不含音频的 Xing/Info 信息帧
+        gap = _encoder_gap(data[pos : pos + length]) if frames == 0 else None
+        if gap is None:
+            seconds += samples / sample_rate
+        else:
+            seconds -= gap / sample_rate
+        frames += 1
+        pos += length
+    if frames == 0:
+        return None
+    return seconds
+
+
+def wav_duration(data: bytes) -> Optional[float]:
+    """按 RIFF 块读取 fmt 和 data，data 块不完整时返回 None"""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    pos = 12
+    byte_rate = None
+    while pos + 8 <= len(data):
+        chunk_id = data[pos : pos + 4]
+        size = int.from_bytes(data[pos + 4 : pos + 8], "little")
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            byte_rate = int.from_bytes(data[body + 8 : body + 12], "little")
+        elif chunk_id == b"data":
+            if not byte_rate or body + size > len(data):
+                return None
+            return size / byte_rate
+        pos = body + size + (size & 1)
+    return None
+
+
+def flac_duration(data: bytes) -> Optional[float]:
+    """从 STREAMINFO 读出采样率和总样本数，元数据之后没有音频帧时返回 None"""
+    if data[:4] != b"fLaC" or len(data) < 42:
+        return None
+    info = int.from_bytes(data[18:26], "big")
+    sample_rate = info >> 44
+    total_samples = info & ((1 << 36) - 1)
+    pos = 4
+    while pos + 4 <= len(data):
+        header = data[pos]
+        pos += 4 + int.from_bytes(data[pos + 1 : pos + 4], "big")
+        if header & 0x80:  # 最后一个元数据块
+            break
+    if not sample_rate or data[pos : pos + 2] not in (b"\xff\xf8", b"\xff\xf9"):
+        return None
+    return total_samples / sample_rate
+
+
+def audio_duration(data: bytes, fmt: str = "mp3") -> Optional[float]:
+    if fmt == "wav":
+        return wav_duration(data)
+    if fmt == "flac":
+        return flac_duration(data)
+    return mp3_duration(data)
+
+
+def is_valid_audio(duration: Optional[float], text: str) -> bool:
+    """能完整解析，且非空文本的音频长于占位空音频"""
+    if duration is None:
+        return False
+    if not text or not text.strip():
+        return True
+    return duration >= MIN_SPEECH_SECONDS
@@ -0,0 +1,73 @@
+"""
+/generate_voice 请求体
+"""
+
+from typing import Any, List
+
+# spaced: 字与字之间加空格，跳过文本润色（FINAL_/NORMAL- 系列脚本）
+# raw:    保留原始文本（real_f_ 系列脚本，配合 --refine_text 使用）
+TEXT_STYLES = ("spaced", "raw")
+
+
+def prepare_text(text: str, style: str) -> str:
+    if style == "spaced":
+        return " ".join(list(text))
+    return text
+
+
+def build_body(
+    text: str, speaker_emb: Any, style: str = "spaced", refine_text: bool = False, fmt: str = "mp3"
+) -> dict:
+    """单个句子的请求体，fmt 为服务端返回的音频格式"""
+    body = {
+        "text": [prepare_text(text, style)],
+        "stream": False,
+        "lang": None,
+        "skip_refine_text": not refine_text,
+        "refine_text_only": False,
+        "use_decoder": True,
+        "do_text_normalization": True,
+        "do_homophone_replacement": False,
+        "format": fmt,
+    }
+
+    body["params_refine_text"] = {
+        "prompt": "",
+        "top_P": 0.7,
+        "top_K": 20,
+        "temperature": 0.7,
+        "repetition_penalty": 1,
+        "max_new_token": 384,
+        "min_new_token": 0,
+        "show_tqdm": True,
+        "ensure_non_empty": True,
+        "stream_batch": 24,
+    }
+
+    body["params_infer_code"] = {
+        "prompt": "[speed_5]",
+        "top_P": 0.1,
+        "top_K": 20,
+        "temperature": 0.3,
+        "repetition_penalty": 1.05,
+        "max_new_token": 2048,
+        "min_new_token": 0,
+        "show_tqdm": True,
+        "ensure_non_empty": True,
+        "stream_batch": True,
+        "spk_emb": speaker_emb,
+        "manual_seed": None,
+    }
+
+    return body
+
+
+def build_batch_body(
+    texts: List[str], speaker_emb: Any, style: str = "spaced", refine_text: bool = False, fmt: str = "mp3"
+) -> dict:
+    """同一说话人的多个句子合并为一个请求体，服务端按顺序返回 0.<fmt>、1.<fmt> ..."""
+    body = build_body("", speaker_emb, style, refine_text, fmt)
+    body["text"] = [prepare_text(text, style) for text in texts]
+    body["split_text"] = False  # 每句单独返回一个音频，不拼接
+    body["priority"] = "bulk"
+    return body
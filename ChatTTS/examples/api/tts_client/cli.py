@@ -0,0 +1,152 @@
+"""
+命令行入口，参数与原 FINAL_/NORMAL-/real_f_ 脚本兼容
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+from typing import Optional, Sequence
+
+from .audio import AUDIO_FORMATS
+from .bodies import TEXT_STYLES
+from .pipeline import Pipeline, wait_for_service_ready
+from .reader import parse_shard
+
+
+def _shard(value: str):
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def build_parser(**defaults) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Process text to speech using ChatTTS.')
+
+    parser.add_argument('--input_file', type=str, required=True,
+                        help='Input JSON file path')
+    parser.add_argument('--output_dir', type=str, default='./output',
+                        help='Base output directory (default: ./output)')
+    parser.add_argument('--project_name', type=str, default=None,
+                        help='Project name (default: derived from input filename)')
+    parser.add_argument('--host', type=str, default='localhost',
+                        help='ChatTTS service host (default: localhost)')
+    parser.add_argument('--port', type=str, default='8000',
+                        help='ChatTTS service port (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=300,
+                        help='Request timeout in seconds (default: 300)')
+    parser.add_argument('--max_retries', type=int, default=10,
+                        help='Retries for responses whose audio fails duration validation; other failures '
+                             'are retried until they succeed (default: 10)')
+    parser.add_argument('--initial_wait', type=int, default=5,
+                        help='Initial wait time between retries in seconds (default: 5)')
+    parser.add_argument('--max_wait', type=int, default=60,
+                        help='Maximum wait time between retries in seconds (default: 60)')
+    parser.add_argument('--concurrent_limit', type=int, default=5,
+                        help='Requests in flight across all dialogues (default: 5)')
+    parser.add_argument('--no_timestamp', action='store_true',
+                        help='Do not add timestamp to output directory')
+    parser.add_argument('--dialogue_batch', action='store_true',
+                        help='Send all sentences of one side of a dialogue in a single request')
+    parser.add_argument('--max_pending_dialogues', type=int, default=None,
+                        help='Dialogues read ahead of the request stage (default: 2 * concurrent_limit)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume processing from existing output directory')
+    parser.add_argument('--resume_dir', type=str, default=None,
+                        help='Specific directory to resume from (if --resume is set)')
+    parser.add_argument('--verify', action='store_true',
+                        help='On resume, compare checksums of finished files with the manifest '
+                             'instead of only their sizes')
+    parser.add_argument('--shard', type=_shard, default=None,
+                        help='Only process dialogue i of every N, given as i/N (0-based); '
+                             'use with --no_timestamp so all shards write to one project directory')
+    parser.add_argument('--text_style', type=str, choices=TEXT_STYLES, default='spaced',
+                        help='spaced: insert spaces between characters; raw: send text unchanged '
+                             '(default: %(default)s)')
+    parser.add_argument('--speaker_seed', type=int, default=None,
+                        help='Derive speakers from this seed and the tts_id so reruns get the same voices '
+                             '(default: random speakers)')
+    parser.add_argument('--refine_text', action=argparse.BooleanOptionalAction, default=False,
+                        help='Let the server refine the text before synthesis')
+    parser.add_argument('--format', type=str, choices=AUDIO_FORMATS, default='mp3',
+                        help='Audio format requested from the server; wav/flac keep the clips lossless '
+                             'so merge_engine.py encodes each dialogue only once (default: %(default)s)')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Synthesis cache directory; sentences already synthesized with the same speaker '
+                             'and parameters are reused instead of requested (can be shared with the server)')
+    parser.add_argument('--merge_dir', type=str, default=None,
+                        help='Merge each dialogue into <merge_dir>/<tts_id>/<tts_id>.mp3 and config.json as soon as '
+                             'its last sentence arrives, without writing per-sentence files (see --keep_clips)')
+    parser.add_argument('--keep_clips', action='store_true',
+                        help='With --merge_dir, also write the per-sentence files into the project directory')
+    parser.add_argument('--merge_workers', type=int, default=None,
+                        help='Processes merging dialogues with --merge_dir (default: number of CPUs)')
+    parser.add_argument('--bit_rate', type=int, default=None,
+                        help='Merged MP3 bit rate (default: encoder default)')
+    parser.add_argument('--gap_ms', type=int, default=0,
+                        help='Silence inserted between consecutive clips of a merged dialogue')
+    parser.add_argument('--crossfade_ms', type=int, default=0,
+                        help='Overlap consecutive clips of a merged dialogue and fade over this many milliseconds')
+
+    parser.set_defaults(**defaults)
+    return parser
+
+
+def parse_args(argv: Optional[Sequence[str]] = None, **defaults) -> argparse.Namespace:
+    return build_parser(**defaults).parse_args(argv)
+
+
+def get_project_name(args) -> str:
+    """获取项目名称，优先使用命令行参数指定的名称，否则从输入文件名派生"""
+    if args.project_name:
+        return args.project_name
+    file_name = os.path.basename(args.input_file)
+    return os.path.splitext(file_name)[0]
+
+
+def find_resume_dir(args, project_name: str) -> Optional[str]:
+    """--resume_dir 或 output_dir 下最新的同名项目目录"""
+    if args.resume_dir:
+        if not os.path.exists(args.resume_dir):
+            raise FileNotFoundError(f"Resume directory {args.resume_dir} does not exist!")
+        return args.resume_dir
+    if not os.path.exists(args.output_dir):
+        return None
+    matching_dirs = [
+        os.path.join(args.output_dir, item)
+        for item in os.listdir(args.output_dir)
+        if item.startswith(project_name) and os.path.isdir(os.path.join(args.output_dir, item))
+    ]
+    if not matching_dirs:
+        return None
+    return max(matching_dirs, key=os.path.getmtime)
+
+
+async def process_json_file(args):
+    status_url = f"http://{args.host}:{args.port}/status"
+    await wait_for_service_ready(status_url, args.initial_wait)
+
+    project_name = get_project_name(args)
+    project_dir = find_resume_dir(args, project_name) if args.resume else None
+    if project_dir:
+        print(f"Resuming from directory: {project_dir}")
+    else:
+        if args.resume:
+            print(f"No matching project directories found for {project_name}, continuing in normal mode...")
+        if args.no_timestamp:
+            project_dir = f"{args.output_dir}/{project_name}"
+        else:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            project_dir = f"{args.output_dir}/{project_name}_{timestamp}"
+        print(f"Project output directory: {project_dir}")
+    os.makedirs(project_dir, exist_ok=True)
+
+    # 目录已存在时（恢复，或多个分片共用一个目录）按文件检查已完成的部分
+    await Pipeline(args, project_dir, resume=args.resume or args.shard is not None).run()
+
+
+def main(argv: Optional[Sequence[str]] = None, **defaults):
+    """defaults 覆盖参数默认值，兼容脚本用它保留各自的端口和文本风格"""
+    args = parse_args(argv, **defaults)
+    asyncio.run(process_json_file(args))
@@ -0,0 +1,94 @@
+"""
+项目清单：记录每个 (tts_id, side, index) 的状态、大小、时长和校验和
+
+保存在项目目录下的 manifest.sqlite3，多个分片客户端可以同时写入。
+恢复时一次查询取出全部已完成的单元，只重新排队缺失或损坏的句子。
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+PENDING = "pending"
+DONE = "done"
+INVALID = "invalid"
+
+# (tts_id, side, index)
+UnitKey = Tuple[str, str, int]
+
+
+class UnitRecord(NamedTuple):
+    status: str
+    size: int
+    duration: Optional[float]
+    checksum: str
+
+
+def checksum(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+class Manifest:
+    def __init__(self, project_dir: str):
+        self.path = os.path.join(project_dir, "manifest.sqlite3")
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS units (
+                tts_id TEXT NOT NULL,
+                side TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                size INTEGER,
+                duration REAL,
+                checksum TEXT,
+                updated_at REAL,
+                PRIMARY KEY (tts_id, side, idx)
+            )
+            """
+        )
+        self.db.commit()
+
+    def load(self) -> Dict[UnitKey, UnitRecord]:
+        """一次取出全部单元的记录"""
+        rows = self.db.execute("SELECT tts_id, side, idx, status, size, duration, checksum FROM units")
+        return {(row[0], row[1], row[2]): UnitRecord(*row[3:]) for row in rows}
+
+    def mark_pending(self, tts_id, side: str, indices: Iterable[int]):
+        now = time.time()
+        self.db.executemany(
+            """
+            INSERT INTO units (tts_id, side, idx, status, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (tts_id, side, idx) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+            """,
+            [(str(tts_id), side, i, PENDING, now) for i in indices],
+        )
+        self.db.commit()
+
+    def record(self, tts_id, side: str, index: int, data: bytes, duration: Optional[float], valid: bool):
+        """记录一个已写入的文件"""
+        self.record_many([(str(tts_id), side, index, data, duration, valid)])
+
+    def record_many(self, items: Iterable[Tuple[str, str, int, bytes, Optional[float], bool]]):
+        now = time.time()
+        self.db.executemany(
+            """
+            INSERT OR REPLACE INTO units (tts_id, side, idx, status, size, duration, checksum, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (str(tts_id), side, index, DONE if valid else INVALID, len(data), duration, checksum(data), now)
+                for tts_id, side, index, data, duration, valid in items
+            ],
+        )
+        self.db.commit()
+
+    def summary(self) -> Dict[str, int]:
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM units GROUP BY status"))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,487 @@
+"""
+对话处理流水线
+
+    读取 → 说话人分配 → 请求（N 个并发 worker）→ 写入 [→ 合并]
+
+各阶段之间用有界队列连接：请求阶段满负荷时上游自动暂停，
+一个对话的请求结束前后续对话的请求已经在排队，服务端不会在对话边界处空闲。
+指定 --merge_dir 时，对话的最后一句返回后立即在进程池中用内存中的片段合并为立体声，
+不再逐句写出文件（--keep_clips 时仍写出），也不需要事后再跑一遍 merge_engine.py。
+"""
+
+import asyncio
+import functools
+import json
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import aiohttp
+from tqdm.asyncio import tqdm
+
+from synthesis_cache import SynthesisCache, cache_key, cacheable, split_seconds
+
+from .audio import audio_duration, is_valid_audio
+from .bodies import build_batch_body, build_body
+from .manifest import DONE, Manifest, checksum
+from .reader import DialogueIndex, read_dialogues
+from .speakers import DialogueSpeakers, load_query
+
+SIDES = ("left", "right")
+
+
+def output_path(base_dir: str, side: str, index: int, fmt: str = "mp3") -> str:
+    return f"{base_dir}/{side}/{index}.{fmt}"
+
+
+class Dialogue:
+    """一个对话的处理状态"""
+
+    def __init__(self, position: int, data: dict, project_dir: str, fmt: str = "mp3"):
+        self.position = position
+        self.fmt = fmt
+        self.tts_id = data["tts_id"]
+        self.texts: Dict[str, List[str]] = {side: data[side] for side in SIDES}
+        self.base_dir = f"{project_dir}/{self.tts_id}"
+        self.speakers: Dict[str, Any] = {}
+        self.missing: Dict[str, List[int]] = {side: [] for side in SIDES}
+        self.pending = 0  # 尚未写入的请求数
+        # 融合模式下等待合并的片段：side → {句子序号: Clip}
+        self.clips: Dict[str, Dict[int, "Clip"]] = {side: {} for side in SIDES}
+
+    def output_path(self, side: str, index: int) -> str:
+        return output_path(self.base_dir, side, index, self.fmt)
+
+    @property
+    def query_file(self) -> str:
+        return f"{self.base_dir}/query.jsonl"
+
+
+class Unit:
+    """一次 /generate_voice 请求：某个对话某一侧的若干句子"""
+
+    def __init__(self, dialogue: Dialogue, side: str, indices: List[int]):
+        self.dialogue = dialogue
+        self.side = side
+        self.indices = indices
+
+    @property
+    def name(self) -> str:
+        if len(self.indices) == 1:
+            return f"{self.dialogue.tts_id}/{self.side}/{self.indices[0]}"
+        return f"{self.dialogue.tts_id}/{self.side}"
+
+
+class Clip(NamedTuple):
+    data: bytes
+    duration: Optional[float]
+    valid: bool
+
+
+def read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def retry_wait_time(retry_count: int, args) -> float:
+    return min(args.initial_wait * (2 ** min(retry_count, 6)), args.max_wait)
+
+
+async def wait_for_service_ready(status_url: str, initial_wait: float):
+    """等待服务准备就绪"""
+    print("Waiting for service to be ready...")
+    while True:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(status_url, timeout=10) as response:
+                    if response.status == 200:
+                        status = await response.json()
+                        if len(status.get("instances", {})) > 0:
+                            print("Service is ready!")
+                            return
+        except Exception as e:
+            print(f"Service not ready yet: {e}")
+        print(f"Waiting {initial_wait} seconds before next check...")
+        await asyncio.sleep(initial_wait)
+
+
+class Pipeline:
+    def __init__(self, args, project_dir: str, resume: bool = False):
+        self.args = args
+        self.project_dir = project_dir
+        self.resume = resume
+        self.url = f"http://{args.host}:{args.port}/generate_voice"
+        self.speakers = DialogueSpeakers(args.speaker_seed)
+        self.manifest = Manifest(project_dir)
+        # 恢复时一次读出清单中的全部记录
+        self.records = self.manifest.load() if resume else {}
+        # 与服务端共用同一个目录时，服务端写入的句子客户端也能直接命中
+        self.cache = SynthesisCache(args.cache_dir, args.format) if args.cache_dir else None
+        depth = 2 * args.concurrent_limit
+        self.dialogues: asyncio.Queue = asyncio.Queue(args.max_pending_dialogues or depth)
+        self.units: asyncio.Queue = asyncio.Queue(depth)
+        self.results: asyncio.Queue = asyncio.Queue(depth)
+        self.progress: Optional[tqdm] = None
+        self.completed = 0
+        self.skipped = 0
+        # 融合模式：对话完成后在进程池中合并，同时进行的合并数有上限，避免片段在内存中堆积
+        self.merger: Optional[ProcessPoolExecutor] = None
+        self.merging: Set[asyncio.Task] = set()
+        self.write_clips = True
+        if args.merge_dir:
+            import merge_engine  # 依赖 av 和 numpy，只在融合模式下导入
+
+            self.merge_clips = functools.partial(
+                merge_engine.merge_clips,
+                output_dir=args.merge_dir,
+                fmt=args.format,
+                bit_rate=args.bit_rate,
+                gap=args.gap_ms / 1000,
+                crossfade=args.crossfade_ms / 1000,
+            )
+            self.merger = ProcessPoolExecutor(args.merge_workers)
+            self.merge_slots = asyncio.Semaphore(2 * (args.merge_workers or os.cpu_count() or 1))
+            self.write_clips = bool(args.keep_clips)
+            os.makedirs(args.merge_dir, exist_ok=True)
+
+    async def run(self):
+        self.progress = tqdm(desc="Processing JSON objects")
+        timeout = aiohttp.ClientTimeout(total=self.args.timeout)
+        conn = aiohttp.TCPConnector(limit=self.args.concurrent_limit)
+        async with aiohttp.ClientSession(timeout=timeout, connector=conn) as session:
+            workers = [
+                asyncio.ensure_future(self.request_stage(session))
+                for _ in range(self.args.concurrent_limit)
+            ]
+            writer = asyncio.ensure_future(self.writer_stage())
+            try:
+                await asyncio.gather(self.reader_stage(), self.speaker_stage())
+                for _ in workers:
+                    await self.units.put(None)
+                await asyncio.gather(*workers)
+                await self.results.put(None)
+                await writer
+                if self.merging:
+                    await asyncio.gather(*self.merging)
+            finally:
+                for task in workers + [writer] + list(self.merging):
+                    task.cancel()
+                if self.merger is not None:
+                    self.merger.shutdown()
+                self.progress.close()
+                summary = self.manifest.summary()
+                self.manifest.close()
+        print(f"All processing completed! {self.completed} dialogues processed, {self.skipped} already complete")
+        print(f"Manifest {self.manifest.path}: {summary}")
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"Synthesis cache {stats['root']}: {stats['hits']} hits, {stats['misses']} misses "
+                  f"(hit rate {stats['hit_rate']:.1%}), {stats['gpu_seconds_saved']:.1f} GPU seconds saved")
+
+    async def reader_stage(self):
+        """读取阶段：按分片读取对话"""
+        try:
+            if self.resume:
+                await self.read_indexed()
+            else:
+                for position, data in read_dialogues(self.args.input_file, self.args.shard):
+                    await self.dialogues.put(Dialogue(position, data, self.project_dir, self.args.format))
+        finally:
+            await self.dialogues.put(None)
+
+    async def read_indexed(self):
+        """恢复时按索引检查各对话，只读取和解析未完成的对话"""
+        index = DialogueIndex.open(self.args.input_file)
+        for tts_id, entry in index.in_order(self.args.shard):
+            base_dir = f"{self.project_dir}/{tts_id}"
+            if self.args.merge_dir:
+                finished = self.is_merged(tts_id)
+            else:
+                finished = os.path.exists(f"{base_dir}/query.jsonl") and all(
+                    self.is_recorded(base_dir, tts_id, side, i)
+                    for side, count in zip(SIDES, (entry.left, entry.right))
+                    for i in range(count)
+                )
+            if finished:
+                self.skipped += 1
+                self.progress.update(1)
+                continue
+            await self.dialogues.put(Dialogue(entry.position, index.load(entry), self.project_dir, self.args.format))
+
+    def is_merged(self, tts_id) -> bool:
+        """融合模式下合并结果的 config.json 最后写入，存在即表示对话已完成"""
+        return bool(self.args.merge_dir) and os.path.exists(f"{self.args.merge_dir}/{tts_id}/config.json")
+
+    def is_recorded(self, base_dir: str, tts_id, side: str, index: int) -> bool:
+        """清单中记录为完成，且文件大小（--verify 时还有校验和）与记录一致"""
+        record = self.records.get((str(tts_id), side, index))
+        if record is None or record.status != DONE:
+            return False
+        path = output_path(base_dir, side, index, self.args.format)
+        if not self.args.verify:
+            return os.path.exists(path) and os.path.getsize(path) == record.size
+        data = read_file(path)
+        return data is not None and checksum(data) == record.checksum
+
+    def find_missing(self, dialogue: Dialogue, side: str) -> List[int]:
+        """返回需要重新合成的句子；没有清单记录的已有文件（旧项目）按解码时长校验后补记"""
+        missing = []
+        adopted = []
+        for i, text in enumerate(dialogue.texts[side]):
+            if self.is_recorded(dialogue.base_dir, dialogue.tts_id, side, i):
+                continue
+            if (str(dialogue.tts_id), side, i) not in self.records:
+                data = read_file(dialogue.output_path(side, i))
+                if data is not None:
+                    duration = audio_duration(data, dialogue.fmt)
+                    if is_valid_audio(duration, text):
+                        adopted.append((dialogue.tts_id, side, i, data, duration, True))
+                        continue
+            missing.append(i)
+        if adopted:
+            self.manifest.record_many(adopted)
+        return missing
+
+    async def speaker_stage(self):
+        """说话人分配阶段：确定说话人和需要合成的句子，写出 query.jsonl 并生成请求"""
+        while True:
+            dialogue = await self.dialogues.get()
+            if dialogue is None:
+                return
+            try:
+                units = self.assign(dialogue)
+            except Exception as e:
+                print(f"Error processing tts_id {dialogue.tts_id}: {e}")
+                continue
+            if not units:
+                if self.merger is not None and not self.is_merged(dialogue.tts_id):
+                    # 片段都已存在但还没有合并（例如上次中断在合并阶段）
+                    await self.start_merge(dialogue)
+                    continue
+                self.skipped += 1
+                self.progress.update(1)
+                continue
+            dialogue.pending = len(units)
+            for unit in units:
+                await self.units.put(unit)
+
+    def assign(self, dialogue: Dialogue) -> List[Unit]:
+        args = self.args
+        query = load_query(dialogue.query_file) if self.resume else None
+        if query and query.get("left_speaker") and query.get("right_speaker"):
+            dialogue.speakers = {side: query[side + "_speaker"] for side in SIDES}
+            for side in SIDES:
+                dialogue.missing[side] = self.find_missing(dialogue, side)
+            if not any(dialogue.missing.values()):
+                return []
+            print(f"Resuming tts_id {dialogue.tts_id}: "
+                  + ", ".join(f"{len(dialogue.missing[s])} missing {s} files" for s in SIDES))
+        else:
+            # 没有记录说话人时整段重新生成，避免同一侧出现两种声音
+            dialogue.speakers = dict(zip(SIDES, self.speakers.sample_pair(dialogue.tts_id)))
+            for side in SIDES:
+                dialogue.missing[side] = list(range(len(dialogue.texts[side])))
+
+        os.makedirs(dialogue.base_dir, exist_ok=True)
+        if self.write_clips:
+            for side in SIDES:
+                os.makedirs(f"{dialogue.base_dir}/{side}", exist_ok=True)
+
+        # 请求体只取决于文本和说话人，先写出 query.jsonl，中断后恢复时可沿用说话人；
+        # 已有的音频保留原来记录的请求体
+        query_data = {
+            "left_speaker": dialogue.speakers["left"],
+            "right_speaker": dialogue.speakers["right"],
+        }
+        for side in SIDES:
+            queries = list((query or {}).get(side + "_queries") or [])
+            queries += [None] * (len(dialogue.texts[side]) - len(queries))
+            for i in dialogue.missing[side]:
+                queries[i] = build_body(
+                    dialogue.texts[side][i], dialogue.speakers[side], args.text_style, args.refine_text, args.format
+                )
+            query_data[side + "_queries"] = queries[: len(dialogue.texts[side])]
+        with open(dialogue.query_file, "w", encoding="utf-8") as f:
+            json.dump(query_data, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+        units = []
+        for side in SIDES:
+            indices = dialogue.missing[side]
+            if not indices:
+                continue
+            self.manifest.mark_pending(dialogue.tts_id, side, indices)
+            if args.dialogue_batch:
+                units.append(Unit(dialogue, side, indices))
+            else:
+                units.extend(Unit(dialogue, side, [i]) for i in indices)
+        return units
+
+    def build_request(self, unit: Unit) -> dict:
+        args = self.args
+        speaker = unit.dialogue.speakers[unit.side]
+        texts = [unit.dialogue.texts[unit.side][i] for i in unit.indices]
+        if self.args.dialogue_batch:
+            return build_batch_body(texts, speaker, args.text_style, args.refine_text, args.format)
+        return build_body(texts[0], speaker, args.text_style, args.refine_text, args.format)
+
+    async def request_stage(self, session: aiohttp.ClientSession):
+        """请求阶段：每个 worker 同时只有一个请求在途"""
+        while True:
+            unit = await self.units.get()
+            if unit is None:
+                return
+            files = await self.cached_request(session, unit)
+            await self.results.put((unit, files))
+
+    async def cached_request(self, session: aiohttp.ClientSession, unit: Unit) -> List[Clip]:
+        """先查合成缓存，只请求未命中的句子，新合成的有效音频写回缓存"""
+        body = self.build_request(unit)
+        texts = [unit.dialogue.texts[unit.side][i] for i in unit.indices]
+        if self.cache is None or not cacheable(body):
+            return (await self.request(session, unit, body, texts))[0]
+
+        keys = [cache_key(t, body, self.args.format) if t.strip() else None for t in body["text"]]
+        clips: List[Optional[Clip]] = []
+        for key, text in zip(keys, texts):
+            data = self.cache.get(key) if key is not None else None
+            duration = audio_duration(data, self.args.format) if data is not None else None
+            valid = data is not None and is_valid_audio(duration, text)
+            clips.append(Clip(data, duration, valid) if valid else None)
+        misses = [k for k, clip in enumerate(clips) if clip is None]
+        if not misses:
+            return clips
+
+        miss_body = dict(body, text=[body["text"][k] for k in misses])
+        fresh, seconds = await self.request(session, unit, miss_body, [texts[k] for k in misses])
+        stored = [(keys[k], clip) for k, clip in zip(misses, fresh) if keys[k] is not None and clip.valid]
+        if stored:
+            shares = split_seconds(seconds, tuple(clip.duration for _, clip in stored))
+            for (key, clip), gpu_seconds in zip(stored, shares):
+                self.cache.put(key, clip.data, gpu_seconds, clip.duration)
+        for k, clip in zip(misses, fresh):
+            clips[k] = clip
+        return clips
+
+    async def request(
+        self, session: aiohttp.ClientSession, unit: Unit, body: dict, texts: List[str]
+    ) -> Tuple[List[Clip], float]:
+        """
+        发送请求并解出 zip 中的各个音频，无限重试直到成功；
+        音频时长校验失败时最多重试 max_retries 次，之后按无效记录。
+        同时返回服务端报告的推理秒数
+        """
+        retry_count = 0
+        invalid_count = 0
+        while True:
+            wait_time = None
+            try:
+                async with session.post(self.url, json=body) as response:
+                    if response.status != 200:
+                        error_text = await response.text()
+                        print(f"Request {unit.name} failed with status {response.status}: {error_text}")
+                        if response.status == 429 and "Retry-After" in response.headers:
+                            wait_time = float(response.headers["Retry-After"])
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+                    content = await response.read()
+                    seconds = float(response.headers.get("X-Synthesis-Seconds", 0))
+                with zipfile.ZipFile(BytesIO(content), "r") as zip_ref:
+                    files = [zip_ref.read(f"{k}.{self.args.format}") for k in range(len(texts))]
+                clips = []
+                for data, text in zip(files, texts):
+                    duration = audio_duration(data, self.args.format)
+                    clips.append(Clip(data, duration, is_valid_audio(duration, text)))
+                if all(clip.valid for clip in clips) or invalid_count >= self.args.max_retries:
+                    return clips, seconds
+                invalid_count += 1
+                print(f"Request {unit.name} returned invalid audio "
+                      f"(durations {[c.duration for c in clips]}), retrying...")
+
+            except (zipfile.BadZipFile, KeyError):
+                print(f"Request {unit.name} returned invalid zip content, retrying...")
+            except asyncio.TimeoutError:
+                print(f"Request {unit.name} timed out after {self.args.timeout} seconds")
+            except aiohttp.ClientResponseError:
+                pass
+            except aiohttp.ClientError as e:
+                print(f"Network error for request {unit.name}: {str(e)}")
+            except Exception as e:
+                print(f"Unexpected error for request {unit.name}: {str(e)}")
+
+            retry_count += 1
+            if wait_time is None:
+                wait_time = retry_wait_time(retry_count, self.args)
+            print(f"Waiting {wait_time} seconds before retry...")
+            await asyncio.sleep(wait_time)
+
+    async def writer_stage(self):
+        """写入阶段：保存音频（融合模式下暂存在内存中），对话的全部请求完成后更新进度或开始合并"""
+        while True:
+            item = await self.results.get()
+            if item is None:
+                return
+            unit, clips = item
+            dialogue = unit.dialogue
+            written = []
+            try:
+                for index, clip in zip(unit.indices, clips):
+                    if self.merger is not None:
+                        dialogue.clips[unit.side][index] = clip
+                    if self.write_clips:
+                        with open(dialogue.output_path(unit.side, index), "wb") as target:
+                            target.write(clip.data)
+                    written.append((dialogue.tts_id, unit.side, index, clip.data, clip.duration, clip.valid))
+            except OSError as e:
+                print(f"Error writing {unit.name}: {e}")
+            self.manifest.record_many(written)
+            dialogue.pending -= 1
+            if dialogue.pending == 0:
+                if self.merger is not None:
+                    await self.start_merge(dialogue)
+                    continue
+                self.complete(dialogue)
+
+    def complete(self, dialogue: Dialogue):
+        self.completed += 1
+        self.progress.update(1)
+        print(f"Successfully completed processing for tts_id: {dialogue.tts_id}")
+
+    async def start_merge(self, dialogue: Dialogue):
+        """
+        合并阶段：本次返回的片段直接取内存中的数据和时长，恢复时已有的片段从文件读取。
+        合并在进程池中进行，写入阶段不等待合并结束
+        """
+        await self.merge_slots.acquire()
+        sources = {}
+        for side in SIDES:
+            sources[side] = []
+            for i in range(len(dialogue.texts[side])):
+                clip = dialogue.clips[side].get(i)
+                path = dialogue.output_path(side, i)
+                if clip is not None:
+                    sources[side].append((clip.data, clip.duration))
+                elif os.path.exists(path):
+                    sources[side].append(path)
+                else:
+                    sources[side].append(None)
+        dialogue.clips = {side: {} for side in SIDES}
+        task = asyncio.ensure_future(self.merge_stage(dialogue, sources))
+        self.merging.add(task)
+        task.add_done_callback(self.merging.discard)
+
+    async def merge_stage(self, dialogue: Dialogue, sources: dict):
+        merge = functools.partial(self.merge_clips, str(dialogue.tts_id), sources, transcript=dialogue.texts)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.merger, merge)
+            self.complete(dialogue)
+        except Exception as e:
+            print(f"Error merging tts_id {dialogue.tts_id}: {e}")
+        finally:
+            self.merge_slots.release()
@@ -0,0 +1,207 @@
+"""
+读取阶段：流式解析输入文件中的对话，并按分片过滤
+
+输入文件是若干个拼接在一起的 JSON 对象，可能一行一个、跨多行，也可能多个挤在同一行。
+这里按字节扫描对象边界，内存占用与文件大小无关；同时为每个 tts_id 记录
+(序号, 字节偏移, 长度, 左右句子数)，保存为输入文件旁的 .index.json，
+恢复时按 tts_id 直接定位，不再重新解析整个文件。
+"""
+
+import json
+import os
+import re
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# (分片编号, 分片总数)
+Shard = Tuple[int, int]
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 1 << 20
+
+# 对象边界只取决于这几个 ASCII 字符，它们不会出现在 UTF-8 多字节字符内部
+_TOKEN = re.compile(rb'[{}"\\]')
+
+
+def parse_shard(value: str) -> Shard:
+    """解析 --shard i/N，i 从 0 开始"""
+    try:
+        index, total = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard {value!r}, expected i/N")
+    if total <= 0 or not 0 <= index < total:
+        raise ValueError(f"invalid shard {value!r}, expected 0 <= i < N")
+    return index, total
+
+
+def in_shard(position: int, shard: Optional[Shard]) -> bool:
+    return shard is None or position % shard[1] == shard[0]
+
+
+def scan_records(input_file: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, bytes]]:
+    """依次返回 (字节偏移, 对象原始字节)，只保留当前未结束的对象在内存中"""
+    with open(input_file, "rb") as f:
+        buf = b""
+        buf_start = 0  # buf[0] 在文件中的偏移
+        pos = 0
+        depth = 0
+        in_str = False
+        start = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf += chunk
+            while True:
+                m = _TOKEN.search(buf, pos)
+                if m is None:
+                    pos = max(pos, len(buf))
+                    break
+                c = buf[m.start()]
+                pos = m.end()
+                if in_str:
+                    if c == 0x5C:  # 反斜杠：跳过被转义的字符
+                        pos += 1
+                    elif c == 0x22:
+                        in_str = False
+                elif c == 0x7B:
+                    if depth == 0:
+                        start = m.start()
+                    depth += 1
+                elif depth == 0:
+                    continue  # 对象之外的杂散字符
+                elif c == 0x22:
+                    in_str = True
+                elif c == 0x7D:
+                    depth -= 1
+                    if depth == 0:
+                        yield buf_start + start, buf[start:pos]
+            # 丢弃已经扫描完的部分
+            keep = start if depth > 0 else min(pos, len(buf))
+            buf = buf[keep:]
+            buf_start += keep
+            pos -= keep
+            start -= keep
+
+
+def iter_records(input_file: str) -> Iterator[Tuple[int, int, int, dict]]:
+    """依次返回 (对话序号, 字节偏移, 长度, 对话数据)，跳过无法解析的对象"""
+    position = 0
+    for offset, raw in scan_records(input_file):
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON object at byte {offset}: {e}")
+            print(f"Problematic JSON string: {raw[:200]!r}")
+            continue
+        yield position, offset, len(raw), data
+        position += 1
+
+
+def read_dialogues(input_file: str, shard: Optional[Shard] = None) -> Iterator[Tuple[int, dict]]:
+    """
+    依次返回 (对话在文件中的序号, 对话数据)
+    指定分片时只返回序号 % N == i 的对话，多个客户端可以用不同的分片处理同一个文件
+    """
+    for position, _, _, data in iter_records(input_file):
+        if in_shard(position, shard):
+            yield position, data
+
+
+class IndexEntry(NamedTuple):
+    position: int
+    offset: int
+    length: int
+    left: int  # 左侧句子数
+    right: int  # 右侧句子数
+
+
+class DialogueIndex:
+    """tts_id → 对话在输入文件中的位置，输入文件变化时自动重建"""
+
+    def __init__(
+        self, input_file: str, entries: Dict[str, IndexEntry], signature: Optional[List[int]] = None
+    ):
+        self.input_file = input_file
+        self.entries = entries
+        self.signature = signature or self._signature(input_file)
+
+    @staticmethod
+    def index_path(input_file: str) -> str:
+        return input_file + ".index.json"
+
+    @staticmethod
+    def _signature(input_file: str) -> List[int]:
+        st = os.stat(input_file)
+        return [st.st_size, st.st_mtime_ns]
+
+    @classmethod
+    def open(cls, input_file: str) -> "DialogueIndex":
+        """读取已保存的索引，不存在或已过期时扫描一遍输入文件重建"""
+        index_file = cls.index_path(input_file)
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved["version"] == INDEX_VERSION and saved["signature"] == cls._signature(input_file):
+                entries = {k: IndexEntry(*v) for k, v in saved["entries"].items()}
+                return cls(input_file, entries, saved["signature"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        index = cls.build(input_file)
+        index.save()
+        return index
+
+    @classmethod
+    def build(cls, input_file: str) -> "DialogueIndex":
+        signature = cls._signature(input_file)
+        entries = {}
+        for position, offset, length, data in iter_records(input_file):
+            try:
+                entries[str(data["tts_id"])] = IndexEntry(
+                    position, offset, length, len(data["left"]), len(data["right"])
+                )
+            except (KeyError, TypeError) as e:
+                print(f"Skipping malformed dialogue at byte {offset}: {e}")
+        return cls(input_file, entries, signature)
+
+    def save(self):
+        """保存到输入文件旁，目录不可写时只在内存中使用"""
+        index_file = self.index_path(self.input_file)
+        try:
+            with open(index_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "version": INDEX_VERSION,
+                        "signature": self.signature,
+                        "entries": {k: list(v) for k, v in self.entries.items()},
+                    },
+                    f,
+                )
+            os.replace(index_file + ".tmp", index_file)
+        except OSError as e:
+            print(f"Could not save input index {index_file}: {e}")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, tts_id) -> bool:
+        return str(tts_id) in self.entries
+
+    def lookup(self, tts_id) -> Optional[IndexEntry]:
+        return self.entries.get(str(tts_id))
+
+    def in_order(self, shard: Optional[Shard] = None) -> Iterator[Tuple[str, IndexEntry]]:
+        """按文件中的顺序返回 (tts_id, 位置)"""
+        items = sorted(self.entries.items(), key=lambda item: item[1].position)
+        for tts_id, entry in items:
+            if in_shard(entry.position, shard):
+                yield tts_id, entry
+
+    def load(self, entry: IndexEntry) -> dict:
+        """按偏移读取并解析单个对话"""
+        with open(self.input_file, "rb") as f:
+            f.seek(entry.offset)
+            return json.loads(f.read(entry.length))
+
+    def get(self, tts_id) -> Optional[dict]:
+        entry = self.lookup(tts_id)
+        return None if entry is None else self.load(entry)
@@ -0,0 +1,49 @@
+"""
+说话人分配：新对话随机采样，恢复时沿用 query.jsonl 中记录的说话人
+"""
+
+import json
+import os
+import random
+import zlib
+from typing import Any, Optional, Tuple
+
+
+class DialogueSpeakers:
+    """
+    只依赖 spk_stat 的轻量采样器，不加载模型也不导入 torch
+    指定 seed 时同一个 tts_id 总是得到同样的说话人，分片和恢复都不影响结果
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        from ChatTTS.speaker_sampler import SpeakerSampler
+
+        self.sampler = SpeakerSampler()
+        self.seed = seed
+
+    def _seed(self, tts_id: Any, side: str, attempt: int) -> int:
+        if self.seed is None:
+            return random.randint(0, 2**32 - 1)
+        return zlib.crc32(f"{self.seed}:{tts_id}:{side}:{attempt}".encode("utf-8"))
+
+    def sample_pair(self, tts_id: Any) -> Tuple[str, str]:
+        """左右两侧使用不同的说话人"""
+        left_speaker = self.sampler.sample(self._seed(tts_id, "left", 0))
+        attempt = 0
+        right_speaker = self.sampler.sample(self._seed(tts_id, "right", attempt))
+        while right_speaker == left_speaker:
+            attempt += 1
+            right_speaker = self.sampler.sample(self._seed(tts_id, "right", attempt))
+        return left_speaker, right_speaker
+
+
+def load_query(query_file: str) -> Optional[dict]:
+    """读取对话目录下的 query.jsonl，不存在或损坏时返回 None"""
+    if not os.path.exists(query_file):
+        return None
+    try:
+        with open(query_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading speakers from {query_file}: {e}")
+        return None
@@ -0,0 +1,164 @@
+"""
+CPU 预 fork 推理进程
+
+父进程在 CPU 上加载一份模型，把权重移入共享内存后 fork 出 N 个推理进程。
+每个进程绑定一组 CPU 核心并按核心数设置 torch 线程数，各自独立持有 GIL，
+GPT 逐 token 循环、logits 处理和 MP3 编码不再在同一个解释器里互相阻塞。
+父进程中的 InstancePool 充当前端调度器，把请求分配给空闲进程。
+"""
+
+import os
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import torch
+
+import ChatTTS
+from ChatTTS.model import GPT
+
+# Chat 中需要放入共享内存的模块
+SHARED_MODULES = ("gpt", "embed", "dvae", "decoder", "vocos")
+
+# (每个索引的音频数据, 音频总秒数, 没有以 EOS 结束的索引)
+RenderResult = Tuple[List[Optional[bytes]], float, List[int]]
+
+
+class _EventContext(GPT.Context):
+    """由父进程通过 multiprocessing.Event 控制的中断标志"""
+
+    def __init__(self, event):
+        super().__init__()
+        self.event = event
+
+    def set(self, v: bool):
+        if v:
+            self.event.set()
+        else:
+            self.event.clear()
+
+    def get(self) -> bool:
+        return self.event.is_set()
+
+
+def share_chat_memory(chat: ChatTTS.Chat):
+    """把已加载模型的参数和缓冲区移入共享内存，fork 后各进程不再各自复制"""
+    for name in SHARED_MODULES:
+        module = getattr(chat, name, None)
+        if module is not None:
+            module.share_memory()
+
+
+def split_cores(n: int, cores: Optional[Sequence[int]] = None) -> List[List[int]]:
+    """把可用核心切成 n 段连续的子集，相邻编号的核心通常位于同一 socket"""
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))
+    cores = list(cores)
+    if n <= 0:
+        raise ValueError("worker count must be positive")
+    if n > len(cores):
+        # 核心不够时允许多个进程共用核心
+        return [[cores[i % len(cores)]] for i in range(n)]
+    size, extra = divmod(len(cores), n)
+    subsets = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        subsets.append(cores[start:end])
+        start = end
+    return subsets
+
+
+def _worker_main(
+    chat: ChatTTS.Chat,
+    conn: Connection,
+    interrupt_event,
+    cores: List[int],
+    render: Callable[[ChatTTS.Chat, Any], RenderResult],
+):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores)))
+
+    chat.context = _EventContext(interrupt_event)
+    events: List[Tuple[str, float]] = []
+    chat.observer = lambda name, value: events.append((name, value))
+
+    while True:
+        try:
+            params = conn.recv()
+        except EOFError:
+            break
+        if params is None:
+            break
+        del events[:]
+        try:
+            conn.send(("ok", render(chat, params), list(events)))
+        except Exception as e:
+            conn.send(("error", str(e), list(events)))
+    conn.close()
+
+
+class CpuWorker:
+    """父进程中代表一个推理进程，提供与 Chat 相同的 interrupt()"""
+
+    def __init__(
+        self,
+        id: int,
+        chat: ChatTTS.Chat,
+        render: Callable[[ChatTTS.Chat, Any], RenderResult],
+        cores: List[int],
+        observer: Optional[Callable[[str, float], None]] = None,
+    ):
+        ctx = mp.get_context("fork")
+        self.id = id
+        self.cores = cores
+        self.observer = observer
+        self.interrupt_event = ctx.Event()
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(chat, child_conn, self.interrupt_event, cores, render),
+            name="chattts-cpu-worker-" + str(id),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def render(self, params: Any) -> RenderResult:
+        """在推理进程中执行一次请求（阻塞，应在线程池中调用）"""
+        self.conn.send(params)
+        status, payload, events = self.conn.recv()
+        if self.observer is not None:
+            for name, value in events:
+                self.observer(name, value)
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def interrupt(self):
+        self.interrupt_event.set()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def start_cpu_workers(
+    chat: ChatTTS.Chat,
+    render: Callable[[ChatTTS.Chat, Any], RenderResult],
+    n: int,
+    observer: Optional[Callable[[str, float], None]] = None,
+    cores: Optional[Sequence[int]] = None,
+) -> List[CpuWorker]:
+    """共享 chat 的权重并 fork 出 n 个绑核的推理进程"""
+    share_chat_memory(chat)
+    return [
+        CpuWorker(i, chat, render, subset, observer)
+        for i, subset in enumerate(split_cores(n, cores))
+    ]
@@ -0,0 +1,110 @@
+"""
+CPU 预 fork 推理进程的吞吐量随进程数的变化，不需要模型权重
+
+GPT 按默认配置随机初始化（同 examples/cmd/gpt_benchmark.py），放入共享内存后
+用 workers.start_cpu_workers 分别 fork 出 --workers 中的每种进程数。每个请求
+在推理进程中生成 --length 个 token（屏蔽 EOS），每个进程同时只处理一个请求，
+共发送 --requests_per_worker * 进程数 个请求，记录每秒完成的请求数。
+进程按 split_cores 绑核，核心数少于进程数时多个进程共用核心，吞吐量不会再增长。
+
+    python examples/api/workers_benchmark.py --workers 1,2,4 --length 64
+"""
+
+import os
+import sys
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cmd"))
+
+import argparse
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import torch
+
+import ChatTTS
+from gpt_benchmark import build_gpt, run
+from workers import start_cpu_workers
+
+# 每个请求：(prompt 长度, 生成 token 数, 种子)
+Request = Tuple[int, int, int]
+
+
+def render_request(chat: ChatTTS.Chat, request: Request):
+    """在推理进程中执行，返回与 render_audio 相同格式的 RenderResult"""
+    prompt, length, seed = request
+    run(chat.gpt, 1, prompt, length, seed)
+    return [None], 0.0, []
+
+
+def measure(chat: ChatTTS.Chat, n: int, args, cores: Optional[List[int]]) -> float:
+    """n 个推理进程处理全部请求的每秒请求数"""
+    workers = start_cpu_workers(chat, render_request, n, cores=cores)
+    try:
+        for worker in workers:
+            worker.render((args.prompt, 4, 0))  # 预热
+        requests = queue.Queue()
+        for i in range(args.requests_per_worker * n):
+            requests.put((args.prompt, args.length, i))
+
+        def drain(worker):
+            while True:
+                try:
+                    request = requests.get_nowait()
+                except queue.Empty:
+                    return
+                worker.render(request)
+
+        threads = [threading.Thread(target=drain, args=(w,)) for w in workers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return args.requests_per_worker * n / (time.perf_counter() - start)
+    finally:
+        for worker in workers:
+            worker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Requests/s of the CPU prefork workers on random weights"
+    )
+    parser.add_argument("--workers", type=str, default="1,2,4", help="Worker counts")
+    parser.add_argument(
+        "--length", type=int, default=64, help="Generated tokens per request"
+    )
+    parser.add_argument(
+        "--prompt", type=int, default=32, help="Prompt length in tokens"
+    )
+    parser.add_argument("--requests_per_worker", type=int, default=4)
+    parser.add_argument(
+        "--cores",
+        type=str,
+        default=None,
+        help="Cores to split between the workers (default: the process affinity)",
+    )
+    args = parser.parse_args()
+
+    cores = list(map(int, args.cores.split(","))) if args.cores else None
+    available = len(cores) if cores else len(os.sched_getaffinity(0))
+    # 父进程不做推理，避免在 fork 前初始化多线程计算
+    torch.set_num_threads(1)
+    chat = ChatTTS.Chat()
+    chat.gpt = build_gpt(False, torch.device("cpu"))
+
+    print(f"{available} cores, {args.length} tokens per request")
+    print(f"{'workers':>7} {'req/s':>8} {'speedup':>8}")
+    base = None
+    for n in map(int, args.workers.split(",")):
+        rate = measure(chat, n, args, cores)
+        base = base or rate
+        print(f"{n:>7} {rate:>8.3f} {rate / base:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+Benchmark GPT.generate tokens/s against sequence length, without model weights.
+
+The GPT is built from the default config with random weights and every
+sentence is forced to generate exactly --lengths tokens (EOS is masked via
+min_new_token), so the numbers only depend on the shapes.
+
+    python examples/cmd/gpt_benchmark.py --lengths 128,512,1024,2048 --batch 1,4
+
+With --sentences, fixed batches (Chat.infer slicing max_split_batch sentences
+at a time) are compared with GPT.generate_continuous on sentences whose
+lengths follow a skewed (geometric) distribution: each step every codebook
+row ends the sentence with probability --eos_rate.
+
+    python examples/cmd/gpt_benchmark.py --sentences 16 --batch 4 --eos_rate 0.003
+
+With --heads, the per-token latency of the code heads and embeddings (one
+call per codebook vs the stacked Embed.code_logits / Embed.code_embedding) is
+compared with the latency of a whole decode step.
+
+    python examples/cmd/gpt_benchmark.py --heads --batch 1,4
+
+With --sampling, the per-token cost of temperature + TopPLogitsWarper +
+TopKLogitsWarper + softmax + multinomial is compared with TopKTopPSampler, for
+the audio codes (batch * num_vq rows) and the text vocabulary (batch rows).
+
+    python examples/cmd/gpt_benchmark.py --sampling --batch 1,4,16
+"""
+
+import os, sys
+
+now_dir = os.getcwd()
+sys.path.append(now_dir)
+
+import argparse
+import logging
+import time
+from dataclasses import asdict
+
+import torch
+import torch.nn.utils.parametrize as P
+from transformers import LlamaModel
+from transformers.generation import TopKLogitsWarper, TopPLogitsWarper
+
+from ChatTTS.config import Config
+from ChatTTS.model import GPT, Embed
+from ChatTTS.model.processors import TopKTopPSampler
+
+# forced lengths always end with "incomplete result" warnings
+logger = logging.getLogger("gpt_benchmark")
+logger.setLevel(logging.ERROR)
+
+
+def build_gpt(use_static_cache: bool, device: torch.device) -> GPT:
+    torch.manual_seed(0)
+    config = Config()
+    embed = Embed(
+        config.embed.hidden_size,
+        config.embed.num_audio_tokens,
+        config.embed.num_text_tokens,
+        config.embed.num_vq,
+    ).to(device)
+    gpt = GPT(
+        gpt_config=asdict(config.gpt),
+        embed=embed,
+        use_static_cache=use_static_cache,
+        device=device,
+        device_gpt=device,
+        logger=logger,
+    )
+    gpt.gpt = LlamaModel(gpt.llama_config).to(device)
+    del gpt.gpt.embed_tokens
+    return gpt.eval()
+
+
+def run(gpt: GPT, batch: int, prompt: int, length: int, seed: int = 0):
+    """returns (seconds, generated ids)"""
+    device = gpt.device
+    generator = torch.Generator(device=device).manual_seed(seed)
+    emb = torch.randn(
+        batch, prompt, gpt.llama_config.hidden_size, generator=generator, device=device
+    )
+    inputs_ids = torch.randint(
+        0,
+        gpt.num_audio_tokens - 1,
+        (batch, prompt, gpt.num_vq),
+        generator=generator,
+        device=device,
+    )
+    start = time.perf_counter()
+    result = next(
+        gpt.generate(
+            emb,
+            inputs_ids,
+            torch.tensor([0.3] * gpt.num_vq, device=device),
+            gpt.num_audio_tokens - 1,
+            torch.ones(batch, prompt, dtype=torch.bool, device=device),
+            max_new_token=length,
+            min_new_token=length,
+            show_tqdm=False,
+            manual_seed=seed,
+        )
+    )
+    return time.perf_counter() - start, result.ids
+
+
+class RandomEos:
+    """logits processor forcing EOS in each row with probability p"""
+
+    def __init__(self, eos: int, p: float, seed: int = 0):
+        self.eos = eos
+        self.p = p
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+        hit = torch.rand(scores.size(0), generator=self.generator) < self.p
+        scores[hit.to(scores.device), self.eos] = 1e4
+        return scores
+
+
+def random_prompts(gpt: GPT, n: int, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(16, 80, (n,), generator=generator).tolist()
+    emb = [
+        torch.randn(l, gpt.llama_config.hidden_size, generator=generator)
+        for l in lengths
+    ]
+    ids = [
+        torch.randint(0, gpt.num_audio_tokens - 1, (l, gpt.num_vq), generator=generator)
+        for l in lengths
+    ]
+    return [e.to(gpt.device) for e in emb], [i.to(gpt.device) for i in ids]
+
+
+def run_fixed(gpt: GPT, emb, ids, batch: int, max_new_token: int, eos_rate: float):
+    """consecutive slices of batch sentences, left padded like Tokenizer.encode"""
+    eos = gpt.num_audio_tokens - 1
+    processor = RandomEos(eos, eos_rate)
+    lengths = []
+    start = time.perf_counter()
+    for i in range(0, len(emb), batch):
+        e, d = emb[i : i + batch], ids[i : i + batch]
+        width = max(x.size(0) for x in e)
+        pad = lambda x: torch.cat([x.new_zeros(width - x.size(0), *x.shape[1:]), x])
+        mask = torch.stack(
+            [pad(torch.ones(x.size(0), dtype=torch.bool, device=x.device)) for x in e]
+        )
+        result = next(
+            gpt.generate(
+                torch.stack([pad(x) for x in e]),
+                torch.stack([pad(x) for x in d]),
+                torch.tensor([0.3] * gpt.num_vq, device=gpt.device),
+                eos,
+                mask,
+                max_new_token=max_new_token,
+                logits_processors=(processor,),
+                show_tqdm=False,
+            )
+        )
+        lengths.extend(int(x.size(0)) for x in result.ids)
+    return time.perf_counter() - start, lengths
+
+
+def run_continuous(gpt: GPT, emb, ids, batch: int, max_new_token: int, eos_rate: float):
+    eos = gpt.num_audio_tokens - 1
+    processor = RandomEos(eos, eos_rate)
+    start = time.perf_counter()
+    result = gpt.generate_continuous(
+        emb,
+        ids,
+        torch.tensor([0.3] * gpt.num_vq, device=gpt.device),
+        eos,
+        batch,
+        max_new_token=max_new_token,
+        # one EOS generator for every admission, like run_fixed
+        logits_processors_factory=lambda: (processor,),
+        show_tqdm=False,
+    )
+    return time.perf_counter() - start, [int(x.size(0)) for x in result.ids]
+
+
+def compare_scheduling(args, device: torch.device):
+    gpt = build_gpt(False, device)
+    emb, ids = random_prompts(gpt, args.sentences)
+    print(
+        f"{'batch':>5} {'schedule':>10} {'sentences/s':>12} {'tok/s':>8} {'mean len':>9} {'max len':>8}"
+    )
+    for batch in map(int, args.batch.split(",")):
+        for name, run_schedule in (
+            ("fixed", run_fixed),
+            ("continuous", run_continuous),
+        ):
+            seconds, lengths = run_schedule(
+                gpt, emb, ids, batch, args.max_new_token, args.eos_rate
+            )
+            print(
+                f"{batch:>5} {name:>10} {len(lengths) / seconds:>12.3f} {sum(lengths) / seconds:>8.1f}"
+                f" {sum(lengths) / len(lengths):>9.1f} {max(lengths):>8}"
+            )
+
+
+def per_call_ms(fn, repeat: int) -> float:
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+@torch.inference_mode()
+def compare_heads(args, device: torch.device):
+    gpt = build_gpt(False, device)
+    embed = gpt.code_logits.__self__
+    print(
+        f"{'batch':>5} {'heads loop':>11} {'heads fused':>12} {'emb loop':>9}"
+        f" {'emb fused':>10} {'step ms':>8}   (ms per token)"
+    )
+    for batch in map(int, args.batch.split(",")):
+        hidden = torch.randn(batch, 1, gpt.llama_config.hidden_size, device=device)
+        ids = torch.randint(
+            0, gpt.num_audio_tokens, (batch, 1, gpt.num_vq), device=device
+        )
+
+        def heads_loop():
+            with P.cached():
+                return torch.stack([h(hidden) for h in embed.head_code], 3)
+
+        def emb_loop():
+            return torch.stack(
+                [e(ids[:, :, i]) for i, e in enumerate(embed.emb_code)], 3
+            ).sum(3)
+
+        assert torch.allclose(heads_loop(), embed.code_logits(hidden), atol=1e-4)
+        assert torch.allclose(emb_loop(), embed.code_embedding(ids), atol=1e-5)
+        run(gpt, batch, args.prompt, 8)  # warm up
+        seconds, _ = run(gpt, batch, args.prompt, 128)
+        print(
+            f"{batch:>5} {per_call_ms(heads_loop, args.repeat):>11.3f}"
+            f" {per_call_ms(lambda: embed.code_logits(hidden), args.repeat):>12.3f}"
+            f" {per_call_ms(emb_loop, args.repeat):>9.3f}"
+            f" {per_call_ms(lambda: embed.code_embedding(ids), args.repeat):>10.3f}"
+            f" {seconds / 128 * 1000:>8.2f}"
+        )
+
+
+def compare_sampling(args):
+    config = Config()
+    warpers = [
+        TopPLogitsWarper(0.7, min_tokens_to_keep=3),
+        TopKLogitsWarper(20, min_tokens_to_keep=3),
+    ]
+    sampler = TopKTopPSampler(20, 0.7, min_tokens_to_keep=3)
+    print(f"{'rows':>5} {'vocab':>6} {'warpers ms':>11} {'fused ms':>9}   (per token)")
+    for batch in map(int, args.batch.split(",")):
+        for rows, vocab in (
+            (batch * config.gpt.num_vq, config.gpt.num_audio_tokens),
+            (batch, config.gpt.num_text_tokens),
+        ):
+            logits = torch.randn(rows, vocab) * 3
+            temperature = torch.full((rows, 1), 0.3)
+
+            def sample_warpers():
+                scores = logits / temperature
+                for warper in warpers:
+                    scores = warper(None, scores)
+                return torch.multinomial(torch.softmax(scores, -1), 1)
+
+            print(
+                f"{rows:>5} {vocab:>6} {per_call_ms(sample_warpers, args.repeat):>11.3f}"
+                f" {per_call_ms(lambda: sampler.sample(logits, temperature), args.repeat):>9.3f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="GPT.generate tokens/s on random weights"
+    )
+    parser.add_argument(
+        "--lengths",
+        type=str,
+        default="128,512,1024",
+        help="Generated tokens per sentence",
+    )
+    parser.add_argument("--batch", type=str, default="1,4", help="Batch sizes")
+    parser.add_argument(
+        "--prompt", type=int, default=64, help="Prompt length in tokens"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch.set_num_threads"
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--sentences",
+        type=int,
+        default=0,
+        help="Compare fixed and continuous batching on this many sentences",
+    )
+    parser.add_argument(
+        "--eos_rate",
+        type=float,
+        default=0.003,
+        help="Per step and codebook probability of EOS with --sentences",
+    )
+    parser.add_argument(
+        "--max_new_token",
+        type=int,
+        default=512,
+        help="Sentence length cap with --sentences",
+    )
+    parser.add_argument(
+        "--heads",
+        action="store_true",
+        help="Compare per-codebook and stacked code heads/embeddings per token",
+    )
+    parser.add_argument(
+        "--sampling",
+        action="store_true",
+        help="Compare the HF top-p/top-k warpers with TopKTopPSampler per token",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=200,
+        help="Calls timed per case with --heads or --sampling",
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    if args.sentences:
+        compare_scheduling(args, device)
+        return
+    if args.heads:
+        compare_heads(args, device)
+        return
+    if args.sampling:
+        compare_sampling(args)
+        return
+    models = {"dynamic": build_gpt(False, device), "static": build_gpt(True, device)}
+
+    print(
+        f"{'batch':>5} {'tokens':>6} "
+        + " ".join(f"{name + ' tok/s':>14}" for name in models)
+        + "  same ids"
+    )
+    for batch in map(int, args.batch.split(",")):
+        for length in map(int, args.lengths.split(",")):
+            rates = []
+            ids = []
+            for gpt in models.values():
+                run(gpt, batch, args.prompt, 8)  # warm up
+                seconds, result = run(gpt, batch, args.prompt, length)
+                rates.append(batch * length / seconds)
+                ids.append(result)
+            same = all(torch.equal(a, b) for a, b in zip(ids[0], ids[-1]))
+            print(
+                f"{batch:>5} {length:>6} "
+                + " ".join(f"{r:>14.1f}" for r in rates)
+                + f"  {same}"
+            )
+
+
+if __name__ == "__main__":
+    main()